@@ -5,43 +5,77 @@ Created on Wed Aug 10 08:31:57 2011
 @author: rueffer
 """
 
-import re, socket, threading
-from time import sleep
+import atexit, os, re, socket, threading
+from time import sleep, time, mktime
+from hashlib import md5
 from struct import unpack, pack
 from string import atoi
 from calendar import timegm
 from datetime import datetime
 from collections import OrderedDict
+from mbe_pyramid import DecimationPyramid
 import numpy as np
 from numpy import greater, bool8, uint8, uint32, float32, float64, ndarray, array, take, frombuffer, empty, hstack, \
-    dtype
+    dtype, unpackbits, ascontiguousarray, memmap, datetime64
 #from  PyQt4 import QtGui, QtCore
 
 
-class StayAliveThread(threading.Thread):
+class ConnectionLost(RuntimeError):
+    pass
+
+
+class KeepAliveThread(threading.Thread):
+    """ Sends a keepalive to the server whenever the connection has been idle for a while and measures its round trip
+    time. If it fails, the connection takes care of reconnecting.
+    """
+
+    def __init__(self, connection, interval=15.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.connection = connection
+        self.interval = interval
+        self.failures = 0
+        self.__stop = threading.Event()
+
     def stop(self):
-        self.__stop = True
+        self.__stop.set()
 
     def run(self):
-        self.__stop = False
-        self.connection = self._Thread__kwargs["connection"]
-        self.semaphore = self._Thread__kwargs["semaphore"]
-        while not self.__stop:
-            for i in xrange(150):
-                sleep(0.1)
-                if self.__stop:
-                    #                    print "stop"
-                    break
-            if not self.__stop and not self.semaphore.locked():
-                try:
-                    if not self.connection.send_command("OK") == "OK":
-                        raise RuntimeError("Unexpected answer from server during stayalive signal")
-                except Exception, err:
-                    print "Error: " + str(err)
+        clock = time  # The module globals are set to None when the interpreter shuts down
+        while not self.__stop.is_set():
+            idle = clock() - self.connection.lastTraffic
+            if idle < self.interval:  # Real traffic keeps the connection alive, no need to send anything
+                self.__stop.wait(self.interval - idle)
+                continue
+            start = clock()
+            try:
+                if not self.connection.send_command("OK") == "OK":
+                    raise RuntimeError("Unexpected answer from server during stayalive signal")
+                self.connection.latency = clock() - start
+            except Exception, err:
+                if self.__stop.is_set():
+                    return  # Closed while sending
+                self.failures += 1
+                print "Error: " + str(err)
+                self.__stop.wait(self.interval)
+
+
+@atexit.register
+def stopKeepAlives():
+    """ Stops the keepalive threads of the connections which were not closed, before the interpreter shuts down
+    """
+    threads = [thread for thread in threading.enumerate() if isinstance(thread, KeepAliveThread)]
+    for thread in threads:
+        thread.stop()
+    for thread in threads:
+        thread.join(1.0)
 
 
 class ServerConnection:
-    def __init__(self, tcp, port, password, name="test", bufferSize=1024):
+    configCache = {}  # ByteInterpreters by md5 of the config header, so reconnecting doesn't parse it again
+
+    def __init__(self, tcp, port, password, name="test", bufferSize=1024, keepalive=15.0, timeout=60.0,
+                 reconnectTries=5, reconnectTimeout=5.0):
         self.tcp = tcp
         if isinstance(port, int):
             self.port = port
@@ -54,78 +88,230 @@ class ServerConnection:
         self.byteInterpreter = None
         self.Chamber = None
         self.name = name
-        self.__stayAlive = None
+        self.timeout = timeout  # Without an answer for this long, the connection is considered lost
+        self.reconnectTries = reconnectTries
+        # Reconnecting happens with the connection locked, a dead server must not block the other threads for long
+        self.reconnectTimeout = reconnectTimeout
+        self.reconnects = 0
+        self.latency = None  # Round trip time of the last keepalive
+        self.lastTraffic = time()
+        self.stats = None  # Set to a mbe_stats.CommandStats to record the timing of every command
+        self.__keepAlive = None
         self.__semaphore = threading.Lock()
-        self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.__socket.connect((self.tcp, self.port))
+        self.__buffer = bytearray(bufferSize)  # Reused for every reply, grows when a bigger frame comes in
+        self.__socket = None
         self.__connect()
+        if keepalive:
+            self.__keepAlive = KeepAliveThread(self, keepalive)
+            self.__keepAlive.start()
 
     def __del__(self):
         # does not work in this implementation
-        self.__stayAlive.stop()
-        self.__socket.close()
+        self.close()
 
     def close(self):
-        self.__stayAlive.stop()
-        self.__socket.close()
-
-    def __connect(self):
+        if self.__keepAlive is not None:
+            self.__keepAlive.stop()
+            if self.__keepAlive is not threading.current_thread():
+                self.__keepAlive.join(self.timeout)
+        if self.__socket is not None:
+            self.__socket.close()
+
+    def __connect(self, timeout=None):
+        """ Open the socket, log in and get the config and chamber. Called with the connection locked, or at init.
+
+        :param timeout: socket timeout while connecting and logging in, self.timeout if None. The connection uses
+            self.timeout once it is established.
+        """
+        self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__socket.settimeout(self.timeout if timeout is None else timeout)
+        self.__socket.connect((self.tcp, self.port))
         self.__send(self.password + "Client:" + self.name)
         self.__receiveConfig()
-        self.Chamber = self.send_command("get this.chamber")
-        self.__stayAlive = StayAliveThread(kwargs={"connection": self, "semaphore": self.__semaphore})
-        self.__stayAlive.start()
+        self.__send(self.password + "get this.chamber")
+        self.Chamber = self.__receive()
+        self.__socket.settimeout(self.timeout)
+        self.lastTraffic = time()
+
+    def __reconnect(self, reason):
+        print "Error: {}. Reconnecting to {}:{}".format(reason, self.tcp, self.port)
+        for attempt in xrange(self.reconnectTries):
+            try:
+                self.__socket.close()
+                self.__connect(self.reconnectTimeout)
+                self.reconnects += 1
+                print "Reconnected to {}:{}".format(self.tcp, self.port)
+                return
+            except (RuntimeError, socket.error), err:
+                reason = err
+                if attempt < self.reconnectTries - 1:
+                    sleep(min(2 ** attempt, 10))
+        raise ConnectionLost("Could not reconnect to the MBE server: {}".format(reason))
 
     def __receiveConfig(self):
-        answer = self.send_command("get this.config")
-        self.ByteInterpreter = ByteInterpreter(answer)
+        self.__send(self.password + "get this.config")
+        answer = self.__receive()
+        key = md5(answer).hexdigest()
+        if key not in ServerConnection.configCache:
+            ServerConnection.configCache[key] = ByteInterpreter(answer)
+        self.ByteInterpreter = ServerConnection.configCache[key]
+
+    def __locked(self, func, repeatable=True, label="", durations=None):
+        """ Run func while holding the connection. If the connection was lost, reconnect and run func again if it is
+        safe to repeat. All errors are raised as RuntimeError.
+
+        :param label: command recorded in the statistics, or the list of the commands of a batch
+        :param durations: for a batch, list which func fills with the time each reply took
+        """
+        start = time()
+        self.__semaphore.acquire()
+        acquired = time()
+        try:
+            try:
+                result = func()
+            except (ConnectionLost, socket.error), exep:
+                self.__reconnect(exep)
+                if not repeatable:
+                    raise ConnectionLost("Reconnected after '{}', command was not repeated".format(exep))
+                result = func()
+            self.lastTraffic = time()
+        except ConnectionLost:
+            self.__semaphore.release()
+            raise
+        except Exception, exep:
+            self.__semaphore.release()
+            raise RuntimeError(exep)
+        self.__semaphore.release()
+
+        if self.stats is not None:
+            if durations is None:
+                self.stats.record_command(label, self.lastTraffic - acquired, acquired - start)
+            else:
+                self.stats.record_batch(label, durations, acquired - start)
+        return result
+
+    def __frame(self, byte):
+        return pack("!l", len(byte)) + byte
 
     def __send(self, byte):
-        lengthInfo = pack("!l", len(byte))
-        self.__socket.send(lengthInfo + byte)
+        self.__socket.sendall(self.__frame(byte))
 
     #        print "sent "+str(len(byte)) + " bytes"
 
-    def __receive(self, allowElse=True):
-        a = self.__socket.recv(4)
-        lengthInfo = unpack("!l", a)[0]
+    def __receiveInto(self, length):
+        """ Receive exactly length bytes into the reusable buffer and return a view on them. The view is only valid
+        until the next receive.
+        """
+        if length > len(self.__buffer):
+            self.__buffer = bytearray(max(length, 2 * len(self.__buffer)))
+        view = memoryview(self.__buffer)
+        received = 0
+        while received < length:
+            n = self.__socket.recv_into(view[received:length], length - received)
+            if not n:
+                raise ConnectionLost("Connection closed by server")
+            received += n
+        return view[:length]
+
+    def __receive(self, allowElse=True, raw=False):
+        """ Receive one answer of the server. With raw=True a buffer on the received bytes is returned instead of a
+        string, it is only valid until the next receive.
+        """
+        lengthInfo = unpack("!l", self.__receiveInto(4).tobytes())[0]
         #        print "received "+str(lengthInfo) + " bytes"
         if lengthInfo:
-            answer = self.__socket.recv(lengthInfo)
+            view = self.__receiveInto(lengthInfo)
+            if lengthInfo > 4:  # Too long to be one of the control answers below
+                if allowElse:
+                    raise RuntimeError(view.tobytes())
+                return buffer(self.__buffer, 0, lengthInfo) if raw else view.tobytes()
+            answer = view.tobytes()
             if answer == "OK":
                 return answer
             elif answer == "WAIT":
-                answer = self.__receive(False)
+                answer = self.__receive(False, raw)
                 return answer
             elif answer == "PWD":
                 raise RuntimeError("Error 9201: Password rejected")
             elif allowElse:
                 raise RuntimeError(answer)
-            return answer
+            return buffer(self.__buffer, 0, lengthInfo) if raw else answer
         else:
             return ""
 
     def send_command(self, cmd):
-        self.__semaphore.acquire()
-        self.__send(self.password + cmd)
-        try:
-            answer = self.__receive()
-            self.__semaphore.release()
-        except Exception, exep:
-            self.__semaphore.release()
-            raise RuntimeError(exep)
+        def request():
+            self.__send(self.password + cmd)
+            return self.__receive()
+
+        # Commands that count something on the server can't be repeated blindly after a reconnect
+        return self.__locked(request, repeatable="recipesrunning" not in cmd.lower(), label=cmd)
 
-        return answer
+    def send_many(self, cmds):
+        """
+        Sends several commands while holding the connection only once. All frames are written back-to-back and the
+        replies are collected afterwards in the same order, instead of doing one full round trip per command.
 
-    def getStatus(self):
-        strData = self.send_command("get this.StatusInBytes")
-        return self.ByteInterpreter.convert(strData)
+        :param cmds: commands to send (ex: ["Get Ga.PV", "Get In.PV"])
+        :type cmds: list of str
+        :return: replies of the server, in the same order as the commands
+        :rtype: list of str
+        """
+        if not cmds:
+            return []
+        durations = []  # Time each reply took, for the statistics
+
+        def request():
+            answers = []
+            error = None
+            del durations[:]  # Measured again if the batch is repeated after reconnecting
+            last = time()
+            self.__socket.sendall("".join([self.__frame(self.password + cmd) for cmd in cmds]))
+            for cmd in cmds:
+                # Keep reading after an error reply, otherwise the following replies stay in the socket
+                try:
+                    answers.append(self.__receive())
+                except ConnectionLost:
+                    raise
+                except RuntimeError, exep:
+                    answers.append(None)
+                    if error is None:
+                        error = exep
+                now = time()
+                durations.append(now - last)
+                last = now
+            return answers, error
+
+        answers, error = self.__locked(request, repeatable=not any(["recipesrunning" in cmd.lower() for cmd in cmds]),
+                                       label=cmds, durations=durations)
+        if error is not None:
+            raise RuntimeError(error)
+        return answers
+
+    def getStatus(self, lazy=False):
+        """ Fetch the whole machine state in one frame
+
+        :param lazy: return a LazyRecords which only decodes the columns which are used
+        """
+        # Decode straight from the receive buffer, this has to happen before anybody else can use the connection
+        def request():
+            self.__send(self.password + "get this.StatusInBytes")
+            if lazy:  # Decoded later, so it needs its own copy of the frame
+                return self.ByteInterpreter.convert_lazy(self.__receive(raw=True)[:])
+            return self.ByteInterpreter.convert(self.__receive(raw=True))
+
+        return self.__locked(request, label="Get this.StatusInBytes")
 
     def getSections(self):
         return self.ByteInterpreter.byteConfig.sections
 
     def getValue(self, name):
-        return self.getStatus()[name][0]
+        # Only decode this column, straight from the receive buffer
+        def request():
+            self.__send(self.password + "get this.StatusInBytes")
+            return self.ByteInterpreter.convert_lazy(self.__receive(raw=True))[name][0]
+
+        return self.__locked(request, label="Get this.StatusInBytes")
 
 
 class helping:
@@ -143,10 +329,136 @@ class helping:
         self.empty = empty
         self.hstack = hstack
         self.dtype = dtype
+        self.unpackbits = unpackbits
+        self.ascontiguousarray = ascontiguousarray
+        self.memmap = memmap
+        self.datetime64 = datetime64
 
 
 np = helping()
 
+GATE_VALVE_STATES = ["Undefi", "Closed", "Open", "Undefi"]  # Gate valves are decoded to these codes (2 bits each)
+
+
+def unpack_bits(words, count=32):
+    """ Unpacks the lowest count bits of all the B32 words at once
+
+    :param words: array of 32 bit words, in any byte order
+    :return: array of shape (len(words), count), column i is bit i
+    :rtype: numpy.ndarray of bool
+    """
+    words = np.ascontiguousarray(np.array(words, ndmin=1), dtype=">u4")
+    # Big-endian bytes unpack to bit 31 first, so reversing the columns gives bit 0 first
+    bits = np.unpackbits(words.view(np.uint8).reshape(-1, 4), axis=1)[:, ::-1]
+    return np.ascontiguousarray(bits[:, :count]).view(np.bool8)
+
+
+def unpack_states(words, count=16):
+    """ Unpacks the 2 bit states of all the gate valve words at once
+
+    :param words: array of 32 bit words, in any byte order
+    :return: array of shape (len(words), count) with the state codes, use GATE_VALVE_STATES or state_strings to get
+        their names
+    :rtype: numpy.ndarray of uint8
+    """
+    bits = unpack_bits(words, 2 * count).view(np.uint8)
+    return bits[:, 0::2] + 2 * bits[:, 1::2]
+
+
+def state_strings(codes):
+    """ String view of gate valve state codes, ex: 2 -> "Open"
+    """
+    return np.array(GATE_VALVE_STATES, dtype="S6")[codes]
+
+
+def decode_records(rawData, byteConfig, timeoffset, out=None):
+    """ Decodes raw (big-endian) records described by byteConfig.dtypefile into byteConfig.dtype
+
+    :param out: array of dtype byteConfig.dtype and the same length as rawData to decode into, a new one by default
+    """
+    temp = np.empty(rawData.shape, dtype=byteConfig.dtype) if out is None else out
+    for i in byteConfig.translate["Copy"]:
+        if i == "Time":
+            temp[i] = rawData[i] + timeoffset
+        else:
+            temp[i] = rawData[i]
+    for i, names in byteConfig.translate["Modify"].iteritems():
+        if i == "GateValves":
+            values = unpack_states(rawData[i], len(names))
+        else:
+            values = unpack_bits(rawData[i], len(names))
+        for n, j in enumerate(names):
+            temp[j] = values[:, n]
+    return temp
+
+
+class LazyRecords:
+    """ Decoded view of raw records which only decodes a column when it is used for the first time, and keeps it.
+    Float and time columns are converted to native byte order, a bitfield section is unpacked when one of its columns
+    is used. Indexing works like for the decoded structured array:
+
+        records["Ga.PV"]  # column
+        records[0]  # decoded record
+        records[10:20]  # LazyRecords of these records
+    """
+
+    def __init__(self, rawData, byteConfig, timeoffset):
+        """
+        :param rawData: records of dtype byteConfig.dtypefile, they have to stay valid as long as this object is used
+        """
+        self.raw = rawData
+        self.byteConfig = byteConfig
+        self.dtype = byteConfig.dtype  # Of the decoded records
+        self.names = byteConfig.dtype.names
+        self.__timeoffset = timeoffset
+        self.__columns = {}
+        self.__sections = {}  # column name: bitfield section it is in
+        for section, names in byteConfig.translate["Modify"].iteritems():
+            for name in names:
+                self.__sections[name] = section
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.get_column(key)
+        elif isinstance(key, slice):
+            return LazyRecords(self.raw[key], self.byteConfig, self.__timeoffset)
+        return decode_records(self.raw[key:key + 1 or None], self.byteConfig, self.__timeoffset)[0]
+
+    def get_column(self, name):
+        if name not in self.__columns:
+            if name in self.__sections:
+                section = self.__sections[name]
+                names = self.byteConfig.translate["Modify"][section]
+                if section == "GateValves":
+                    values = unpack_states(self.raw[section], len(names))
+                else:
+                    values = unpack_bits(self.raw[section], len(names))
+                for n, j in enumerate(names):
+                    self.__columns[j] = values[:, n]
+            elif name == "Time":
+                self.__columns[name] = self.raw[name] + self.__timeoffset
+            elif name in self.byteConfig.translate["Copy"]:
+                self.__columns[name] = self.raw[name].astype(self.byteConfig.dtype[name])
+            else:
+                raise KeyError(name)
+        return self.__columns[name]
+
+    def to_array(self, columns=None):
+        """ Decodes everything, or only some columns, into a structured array
+
+        :param columns: names of the columns, all of them if None
+        :rtype: numpy.ndarray
+        """
+        if columns is None:
+            return decode_records(self.raw, self.byteConfig, self.__timeoffset)
+        temp = np.empty(self.raw.shape, dtype=[(name, self.byteConfig.dtype[name]) for name in columns])
+        for name in columns:
+            temp[name] = self.get_column(name)
+        return temp
+
 
 class ByteInterpreter:
     def __init__(self, astring):
@@ -157,10 +469,7 @@ class ByteInterpreter:
         return self.byteConfig.sections
 
     def iToBin(self, value, bit=32):
-        l = []
-        for i in xrange(bit):
-            l.append(np.greater(value & 2 ** i, 0))
-        return l
+        return list(unpack_bits(value, bit).T)
 
     def iToEnum(self, value, bit=2, no=16):
         l = []
@@ -169,14 +478,7 @@ class ByteInterpreter:
         return l
 
     def iToStr(self, value, no=2):
-        strings = ["Undefi", "Closed", "Open", "Undefi"]
-        if not isinstance(value, np.ndarray):
-            value = np.array([value])
-        l = []
-        for i in range(0, no * 2, 2):
-            l.append(np.take(strings, (np.greater((value & 2 ** i), 0).astype(np.uint8) + \
-                                       2 * np.greater((value & 2 ** (i + 1)), 0).astype(np.uint8))))
-        return l
+        return list(state_strings(unpack_states(value, no)).T)
 
     def get_names(self):
         return self.data.dtype.names
@@ -195,46 +497,60 @@ class ByteInterpreter:
 
 
     def convert(self, strData):
-        """ Read all data after current file position
+        """ Decode a status frame. strData can be a string or a buffer object, it is read without copying
         """
         rawData = np.frombuffer(strData, self.byteConfig.dtypefile)
-        self.temp = rawData
-        temp = np.empty(rawData.shape, dtype=self.byteConfig.dtype)
+        return decode_records(rawData, self.byteConfig, self.__timeoffset)
 
-        for i in self.byteConfig.translate["Copy"]:
-            if i == "Time":
-                temp[i] = rawData[i] + self.__timeoffset
-            else:
-                temp[i] = rawData[i]
-        for i in self.byteConfig.translate["Modify"]:
-            if i == "GateValves":
-                strings = self.iToStr(rawData[i], no=len(self.byteConfig.translate["Modify"][i]))
-                for n, j in enumerate(self.byteConfig.translate["Modify"][i]):
-                    temp[j] = strings[n]
-            else:
-                bools = self.iToBin(rawData[i], len(self.byteConfig.translate["Modify"][i]))
-                for n, j in enumerate(self.byteConfig.translate["Modify"][i]):
-                    temp[j] = bools[n]
+    def convert_lazy(self, strData):
+        """ Like convert, but the columns are only decoded when they are used. strData has to stay valid as long as
+        the result is used.
 
-        return temp
+        :rtype: LazyRecords
+        """
+        return LazyRecords(np.frombuffer(strData, self.byteConfig.dtypefile), self.byteConfig, self.__timeoffset)
 
 
 class LogFile:
-    def __init__(self, path):
+    def __init__(self, path, memoryMap=False, decodeAll=None):
+        """
+        :param path: path of the binary log file
+        :param memoryMap: if True the records are memory-mapped instead of read into memory, and by default nothing is
+            decoded up front: self.data is then a LazyRecords which decodes a column the first time it is used. Use it
+            for multi-day logs.
+        :param decodeAll: whether all the records are decoded into RAM right away. Defaults to False with memoryMap,
+            it is always True without. Use get_records() or get_range() to decode only the part you need.
+        """
+        self.path = path
         self.byteConfig = ByteConfig(path, closeFile=False)
         self.file = self.byteConfig.file
+        self.memoryMap = memoryMap
+        self.decodeAll = not memoryMap if decodeAll is None else decodeAll or not memoryMap
+        self.dataOffset = self.file.tell()  # The records start right after the header
+        self.records = None  # Memory-mapped raw records, only with memoryMap
+        self.columns = None  # LazyRecords of all the records, only without decodeAll (then self.data is the same)
+        self.__pyramid = None
+        self.count = 0  # Number of records decoded so far
         self.data = None
+        self.__buffer = None  # Decoded records, grows in chunks. self.data is a view of its filled part
+        self.__rest = ""  # Incomplete record at the end of the file, completed on the next read
         self.__timeoffset = timegm((1904, 1, 1, 0, 0, 0))
         self.readNew()
 
+    def close(self):
+        """ Closes the file, the data which was already decoded stays available (not with a lazy self.data)
+        """
+        self.columns = None
+        if not self.decodeAll:
+            self.data = None
+        self.records = None
+        self.file.close()
+
     def get_sections(self):
         return self.byteConfig.sections
 
     def iToBin(self, value, bit=32):
-        l = []
-        for i in xrange(bit):
-            l.append(np.greater(value & 2 ** i, 0))
-        return l
+        return list(unpack_bits(value, bit).T)
 
     def iToEnum(self, value, bit=2, no=16):
         l = []
@@ -243,14 +559,7 @@ class LogFile:
         return l
 
     def iToStr(self, value, no=2):
-        strings = ["Undefi", "Closed", "Open", "Undefi"]
-        if not isinstance(value, np.ndarray):
-            value = np.array([value])
-        l = []
-        for i in range(0, no * 2, 2):
-            l.append(np.take(strings, (np.greater((value & 2 ** i), 0).astype(np.uint8) + \
-                                       2 * np.greater((value & 2 ** (i + 1)), 0).astype(np.uint8))))
-        return l
+        return list(state_strings(unpack_states(value, no)).T)
 
     def get_data(self, row, column):
         name = self.data.dtype.names[column + 1]
@@ -266,33 +575,197 @@ class LogFile:
 
 
     def readNew(self):
-        """ Read all data after current file position
+        """ Read all data after current file position. Only the new records are decoded, they are appended to
+        self.data without copying the older ones (most of the time).
+
+        :return: number of new records
+        :rtype: int
         """
-        strData = self.file.read()
-        rawData = np.frombuffer(strData, self.byteConfig.dtypefile)
+        itemsize = self.byteConfig.dtypefile.itemsize
+        if self.memoryMap:
+            count = (os.fstat(self.file.fileno()).st_size - self.dataOffset) // itemsize
+            if count > self.count:
+                self.records = np.memmap(self.path, dtype=self.byteConfig.dtypefile, mode="r", offset=self.dataOffset,
+                                         shape=(count,))
+                rawData = self.records[self.count:]
+            else:
+                rawData = np.empty(0, dtype=self.byteConfig.dtypefile)
+        else:
+            strData = self.__rest + self.file.read()
+            complete = len(strData) // itemsize
+            self.__rest = strData[complete * itemsize:]
+            rawData = np.frombuffer(strData, self.byteConfig.dtypefile, count=complete)
         self.temp = rawData
-        temp = np.empty(rawData.shape, dtype=self.byteConfig.dtype)
 
-        for i in self.byteConfig.translate["Copy"]:
-            if i == "Time":
-                temp[i] = rawData[i] + self.__timeoffset
-            else:
-                temp[i] = rawData[i]
-        for i in self.byteConfig.translate["Modify"]:
-            if i == "GateValves":
-                strings = self.iToStr(rawData[i], no=len(self.byteConfig.translate["Modify"][i]))
-                for n, j in enumerate(self.byteConfig.translate["Modify"][i]):
-                    temp[j] = strings[n]
+        start, end = self.count, self.count + len(rawData)
+        if not self.decodeAll:
+            self.count = end
+            if len(rawData) or self.columns is None:
+                self.columns = LazyRecords(self.records if self.records is not None else rawData, self.byteConfig,
+                                           self.__timeoffset)
+                self.data = self.columns
+            return len(rawData)
+        if self.__buffer is None or end > len(self.__buffer):
+            # Grow geometrically, so that appending stays linear in the total number of records
+            grown = np.empty(max(2 * end, 1024), dtype=self.byteConfig.dtype)
+            if self.__buffer is not None:
+                grown[:start] = self.__buffer[:start]
+            self.__buffer = grown
+        decode_records(rawData, self.byteConfig, self.__timeoffset, out=self.__buffer[start:end])
+        self.count = end
+        self.data = self.__buffer[:end]
+        return len(rawData)
+
+    def follow(self, interval=1.0, timeout=None, minBatch=1):
+        """ Follows the log file while the MBE keeps writing to it, like "tail -f". The file is polled every interval
+        seconds for new records.
+
+            for batch in LogFile(path, memoryMap=True).follow():
+                plot(batch["Time"], batch["Ga.PV"])
+
+        :param interval: time between two checks of the file in seconds
+        :param timeout: stop once no new record arrived for this many seconds, follow forever if None
+        :param minBatch: only yield once at least this many new records are there
+        :return: generator of the newly decoded records (array of dtype byteConfig.dtype), in batches
+        """
+        start = self.count
+        lastRecord = time()
+        while True:
+            if self.readNew():
+                lastRecord = time()
+            if self.count - start >= minBatch:
+                batch = self.get_records(start, self.count)
+                start = self.count
+                yield batch
+            elif timeout is not None and time() - lastRecord > timeout:
+                if self.count > start:
+                    yield self.get_records(start, self.count)
+                return
             else:
-                bools = self.iToBin(rawData[i], len(self.byteConfig.translate["Modify"][i]))
-                for n, j in enumerate(self.byteConfig.translate["Modify"][i]):
-                    temp[j] = bools[n]
+                sleep(interval)
+
+    def get_records(self, start, end):
+        """ Decoded records start to end, only these are decoded if the file wasn't decoded up front
+
+        :rtype: numpy.ndarray of dtype byteConfig.dtype
+        """
+        if self.decodeAll:
+            return self.data[start:end]
+        return self.columns[start:end].to_array()
+
+    def get_column(self, name, start=0, end=None):
+        """ One column of the log, without decoding the others if the file wasn't decoded up front
 
-        if self.data == None:
-            self.data = temp
+        :param name: name of the column, ex: "Manip.PV"
+        :rtype: numpy.ndarray
+        """
+        if self.decodeAll:
+            return self.data[name][start:end]
+        return self.columns[name][start:end]
+
+    def time_index(self, t):
+        """ Index of the first record at or after a certain time, found by binary search on the Time column (which
+        is monotonic), so nothing needs to be decoded
+
+        :param t: datetime (local time, like get_time), numpy.datetime64 (UTC) or unix timestamp in seconds
+        :rtype: int
+        """
+        t = to_timestamp(t)
+        if self.decodeAll:
+            column, offset = self.data["Time"], 0
         else:
-            self.data = np.hstack([self.data, temp])
-            # self.data = temp
+            column, offset = self.columns.raw["Time"], self.__timeoffset
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if column[middle] + offset < t:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def get_range(self, start=None, end=None, columns=None):
+        """ Records between two times, ex: log.get_range(datetime(2018, 5, 3, 14, 2), datetime(2018, 5, 3, 14, 35),
+        ["Ga.PV", "BFM.P"]). Only this part of the log gets decoded.
+
+        :param start: first time to include (see time_index), from the beginning of the log if None
+        :param end: time to stop at (excluded), until the end of the log if None
+        :param columns: names of the columns to return (Time is always included), all of them if None
+        :return: the records
+        :rtype: numpy.ndarray of dtype byteConfig.dtype
+        """
+        first = 0 if start is None else self.time_index(start)
+        last = max(first, self.count if end is None else self.time_index(end))
+        if columns is None:
+            return self.get_records(first, last)
+        columns = ["Time"] + [column for column in columns if column != "Time"]
+        if self.decodeAll:
+            return self.data[first:last][columns]
+        return self.columns[first:last].to_array(columns)
+
+    def pyramid(self, save=True):
+        """ Min/max/mean pyramid of all the columns (see mbe_pyramid), for plotting long logs. It is kept in a file
+        next to the log and only the records added since then are processed.
+
+        :param save: save the updated pyramid next to the log (<log>.pyramid.npz)
+        :rtype: mbe_pyramid.DecimationPyramid
+        """
+        columns = [name for name in self.byteConfig.dtype.names if name != "Time"]
+        path = self.path + ".pyramid.npz"
+        if self.__pyramid is None and os.path.exists(path):
+            self.__pyramid = DecimationPyramid.load(path)
+            if self.__pyramid.columns != columns or self.__pyramid.count > self.count:
+                self.__pyramid = None  # Not made from this log
+        if self.__pyramid is None:
+            self.__pyramid = DecimationPyramid(columns)
+
+        if self.__pyramid.count < self.count:
+            for start in xrange(self.__pyramid.count, self.count, 1000000):  # In chunks, to limit the memory used
+                end = min(start + 1000000, self.count)
+                records = self.data[start:end] if self.decodeAll else self.columns[start:end]
+                self.__pyramid.append(records["Time"], dict([(column, records[column]) for column in columns]))
+            if save:
+                self.__pyramid.save(path)
+        return self.__pyramid
+
+    def get_decimated(self, columns, start=None, end=None, maxPoints=2000):
+        """ Columns of a time window reduced to about maxPoints points for plotting, every point gives the min, max
+        and mean of the samples it stands for. Short windows are returned at full resolution.
+
+        :param columns: names of the columns
+        :param start: beginning of the window (see time_index), from the beginning of the log if None
+        :param end: end of the window, until the end of the log if None
+        :return: (times, {column: (min, max, mean)})
+        :rtype: tuple
+        """
+        first = 0 if start is None else self.time_index(start)
+        last = max(first, self.count if end is None else self.time_index(end))
+        if last - first <= maxPoints:
+            times = self.get_column("Time", first, last)
+            return times, dict([(column, (self.get_column(column, first, last),) * 3) for column in columns])
+        times, data = self.pyramid().select(None if start is None else to_timestamp(start),
+                                            None if end is None else to_timestamp(end), maxPoints)
+        return times, dict([(column, data[column]) for column in columns])
+
+    def get_timestamps(self, data=None):
+        """ Times of the records as numpy.datetime64 (UTC), converted all at once
+
+        :param data: decoded records, all of self.data by default
+        :rtype: numpy.ndarray of datetime64[us]
+        """
+        if data is None:
+            data = self.data
+        return (data["Time"] * 1E6).astype("int64").astype("datetime64[us]")
+
+
+def to_timestamp(t):
+    """ Converts a datetime (local time), numpy.datetime64 (UTC) or unix timestamp to a unix timestamp in seconds
+    """
+    if isinstance(t, datetime):
+        return mktime(t.timetuple()) + t.microsecond / 1E6
+    elif isinstance(t, np.datetime64):
+        return t.astype("datetime64[us]").astype("int64") / 1E6
+    return float(t)
 
 
 class ByteConfig:
@@ -354,6 +827,12 @@ class ByteConfig:
     def calc_dtype(self):
         if self.header == "":
             raise ValueError("Please give a correct header")
+        try:
+            self.__parseHeader()
+        except AttributeError:  # One of the patterns below didn't match, ex: truncated log
+            raise ValueError("Corrupted header")
+
+    def __parseHeader(self):
 
         # print self.header
 
@@ -384,7 +863,7 @@ class ByteConfig:
                 return 8
 
         l = []
-        l2 = dict()
+        l2 = OrderedDict()  # In header order, so that the OFF elements are numbered the same way in dtype and translate
         self.translate = dict([("Copy", dict()), ("Modify", dict())])
         for head in headerlist:
             temp = re.match(pattern1, head).groups()
@@ -455,7 +934,7 @@ class ByteConfig:
         for i in l:
             if i[0] in l2:
                 if i[0] == "GateValves":
-                    t = np.dtype("S6")
+                    t = np.uint8  # State code, see GATE_VALVE_STATES
                 else:
                     t = np.bool8
                 for j in l2[i[0]]:
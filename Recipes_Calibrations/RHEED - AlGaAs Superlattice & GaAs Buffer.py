@@ -115,14 +115,16 @@ if __name__ == '__main__':
         ##############################################################################
 
         ts_print("Starting superlattice growth")
+        # Plan all the shutter movements first so that the layers don't drift over the cycles
+        t_cycle = t_growth_sl_algaas + t_growth_sl_gaas + t_growth_sl_pause
+        timeline = mbe.timeline()
         for i in range(n_superlattice_cycles):
-            mbe.shutter("Ga", True)
-            mbe.shutter("Al", True)
-            mbe.waiting(t_growth_sl_algaas)  # Wait Growth Time
-            mbe.shutter("Al", False)
-            mbe.waiting(t_growth_sl_gaas)  # Wait Growth Time
-            mbe.shutter("Ga", False)
-            mbe.waiting(t_growth_sl_pause)  # Wait Growth Time
+            timeline.shutter(i * t_cycle, ["Ga", "Al"], [True, True])
+            timeline.shutter(i * t_cycle + t_growth_sl_algaas, "Al", False)
+            timeline.shutter(i * t_cycle + t_growth_sl_algaas + t_growth_sl_gaas, "Ga", False)
+        t_start = mbe.recipe_time()
+        timeline.run(t_start)
+        mbe.wait_until(t_start + n_superlattice_cycles * t_cycle)  # Pause after the last cycle
 
         ##############################################################################
         # GaAs Buffer #2
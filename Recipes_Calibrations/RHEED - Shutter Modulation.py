@@ -21,12 +21,14 @@ if __name__ == '__main__':
         mbe.start_recipe()
 
         # Define parameters
-        n_repetitions = 200
         t_open = 8  # seconds
         t_close = 8  # seconds
 
-        while n_repetitions:
-            mbe.shutter("Ga", True)
-            mbe.waiting(t_open)
-            mbe.shutter("Ga", False)
-            mbe.waiting(t_open)
+        # One period, run again and again against fixed start marks so that the period doesn't drift
+        timeline = mbe.timeline()
+        timeline.shutter(0, "Ga", True)
+        timeline.shutter(t_open, "Ga", False)
+        start = mbe.recipe_time()
+        while True:  # Toggles until the recipe is stopped
+            timeline.run(start)
+            start += t_open + t_close
@@ -46,7 +46,7 @@ def cool_down(mbe, cell):
 
 if __name__ == "__main__":
 
-    with MBERecipe(virtual_server=False, stdby_at_exit=False)as mbe:
+    with MBERecipe(virtual_server=False, stdby_at_exit=False, snapshot_ttl=0.5) as mbe:
 
         ref_temp_AsCracker = float(mbe.get_param("AsCracker.PV"))
         ref_temp_SbCracker = float(mbe.get_param("SbCracker.PV"))
@@ -0,0 +1,219 @@
+"""
+Throughput and latency benchmark of the communication with the MBE server. Runs a realistic mix of commands against
+the local virtual servers with an increasing number of concurrent clients and measures the commands per second and the
+p50/p99 latencies, for each kind of client:
+
+    connection  MBE_Tools.ServerConnection against the framed virtual server, one connection per client
+    shared      one MBE_Tools.ServerConnection shared by all the clients (like the recipe and its helper threads)
+    async       mbe_async.AsyncServerConnection against the framed virtual server, one connection per client
+    virtual     virtual_mbe_server_client.Connect against the normal virtual server
+
+The "recipe" command mix follows how often the recipes call set_param, shutter, waiting and wait_to_reach_temp, the
+"status" mix only fetches and decodes the binary status frame.
+
+The results are written to a JSON file. When a baseline file is given, the script exits with an error if the
+throughput of any benchmark dropped by more than the tolerance. Run it from the root of the toolbox:
+
+    python -m Virtual_MBE.benchmark_mbe_server --output results.json --baseline baseline.json
+"""
+
+import argparse, json, platform, random, sys, threading
+from datetime import datetime
+from time import time
+
+from MBE_Tools import ServerConnection
+from mbe_async import AsyncServerConnection
+from mbe_stats import LatencyHistogram
+from Virtual_MBE.virtual_mbe_framed_host import FramedMBEServer
+from Virtual_MBE.virtual_mbe_server_client import Connect
+from Virtual_MBE.virtual_mbe_server_host import VirtualMBEServer, MBERequestHandler
+
+# (weight, commands of one operation). Weights are the number of calls found in the recipes
+MIXES = {
+    "recipe": [(18053, ["Set Ga.PV.TSP 550", "Get Ga.PV.TSP"]),  # set_param: set and read back
+               (5267, ["Open In", "Get Shutter.In"]),  # shutter: actuate and read back
+               (4178, ["Wait 1"]),  # waiting
+               (3486, ["Get Manip.PV", "Get Manip.PV.TSP"])],  # wait_to_reach_temp: poll the temperature
+    "status": [(1, ["get this.StatusInBytes"])],
+}
+CLIENTS = ["connection", "shared", "async", "virtual"]
+
+
+class QuietMBERequestHandler(MBERequestHandler):
+    """
+    Same as MBERequestHandler but without printing every command, which would slow down the server
+    """
+
+    def handle(self):
+        data = self.request.recv(1024).strip()
+        self.request.sendall(str(self.process_command(data)))
+
+
+def operations(mix, seed):
+    """
+    Endless random sequence of operations following the weights of a command mix
+
+    :param mix: name of the command mix
+    :param seed: seed of the random generator, so that every run sends the same commands
+    """
+    rng = random.Random(seed)
+    entries = MIXES[mix]
+    total = float(sum([weight for weight, commands in entries]))
+    while True:
+        x = rng.random() * total
+        for weight, commands in entries:
+            x -= weight
+            if x <= 0:
+                break
+        yield commands
+
+
+def run_client(send, mix, seed, end, histogram):
+    """
+    Sends operations until the end time is reached and records the latency of every command
+
+    :param send: function sending one command and returning its answer
+    """
+    for commands in operations(mix, seed):
+        if time() > end:
+            return
+        for cmd in commands:
+            start = time()
+            send(cmd)
+            histogram.record(time() - start)
+
+
+def make_senders(client, n, address, mix):
+    """
+    Opens the connections of n concurrent clients
+
+    :return: (list of send functions, function closing the connections)
+    """
+    host, port = address
+    if client == "virtual":
+        conns = [Connect(host, port) for i in range(n)]
+        return [conn.send_command for conn in conns], lambda: None
+
+    if client == "async":
+        conns = [AsyncServerConnection(host, port, "xxa", name="benchmark{}".format(i), keepalive=None)
+                 for i in range(n)]
+        if mix == "status":
+            senders = [lambda cmd, conn=conn: conn.getStatus() for conn in conns]
+        else:
+            senders = [conn.call for conn in conns]
+    else:
+        count = 1 if client == "shared" else n
+        conns = [ServerConnection(host, port, "xxa", name="benchmark{}".format(i), keepalive=None)
+                 for i in range(count)]
+        conns = conns * n if client == "shared" else conns
+        if mix == "status":
+            senders = [lambda cmd, conn=conn: conn.getStatus() for conn in conns]
+        else:
+            senders = [conn.send_command for conn in conns]
+
+    def close():
+        for conn in set(conns):
+            conn.close()
+
+    return senders, close
+
+
+def run_benchmark(client, mix, n, duration, address, seed=0):
+    """
+    Runs one benchmark: n concurrent clients of one kind sending one command mix for duration seconds
+
+    :return: results of the benchmark
+    :rtype: dict
+    """
+    senders, close = make_senders(client, n, address, mix)
+    histograms = [LatencyHistogram() for i in range(n)]
+    start = time()
+    threads = [threading.Thread(target=run_client, args=(senders[i], mix, seed + i, start + duration, histograms[i]))
+               for i in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time() - start
+    close()
+
+    histogram = LatencyHistogram()
+    for h in histograms:
+        histogram.merge(h)
+    return {"client": client, "mix": mix, "concurrency": n, "commands": histogram.count, "seconds": elapsed,
+            "commands_per_s": histogram.count / elapsed, "mean_ms": histogram.mean() * 1E3,
+            "p50_ms": histogram.percentile(50) * 1E3, "p99_ms": histogram.percentile(99) * 1E3,
+            "max_ms": (histogram.max or 0) * 1E3}
+
+
+def start_server(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server.server_address
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: descriptions of the benchmarks whose throughput dropped by more than tolerance compared to the baseline
+    :rtype: list of str
+    """
+    previous = dict([((r["client"], r["mix"], r["concurrency"]), r) for r in baseline["results"]])
+    regressions = []
+    for r in results:
+        old = previous.get((r["client"], r["mix"], r["concurrency"]))
+        if old is not None and r["commands_per_s"] < old["commands_per_s"] * (1 - tolerance):
+            regressions.append("{} {} x{}: {:.1f} commands/s instead of {:.1f}".format(
+                r["client"], r["mix"], r["concurrency"], r["commands_per_s"], old["commands_per_s"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the communication with the (virtual) MBE server")
+    parser.add_argument("--clients", default=",".join(CLIENTS), help="kinds of clients to benchmark")
+    parser.add_argument("--mixes", default="recipe,status", help="command mixes to benchmark")
+    parser.add_argument("--concurrency", default="1,2,4,8", help="numbers of concurrent clients")
+    parser.add_argument("--duration", type=float, default=3.0, help="duration of each benchmark in seconds")
+    parser.add_argument("--output", default="benchmark_results.json", help="file to write the results to")
+    parser.add_argument("--baseline", help="results of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative drop of throughput")
+    args = parser.parse_args(argv)
+
+    framed = FramedMBEServer(("localhost", 0))
+    virtual = VirtualMBEServer(("localhost", 0), QuietMBERequestHandler)
+    addresses = {"virtual": start_server(virtual)}
+    addresses["connection"] = addresses["shared"] = addresses["async"] = start_server(framed)
+
+    results = []
+    print("{:<12}{:<8}{:>4}{:>12}{:>10}{:>10}{:>10}".format("client", "mix", "n", "commands/s", "p50 [ms]",
+                                                              "p99 [ms]", "max [ms]"))
+    for client in args.clients.split(","):
+        for mix in args.mixes.split(","):
+            if client == "virtual" and mix == "status":
+                continue  # The normal virtual server has no binary status
+            for n in [int(n) for n in args.concurrency.split(",")]:
+                r = run_benchmark(client, mix, n, args.duration, addresses[client])
+                results.append(r)
+                print("{:<12}{:<8}{:>4}{:>12.1f}{:>10.2f}{:>10.2f}{:>10.2f}".format(
+                    client, mix, n, r["commands_per_s"], r["p50_ms"], r["p99_ms"], r["max_ms"]))
+
+    framed.shutdown()
+    virtual.shutdown()
+
+    output = {"date": datetime.now().isoformat(), "python": sys.version.split()[0], "platform": platform.platform(),
+              "duration": args.duration, "results": results}
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+    print("Results written to {}".format(args.output))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("Regression: " + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
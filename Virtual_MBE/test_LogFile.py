@@ -0,0 +1,256 @@
+import os, shutil, tempfile
+from datetime import datetime
+from struct import pack
+from unittest import TestCase
+
+import numpy as np
+
+from MBE_Tools import LogFile, LazyRecords, ByteConfig, ByteInterpreter
+
+from Virtual_MBE.virtual_mbe_framed_host import make_header
+
+OFFSET_1904 = 2082844800  # Seconds between 1904 (time of the MBE server) and 1970 (unix time)
+START = 1500000000.0  # Unix time of the first record
+
+
+def write_header(path, header):
+    """
+    Starts a new log, with only the header
+    """
+    with open(path, "wb") as f:
+        f.write(pack("!l", len(header)) + header)
+
+
+def write_records(path, byteConfig, first, n, start=START, ga=None):
+    """
+    Appends n records to a log, one per second: Ga.PV counts the records, the As shutter is open every other second
+
+    :param first: number of the first record
+    :param start: unix time of record number 0
+    :param ga: values of Ga.PV instead of the number of the record
+    """
+    records = np.zeros(n, dtype=byteConfig.dtypefile)
+    index = np.arange(first, first + n)
+    records["Time"] = start + OFFSET_1904 + index
+    if "Ga.PV" in records.dtype.names:
+        records["Ga.PV"] = index if ga is None else ga
+    if "Shutters" in records.dtype.names:
+        records["Shutters"] = (index % 2) << 2  # As is the third shutter
+    with open(path, "ab") as f:
+        f.write(records.tostring())
+
+
+class TestLogFile(TestCase):
+    """
+    Testing class for reading binary log files, on a log written like the MBE server does
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "test.log")
+        self.header = make_header()
+        self.byteConfig = ByteConfig(self.header, string=True)
+        self.create()
+
+    def create(self):
+        """
+        Starts a new log, with only the header
+        """
+        write_header(self.path, self.header)
+        self.count = 0
+
+    def append(self, n, ga=None):
+        """
+        Appends n records to the log, see write_records
+        """
+        write_records(self.path, self.byteConfig, self.count, n, ga=ga)
+        self.count += n
+
+    def test_read(self):
+        """
+        Tests that the records are decoded the same way with and without memory-mapping
+        """
+        self.append(100)
+        log = LogFile(self.path)
+        self.assertEqual(len(log.data), 100)
+        self.assertEqual(log.data["Time"][0], START)
+        np.testing.assert_array_equal(log.data["Ga.PV"], np.arange(100))
+        np.testing.assert_array_equal(log.data["Shutters.As"], np.arange(100) % 2 == 1)
+        mapped = LogFile(self.path, memoryMap=True, decodeAll=True)
+        np.testing.assert_array_equal(mapped.data, log.data)
+        log.close()
+        mapped.close()
+
+    def test_memory_map_is_lazy(self):
+        """
+        Tests that a memory-mapped log doesn't decode anything up front, only the columns which are used
+        """
+        self.append(100)
+        log = LogFile(self.path, memoryMap=True)
+        self.assertFalse(log.decodeAll)
+        self.assertIsInstance(log.data, LazyRecords)
+        self.assertEqual(log.data._LazyRecords__columns, {})
+        np.testing.assert_array_equal(log.data["Ga.PV"], np.arange(100))
+        self.assertEqual(sorted(log.data._LazyRecords__columns), ["Ga.PV"])
+        self.assertEqual(log.get_time(0), LogFile(self.path).get_time(0))
+
+        self.append(50)  # Written while the log is open
+        self.assertEqual(log.readNew(), 50)
+        self.assertEqual(len(log.data), 150)
+        np.testing.assert_array_equal(log.data["Ga.PV"], np.arange(150))
+        np.testing.assert_array_equal(log.get_records(140, 150), LogFile(self.path).data[140:150])
+        log.close()
+
+    def test_follow(self):
+        """
+        Tests that following a log yields the records written since, in batches, and stops after the timeout
+        """
+        for memoryMap in (False, True):
+            self.create()
+            self.append(10)
+            log = LogFile(self.path, memoryMap=memoryMap)
+            batches = log.follow(interval=0.01, timeout=0.1)
+            self.append(5)
+            batch = next(batches)
+            np.testing.assert_array_equal(batch["Ga.PV"], np.arange(10, 15))
+            self.append(3)
+            with open(self.path, "ab") as f:  # Half of a record, the rest comes later
+                f.write(np.zeros(1, dtype=self.byteConfig.dtypefile).tostring()[:10])
+            np.testing.assert_array_equal(next(batches)["Ga.PV"], np.arange(15, 18))
+            self.assertRaises(StopIteration, next, batches)
+            self.assertEqual(log.count, 18)
+            log.close()
+
+    def test_follow_min_batch(self):
+        """
+        Tests that small batches are held back until there are enough records, or until the timeout
+        """
+        self.append(1)
+        log = LogFile(self.path, memoryMap=True)
+        batches = log.follow(interval=0.01, timeout=0.1, minBatch=4)
+        self.append(6)
+        self.assertEqual(len(next(batches)), 6)
+        self.append(2)
+        self.assertEqual(len(next(batches)), 2)  # Only because of the timeout
+        self.assertRaises(StopIteration, next, batches)
+        log.close()
+
+    def test_time_index(self):
+        """
+        Tests finding records by time, given as unix timestamp, local datetime or UTC datetime64
+        """
+        self.append(100)
+        for log in (LogFile(self.path), LogFile(self.path, memoryMap=True)):
+            self.assertEqual(log.time_index(START), 0)
+            self.assertEqual(log.time_index(START + 10), 10)
+            self.assertEqual(log.time_index(START + 10.5), 11)
+            self.assertEqual(log.time_index(START - 100), 0)
+            self.assertEqual(log.time_index(START + 1000), 100)
+            self.assertEqual(log.time_index(np.datetime64(int(START) + 20, "s")), 20)
+            self.assertEqual(log.time_index(datetime.fromtimestamp(START + 30)), 30)
+            log.close()
+
+    def test_get_range(self):
+        """
+        Tests that a time range gives the same records with and without decoding everything up front
+        """
+        self.append(100)
+        full = LogFile(self.path)
+        for log in (full, LogFile(self.path, memoryMap=True)):
+            records = log.get_range(START + 10, START + 20)
+            np.testing.assert_array_equal(records, full.data[10:20])
+            records = log.get_range(START + 95, columns=["Ga.PV", "Shutters.As"])
+            self.assertEqual(records.dtype.names, ("Time", "Ga.PV", "Shutters.As"))
+            np.testing.assert_array_equal(records["Ga.PV"], np.arange(95, 100))
+            np.testing.assert_array_equal(records["Shutters.As"], np.arange(95, 100) % 2 == 1)
+            self.assertEqual(len(log.get_range(end=START + 5)), 5)
+            self.assertEqual(len(log.get_range(START + 50, START + 40)), 0)
+            log.close()
+
+    def test_pyramid(self):
+        """
+        Tests that the levels of the pyramid are the min/max/mean of the samples they summarize, with the samples which
+        don't make a full bin yet at the end, and that the saved pyramid is extended with the new records
+        """
+        ga = np.random.RandomState(0).normal(700, 5, 1287).astype(np.float32)
+        self.append(1287, ga)
+        log = LogFile(self.path)
+        times, data = log.pyramid().select(max_points=100)  # Bins of 16 samples, 80 complete ones and 7 samples
+        self.assertEqual(len(times), 87)
+        np.testing.assert_array_equal(times[:80], START + np.arange(0, 1280, 16))
+        minimum, maximum, mean = data["Ga.PV"]
+        np.testing.assert_array_equal(minimum[:80], np.reshape(ga[:1280], (-1, 16)).min(axis=1))
+        np.testing.assert_array_equal(maximum[:80], np.reshape(ga[:1280], (-1, 16)).max(axis=1))
+        np.testing.assert_allclose(mean[:80], np.reshape(ga[:1280].astype(np.float64), (-1, 16)).mean(axis=1))
+        for values in data["Ga.PV"]:
+            np.testing.assert_array_equal(values[80:], ga[1280:])
+
+        times, data = log.pyramid().select(max_points=20)  # Bins of 256 samples
+        self.assertEqual(len(times), 5 + 7)
+        minimum, maximum, mean = data["Ga.PV"]
+        np.testing.assert_array_equal(minimum[:5], np.reshape(ga[:1280], (-1, 256)).min(axis=1))
+        np.testing.assert_array_equal(maximum[:5], np.reshape(ga[:1280], (-1, 256)).max(axis=1))
+        np.testing.assert_allclose(mean[:5], np.reshape(ga[:1280].astype(np.float64), (-1, 256)).mean(axis=1))
+        log.close()
+
+        more = np.random.RandomState(1).normal(650, 5, 500).astype(np.float32)
+        self.append(500, more)
+        log = LogFile(self.path)
+        self.assertTrue(os.path.exists(self.path + ".pyramid.npz"))
+        extended = log.pyramid(save=False).select(max_points=20)
+        os.remove(self.path + ".pyramid.npz")
+        rebuilt = log.pyramid(save=False).select(max_points=20)
+        np.testing.assert_array_equal(extended[0], rebuilt[0])
+        for a, b in zip(extended[1]["Ga.PV"], rebuilt[1]["Ga.PV"]):
+            np.testing.assert_allclose(a, b)
+        log.close()
+
+    def test_get_decimated(self):
+        """
+        Tests that a decimated time window is the same as decimating the records of this window, and that short windows
+        come at full resolution
+        """
+        ga = np.random.RandomState(2).normal(700, 5, 4096).astype(np.float32)
+        self.append(4096, ga)
+        for log in (LogFile(self.path), LogFile(self.path, memoryMap=True)):
+            start, end = START + 512, START + 1280  # On bin boundaries, 48 bins of 16 records
+            times, data = log.get_decimated(["Ga.PV"], start, end, maxPoints=50)
+            records = log.get_range(start, end)
+            self.assertEqual(len(records), 768)
+            np.testing.assert_array_equal(times, records["Time"][::16])
+            minimum, maximum, mean = data["Ga.PV"]
+            window = np.reshape(records["Ga.PV"], (-1, 16))
+            np.testing.assert_array_equal(minimum, window.min(axis=1))
+            np.testing.assert_array_equal(maximum, window.max(axis=1))
+            np.testing.assert_allclose(mean, window.astype(np.float64).mean(axis=1))
+
+            times, data = log.get_decimated(["Ga.PV"], start, START + 540, maxPoints=50)
+            np.testing.assert_array_equal(times, START + np.arange(512, 540))
+            for values in data["Ga.PV"]:
+                np.testing.assert_array_equal(values, ga[512:540])
+            log.close()
+
+    def test_lazy_records(self):
+        """
+        Tests that the lazy decoding gives the same columns, records and slices as decoding everything
+        """
+        self.append(20)
+        with open(self.path, "rb") as f:
+            frames = f.read()[4 + len(self.header):]
+        interpreter = ByteInterpreter(self.header)
+        decoded = interpreter.convert(frames)
+        lazy = interpreter.convert_lazy(frames)
+        self.assertEqual(len(lazy), 20)
+        for name in decoded.dtype.names:
+            np.testing.assert_array_equal(lazy[name], decoded[name])
+            self.assertEqual(lazy[name].dtype, decoded[name].dtype)
+        self.assertEqual(lazy[3], decoded[3])
+        self.assertEqual(lazy[-1], decoded[-1])
+        np.testing.assert_array_equal(lazy[5:10].to_array(), decoded[5:10])
+        np.testing.assert_array_equal(lazy[5:10]["Shutters.As"], decoded["Shutters.As"][5:10])
+        np.testing.assert_array_equal(lazy.to_array(["Time", "GateValves.Cryo1"]),
+                                      decoded[["Time", "GateValves.Cryo1"]])
+        self.assertRaises(KeyError, lazy.get_column, "Nonsense.PV")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
@@ -0,0 +1,79 @@
+import os, shutil, tempfile
+from struct import pack
+from unittest import TestCase
+
+import numpy as np
+
+from MBE_Tools import ByteConfig
+from mbe_log_query import LogQuery
+
+from Virtual_MBE.test_LogFile import write_header, write_records, START
+from Virtual_MBE.virtual_mbe_framed_host import make_header
+
+
+class TestLogQuery(TestCase):
+    """
+    Testing class for the queries over a directory of logs
+    """
+
+    def setUp(self):
+        """
+        Writes three logs of 100 records, one hour apart and not in the order of their names, and one log which doesn't
+        have the Ga cell
+        """
+        self.directory = tempfile.mkdtemp()
+        header = make_header()
+        byteConfig = ByteConfig(header, string=True)
+        for name, hour in [("a.log", 2), ("b.log", 0), ("c.log", 1)]:
+            path = os.path.join(self.directory, name)
+            write_header(path, header)
+            write_records(path, byteConfig, 0, 100, START + 3600 * hour)
+        other = "F64(Time)\r\n1xF32(Values[MBE.P])\r\n"
+        path = os.path.join(self.directory, "other.log")
+        write_header(path, other)
+        write_records(path, ByteConfig(other, string=True), 0, 100)
+
+    def test_query(self):
+        """
+        Tests that the query gives the same result in this process and in a pool of processes
+        """
+        results = []
+        for processes in (1, 2):
+            logs = LogQuery(self.directory, processes=processes)
+            result = logs.query(["Ga.PV"], START + 50, START + 3600 + 50, where={"Shutters.As": True})
+            self.assertEqual(logs.skipped, [os.path.join(self.directory, "other.log")])
+            results.append(result)
+        for result in results:
+            self.assertEqual(result.keys(), ["Time", "Ga.PV"])
+            np.testing.assert_array_equal(result["Ga.PV"], np.concatenate([np.arange(51, 100, 2),
+                                                                           np.arange(1, 50, 2)]))
+            self.assertTrue(np.all(np.diff(result["Time"]) > 0))
+        np.testing.assert_array_equal(results[0]["Time"], results[1]["Time"])
+
+    def test_whole_logs(self):
+        """
+        Tests a query without time window and condition
+        """
+        result = LogQuery(self.directory, processes=2).query(["Ga.PV"])
+        self.assertEqual(len(result["Time"]), 300)
+        self.assertEqual(result["Time"][0], START)
+        self.assertEqual(len(LogQuery(self.directory, pattern="*.none", processes=1).query(["Ga.PV"])["Time"]), 0)
+
+    def test_corrupt_logs(self):
+        """
+        Tests that logs which can't be read are skipped with the reason, and the others are still queried
+        """
+        corrupt = {"empty.log": "", "header.log": pack("!l", 9) + "nonsense!", "truncated.log": pack("!l", 5000) + "F64"}
+        for name, data in corrupt.items():
+            with open(os.path.join(self.directory, name), "wb") as f:
+                f.write(data)
+        for processes in (1, 2):
+            logs = LogQuery(self.directory, processes=processes)
+            result = logs.query(["Ga.PV"])
+            self.assertEqual(len(result["Time"]), 300)
+            self.assertEqual(sorted(logs.errors), [os.path.join(self.directory, name) for name in sorted(corrupt)])
+            self.assertEqual(sorted(logs.skipped), sorted(logs.errors.keys() + [os.path.join(self.directory, "other.log")]))
+            self.assertIn("Corrupted header", logs.errors[os.path.join(self.directory, "header.log")])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
@@ -0,0 +1,75 @@
+import threading
+from unittest import TestCase
+
+from mbe_async import AsyncServerConnection
+
+from Virtual_MBE.virtual_mbe_framed_host import FramedMBEServer
+
+
+class TestMBEAsync(TestCase):
+    """
+    Testing class for the event driven client, against the framed virtual mbe server
+    """
+
+    def setUp(self):
+        """
+        Creates a thread for the framed virtual mbe server and connects to it
+        """
+        HOST, PORT = "localhost", 9966
+        self.server = FramedMBEServer((HOST, PORT))
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+        self.conn = AsyncServerConnection(HOST, PORT, "xxa", keepalive=None)
+        self.finished = []
+
+    def callback(self, req):
+        self.finished.append((req.cmd, req.answer, req.error))
+
+    def test_callbacks(self):
+        """
+        Tests that pipelined requests are answered in order and call their callbacks
+        """
+        self.assertEqual(self.conn.call("Set Ga.PV.TSP 850"), "OK")
+        reqs = [self.conn.request(cmd, callback=self.callback) for cmd in ["Get Ga.PV.TSP", "Get Nonsense.PV"]]
+        self.conn.wait_for(reqs, timeout=5)
+        self.assertEqual(self.finished[0], ("Get Ga.PV.TSP", "850.0", None))
+        self.assertEqual(self.finished[1][0], "Get Nonsense.PV")
+        self.assertTrue(self.finished[1][2].startswith("Error"))
+        self.assertRaises(RuntimeError, reqs[1].result)
+
+    def test_close_by_client(self):
+        """
+        Tests that closing the connection calls the callbacks of the requests still waiting, with an error
+        """
+        reqs = [self.conn.request("Get Ga.PV", callback=self.callback) for i in range(3)]
+        self.conn.close()
+        self.assertEqual(len(self.finished), 3)
+        for req in reqs:
+            self.assertTrue(req.done)
+            self.assertRaises(RuntimeError, req.result)
+        self.assertRaises(RuntimeError, self.conn.request, "Get Ga.PV")
+
+    def test_close_by_server(self):
+        """
+        Tests that the callbacks of the waiting requests are called with an error when the server drops the connection,
+        even if one of them fails
+        """
+        def failing(req):
+            raise ValueError("callback failed")
+
+        reqs = [self.conn.request("Get Ga.PV", callback=failing)]
+        reqs += [self.conn.request("Get In.PV", callback=self.callback) for i in range(2)]
+        self.server.drop_clients()
+        self.conn.wait_for(reqs, timeout=5)
+        self.assertEqual([error for cmd, answer, error in self.finished], ["Connection closed by server"] * 2)
+        self.assertRaises(RuntimeError, reqs[0].result)
+        self.assertRaises(RuntimeError, self.conn.call, "Get Ga.PV")
+
+    def tearDown(self):
+        """
+        Stops the connection and the virtual mbe server
+        """
+        self.conn.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
@@ -1,9 +1,12 @@
 import threading
 from unittest import TestCase
 
+import numpy as np
+import pandas as pd
+
 from virtual_mbe_server_client import Connect
 
-from Virtual_MBE.virtual_mbe_server_host import VirtualMBE, VirtualMBEServer, MBERequestHandler
+from Virtual_MBE.virtual_mbe_server_host import VirtualMBE, VirtualMBEServer, MBERequestHandler, decimate_frame
 
 
 class TestMBEDebugServer(TestCase):
@@ -80,6 +83,15 @@ class TestMBEDebugServer(TestCase):
         result = self.client.send_command('Get time')
         self.assertEqual(int(result), 60)
 
+    def test_send_many(self):
+        """
+        Sending several commands at once should give back the replies in the same order
+        """
+        results = self.client.send_many(['Set Manip.PV.TSP 250', 'Get Manip.PV.TSP', 'Get Shutter.Ga'])
+        self.assertEqual(results[0], "OK.")
+        self.assertAlmostEqual(float(results[1]), 250)
+        self.assertEqual(results[2], 'closed')
+
     def tearDown(self):
         """
         After testing is finished, shut down the server running in the thread
@@ -156,3 +168,23 @@ class TestVirtualMBE(TestCase):
             mbe.set_param('SUKO.OP.TSP', 20)
             mbe.wait(60)
             self.assertAlmostEqual(mbe.get_param('SUKO.OP'), 12)
+
+    def test_decimate_frame(self):
+        """
+        Tests that decimating keeps single-sample spikes and short shutter openings visible
+        """
+        n = 20000
+        df = pd.DataFrame({'time_in_min': np.arange(n) / 60.0, 'ga.pv': np.full(n, 550.0),
+                           'shutter.ga': np.zeros(n)})
+        df.loc[12345, 'ga.pv'] = 900
+        df.loc[777, 'ga.pv'] = 100
+        df.loc[5000:5002, 'shutter.ga'] = 1.3
+        reduced = decimate_frame(df, 'time_in_min', 2000)
+        self.assertLessEqual(len(reduced), 2000)
+        self.assertEqual(list(reduced.columns), list(df.columns))
+        self.assertEqual(reduced['ga.pv'].max(), 900)
+        self.assertEqual(reduced['ga.pv'].min(), 100)
+        self.assertEqual(reduced['shutter.ga'].max(), 1.3)
+        self.assertTrue(np.all(np.diff(reduced['time_in_min']) >= 0))
+        spike = reduced['time_in_min'][reduced['ga.pv'] == 900].iloc[0]
+        self.assertLess(abs(spike - 12345 / 60.0), 16 * 16 / 60.0)  # In the right bin
@@ -0,0 +1,76 @@
+import threading
+from unittest import TestCase
+
+from MBE_Tools import ServerConnection, GATE_VALVE_STATES
+from mbe_stats import CommandStats
+
+from Virtual_MBE.virtual_mbe_framed_host import FramedMBEServer
+
+
+class TestMBEFramedServer(TestCase):
+    """
+    Testing class for the framed virtual mbe server, using the same client as for the real MBE server
+    """
+
+    def setUp(self):
+        """
+        Creates a thread for the framed virtual mbe server and connects to it
+        """
+        HOST, PORT = "localhost", 9965
+        self.server = FramedMBEServer((HOST, PORT))
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+        self.conn = ServerConnection(HOST, PORT, "xxa", keepalive=None)
+
+    def test_commands(self):
+        """
+        Tests the normal commands and their replies
+        """
+        self.assertEqual(self.conn.Chamber, "D1")
+        self.assertEqual(self.conn.send_command("Set Ga.PV.TSP 850"), "OK")
+        self.assertEqual(float(self.conn.send_command("Get Ga.PV.TSP")), 850)
+        self.assertEqual(self.conn.send_command("Set Ga.Mode Auto"), "OK")
+        self.assertEqual(self.conn.send_command("Open Ga"), "OK")
+        self.assertEqual(self.conn.send_command("Get Shutter.Ga"), "open")
+        self.assertEqual(self.conn.send_command("Wait 10"), "OK")
+        self.assertEqual(float(self.conn.send_command("Get time")), 10)
+        self.assertRaises(RuntimeError, self.conn.send_command, "Get Nonsense.PV")
+        self.assertEqual(self.conn.send_many(["Get Ga.PV.TSP", "Get Shutter.In"]), ["850.0", "closed"])
+
+    def test_status(self):
+        """
+        Tests that the binary status frame is decoded to the state of the virtual mbe
+        """
+        self.conn.send_command("Set In.PV 600")
+        self.conn.send_command("Open As")
+        status = self.conn.getStatus()[0]
+        self.assertEqual(status['In.PV'], 600)
+        self.assertEqual(status['Manip.PV'], 200)
+        self.assertTrue(status['Shutters.As'])
+        self.assertFalse(status['Shutters.Ga'])
+        self.assertEqual(GATE_VALVE_STATES[status['GateValves.Cryo1']], "Open")
+        lazy = self.conn.getStatus(lazy=True)
+        self.assertEqual(lazy['In.PV'][0], 600)
+        self.assertTrue(lazy['Shutters.As'][0])
+        self.assertEqual(lazy[0], status)
+
+    def test_stats(self):
+        """
+        Tests that the commands of a batch are recorded in the statistics each under its own class
+        """
+        self.conn.stats = CommandStats()
+        self.conn.send_many(["Get Ga.PV", "Get In.PV", "Set In.PV.TSP 600", "Open Ga"])
+        self.conn.send_command("Get Ga.PV")
+        commands = self.conn.stats.commands
+        self.assertEqual(sorted(commands), [("get", "PV"), ("open", "Shutter"), ("set", "PV.TSP")])
+        self.assertEqual(commands[("get", "PV")].count, 3)
+        self.assertEqual(self.conn.stats.lock_wait.count, 2)
+
+    def tearDown(self):
+        """
+        Stops the connection and the virtual mbe server
+        """
+        self.conn.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
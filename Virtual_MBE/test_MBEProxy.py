@@ -0,0 +1,144 @@
+import socket, threading
+from struct import pack
+from time import sleep
+from unittest import TestCase
+
+from MBE_Tools import ServerConnection
+from mbe_proxy import MBEProxyServer
+
+from Virtual_MBE.virtual_mbe_framed_host import FramedMBEServer
+
+
+class SlowConnection:
+    """
+    Upstream connection which holds every command until it is released, to have several requests in flight at once
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.release = threading.Event()
+        self.calls = 0
+
+    def send_command(self, cmd):
+        self.calls += 1
+        self.release.wait(5)
+        return self.conn.send_command(cmd)
+
+
+class TestMBEProxy(TestCase):
+    """
+    Testing class for the local proxy, between clients and the framed virtual mbe server
+    """
+
+    def setUp(self):
+        """
+        Starts the framed virtual mbe server and the proxy in front of it, each in its own thread
+        """
+        HOST, PORT, PROXY_PORT = "localhost", 9967, 9968
+        self.server = FramedMBEServer((HOST, PORT))
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+        self.upstream = ServerConnection(HOST, PORT, "xxa", name="proxy", keepalive=None)
+        self.proxy = MBEProxyServer((HOST, PROXY_PORT), self.upstream, ttl=60)
+        self.proxy_thread = threading.Thread(target=self.proxy.serve_forever)
+        self.proxy_thread.start()
+        self.proxy_address = (HOST, PROXY_PORT)
+        self.clients = []
+
+    def connect(self, name="test"):
+        conn = ServerConnection(self.proxy_address[0], self.proxy_address[1], "xxa", name=name, keepalive=None)
+        self.clients.append(conn)
+        return conn
+
+    def test_commands(self):
+        """
+        Tests that the commands are passed on and that changes clear the cached answers
+        """
+        conn = self.connect()
+        self.assertEqual(conn.Chamber, "D1")
+        self.assertEqual(float(conn.send_command("Get Ga.PV.TSP")), 550)
+        self.assertEqual(conn.send_command("Set Ga.PV.TSP 850"), "OK")
+        self.assertEqual(float(conn.send_command("Get Ga.PV.TSP")), 850)
+        self.assertRaises(RuntimeError, conn.send_command, "Get Nonsense.PV")
+        self.assertEqual(conn.getStatus()[0]['Ga.PV.TSP'], 850)
+
+    def test_coalescing(self):
+        """
+        Tests that identical requests in flight at the same time are sent upstream once, and answered from the cache
+        afterwards
+        """
+        cache = self.proxy.cache
+        cache.conn = SlowConnection(self.upstream)
+        answers = []
+
+        def ask():
+            answers.append(cache.get("Get In.PV"))
+
+        threads = [threading.Thread(target=ask) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        sleep(0.2)  # All of them are waiting now
+        cache.conn.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(answers, ["515"] * 5)
+        self.assertEqual(cache.conn.calls, 1)
+        self.assertEqual(cache.get("get in.pv"), "515")
+        self.assertEqual((cache.upstream_calls, cache.hits), (1, 5))  # The 4 waiting ones count as hits
+
+    def test_fan_out(self):
+        """
+        Tests that every client gets its own replies when several clients pipeline commands at the same time
+        """
+        self.upstream.send_many(["Set {}.PV.TSP {}".format(cell, 600 + i) for i, cell in enumerate(["Ga", "In", "Al"])])
+        expected = ["600.0", "601.0", "602.0"]
+        errors = []
+
+        def run(i):
+            conn = self.connect("client{}".format(i))
+            cmds = ["Get Ga.PV.TSP", "Get In.PV.TSP", "Get Al.PV.TSP"]
+            for j in range(20):
+                shift = (i + j) % 3  # Every client asks in a different order
+                answers = conn.send_many(cmds[shift:] + cmds[:shift])
+                if answers != expected[shift:] + expected[:shift]:
+                    errors.append(answers)
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_client_disconnect(self):
+        """
+        Tests that a client disconnecting in the middle of a request doesn't disturb the proxy or the other clients
+        """
+        self.proxy.cache.conn = SlowConnection(self.upstream)
+        cut = socket.create_connection(self.proxy_address)
+        cut.sendall(pack("!l", 20) + "xxaGet")  # Disconnects in the middle of a frame
+        waiting = socket.create_connection(self.proxy_address)
+        waiting.sendall(pack("!l", 12) + "xxaGet In.PV")  # Disconnects while the proxy waits for the server
+        sleep(0.1)
+        cut.close()
+        waiting.close()
+        self.proxy.cache.conn.release.set()
+        sleep(0.1)
+        conn = self.connect()
+        self.assertEqual(float(conn.send_command("Get In.PV")), 515)
+        self.assertEqual(conn.send_command("Set In.PV.TSP 700"), "OK")
+        self.assertEqual(float(conn.send_command("Get In.PV.TSP")), 700)
+
+    def tearDown(self):
+        """
+        Stops the clients, the proxy and the virtual mbe server
+        """
+        for conn in self.clients:
+            conn.close()
+        self.proxy.shutdown()
+        self.proxy.server_close()
+        self.proxy_thread.join()
+        self.upstream.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
@@ -0,0 +1,393 @@
+import json, os, shutil, tempfile, threading
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+
+from recipe_helper import MBERecipe
+from mbe_readback import ReadbackPolicy
+from mbe_settling import SettlingHistory
+from mbe_stats import CommandStats
+from mbe_timing import RecipeClock
+
+from Virtual_MBE.virtual_mbe_framed_host import FramedMBEServer
+from Virtual_MBE.test_MBETiming import FakeTime
+
+
+class LinearCalibration:
+    """
+    As calibration where the BFM pressure is proportional to the valve opening, with the interface of
+    mbe_calibration.Calibration used by MBERecipe.converge_with_bfm
+    """
+
+    def __init__(self, pressure_per_percent):
+        self.pressure_per_percent = pressure_per_percent
+        openings = [0., 25., 50., 75., 100.]
+        self.bfm_data = pd.DataFrame({"AsOpening": openings,
+                                      "BFM.P": [opening * pressure_per_percent for opening in openings]})
+
+    def get_interpolator(self):
+        return lambda p: p / self.pressure_per_percent
+
+    def calc_setpoint(self, desired_flux):
+        return desired_flux / self.pressure_per_percent
+
+
+class TestMBERecipe(TestCase):
+    """
+    Testing class for the recipe helper, against the framed virtual mbe server
+    """
+    HOST, PORT = "localhost", 9970
+
+    def setUp(self):
+        """
+        Creates a thread for the framed virtual mbe server and a directory for what the recipes learn
+        """
+        self.server = FramedMBEServer((self.HOST, self.PORT))
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+        self.directory = tempfile.mkdtemp()
+        self.recipes = []
+
+    def recipe(self, settle_times="settle_times.json", **kwargs):
+        """
+        :param settle_times: name of the file where the recipe keeps the learned settle times, in the test directory
+        :param kwargs: other arguments of MBERecipe, ex: snapshot_ttl
+        :return: a recipe connected to the framed virtual mbe server
+        """
+        mbe = MBERecipe(server_address=(self.HOST, self.PORT), **kwargs)
+        mbe.readback = ReadbackPolicy(os.path.join(self.directory, settle_times))
+        mbe.settling = SettlingHistory(filename=None)
+        self.recipes.append(mbe)
+        return mbe
+
+    def test_settle_times_saved(self):
+        """
+        Tests that the settle times are saved when the recipe ends normally and learned something
+        """
+        with self.recipe() as mbe:
+            mbe.set_param("Ga.PV.TSP", 600)
+        with open(os.path.join(self.directory, "settle_times.json")) as f:
+            self.assertIn("ga.pv.tsp", json.load(f))
+        mbe = self.recipe()
+        self.assertIn("ga.pv.tsp", mbe.readback.settle_times)
+
+    def test_settle_times_not_saved(self):
+        """
+        Tests that the settle times are not saved when nothing was learned or the recipe failed, and that a failed
+        save doesn't stop the recipe
+        """
+        with self.recipe() as mbe:
+            pass
+        with self.assertRaises(ValueError):
+            with self.recipe() as mbe:
+                mbe.set_param("Ga.PV.TSP", 600)
+                raise ValueError("recipe failed")
+        self.assertEqual(os.listdir(self.directory), [])
+
+        open(os.path.join(self.directory, "file"), "w").close()
+        with self.recipe(os.path.join("file", "settle_times.json")) as mbe:  # Can't be written
+            mbe.set_param("Ga.PV.TSP", 600)
+
+    def test_settle_times_corrupt(self):
+        """
+        Tests that a file which can't be read is ignored
+        """
+        with open(os.path.join(self.directory, "settle_times.json"), "w") as f:
+            f.write("{not json")
+        self.assertEqual(self.recipe().readback.settle_times, {})
+
+    def test_shutter(self):
+        """
+        Tests moving shutters one after the other and together
+        """
+        mbe = self.recipe()
+        mbe.shutter(["Ga", "As"], [True, True])
+        self.assertEqual(mbe.conn.send_many(["Get Shutter.Ga", "Get Shutter.As"]), ["open", "open"])
+        latencies = mbe.shutter(["Ga", "As", "In"], [False, True, True], simultaneous=True)
+        self.assertEqual(latencies.keys(), ["Ga", "As", "In"])
+        self.assertEqual(mbe.conn.send_many(["Get Shutter.Ga", "Get Shutter.In"]), ["closed", "open"])
+
+    def test_snapshot(self):
+        """
+        Tests that values read from the status frame are named and formatted like the replies to "Get", and that
+        parameters which are not in the frame are asked for with "Get"
+        """
+        mbe = self.recipe(snapshot_ttl=60)
+        mbe.conn.stats = CommandStats()
+        mbe.conn.send_many(["Open As", "Set MBE.P 2.5E-7"])
+        parameters = ["Ga.PV", "Ga.PV.TSP", "MBE.P", "BFM.LT", "Shutter.Ga", "Shutter.As", "Manip.RS.RPM", "Ga.Mode"]
+        replies = mbe.conn.send_many(["Get {}".format(parameter) for parameter in parameters])
+        values = mbe.get_params(parameters)
+        self.assertEqual(mbe.conn.stats.commands[("get", "this.StatusInBytes")].count, 1)
+        self.assertEqual(values[:4], ["550.0", "550.0", "2.5e-07", "0.0"])
+        self.assertEqual(values[4:6], ["Closed", "Open"])  # From the "Shutters" section of the frame
+        for value, reply in zip(values[:4], replies[:4]):
+            self.assertEqual(float(value), float(reply))
+        self.assertEqual([value.lower() for value in values[4:]], replies[4:])
+
+        # Not in the frame, asked for in one batch
+        self.assertIsNone(mbe.get_snapshot_value("Manip.RS.RPM"))
+        self.assertIsNone(mbe.get_snapshot_value("Ga.Mode"))
+        self.assertEqual(values[6:], replies[6:])
+        self.assertEqual(mbe.conn.stats.commands[("get", "RS.RPM")].count, 2)  # Once here, once in get_params
+        self.assertEqual(mbe.get_param("Ga.Mode"), "pid")
+
+    def test_snapshot_refresh(self):
+        """
+        Tests that the status frame is kept for its time to live, fetched again afterwards, and forgotten whenever the
+        recipe changes something
+        """
+        mbe = self.recipe(snapshot_ttl=60)
+        mbe.conn.stats = CommandStats()
+        fetches = lambda: mbe.conn.stats.commands[("get", "this.StatusInBytes")].count
+        self.assertEqual(mbe.get_param("Ga.PV.TSP"), "550.0")
+        mbe.conn.send_command("Set Ga.PV.TSP 560")  # Behind the back of the recipe
+        self.assertEqual(mbe.get_param("Ga.PV.TSP"), "550.0")
+        self.assertEqual(fetches(), 1)
+        mbe.snapshot_time -= 61  # Older than its time to live
+        self.assertEqual(mbe.get_param("Ga.PV.TSP"), "560.0")
+        self.assertEqual(fetches(), 2)
+
+        mbe.set_param("Ga.PV.TSP", 600)
+        self.assertIsNone(mbe.snapshot)
+        self.assertEqual(mbe.get_param("Ga.PV.TSP"), "600.0")
+        mbe.shutter("Ga", True)
+        self.assertIsNone(mbe.snapshot)
+        self.assertEqual(mbe.get_param("Shutter.Ga"), "Open")
+        mbe.shutter(["Ga", "In"], [False, True], simultaneous=True)
+        self.assertEqual(mbe.get_params(["Shutter.Ga", "Shutter.In"]), ["Closed", "Open"])
+        self.assertEqual(fetches(), 5)
+
+    def test_stdby_after_shutter_error(self):
+        """
+        Tests that the valves are closed and the cells ramped down even if the shutters could not be closed, and that
+        the error is raised afterwards
+        """
+        mbe = self.recipe()
+        mbe.conn.send_many(["Set AsCracker.Valve.OP 50", "Set Ga.PV 700", "Set Ga.PV.TSP 700"])
+
+        def stuck(*args, **kwargs):
+            raise Exception("Error! Could not close shutter As")
+
+        mbe.shutter = stuck
+        self.assertRaisesRegexp(Exception, "shutter As", mbe.set_stdby)
+        self.assertEqual(float(mbe.get_param("AsCracker.Valve")), 0)
+        self.assertEqual(float(mbe.get_param("Ga.PV.TSP")), 550)
+
+    def scripted(self, mbe, readings, fail_after=None):
+        """
+        Replaces the readings of the server by scripted ones, on a fake clock going forward one second per poll
+
+        :param readings: parameter: list of the successive readings, the last one repeats, or function giving the
+            reading
+        :param fail_after: number of reads after which the connection fails
+        """
+        fake = FakeTime(late=0.0)
+        mbe.clock = RecipeClock(clock=fake.clock, sleep=fake.sleep, max_sleep=None)
+        reads = []
+
+        def get_params(parameters):
+            if fail_after is not None and len(reads) >= fail_after:
+                raise RuntimeError("Connection lost")
+            reads.append(parameters)
+            values = []
+            for parameter in parameters:
+                reading = readings[parameter]
+                if callable(reading):
+                    values.append(str(reading()))
+                else:
+                    values.append(str(reading.pop(0) if len(reading) > 1 else reading[0]))
+            return values
+
+        mbe.get_params = get_params
+        return reads
+
+    def test_wait_for_all(self):
+        """
+        Tests waiting for a controller which settles and one which only passes through an intermediate temperature
+        """
+        mbe = self.recipe()
+        reads = self.scripted(mbe, {"Ga.PV": [700, 690, 660, 649.5, 650.5, 650, 650.2, 649.9], "Ga.PV.TSP": [650],
+                                    "Manip.PV": [500, 550, 600, 650, 700, 750], "Manip.PV.TSP": [800]})
+        reached = mbe.wait_for_all({"Ga": None, "Manip": 600}, n=3)
+        self.assertEqual(reached.keys(), ["Ga", "Manip"])
+        self.assertEqual(reached["Manip"], 1)  # The first reading is taken right away
+        self.assertEqual(reached["Ga"], 4)
+        self.assertEqual(reads[-1], ["Ga.PV"])  # Manip isn't read anymore once reached
+
+    def test_wait_for_all_timeout(self):
+        """
+        Tests that the wait gives up after the timeout, with None for the controllers which didn't settle, and with an
+        error per controller
+        """
+        mbe = self.recipe()
+        self.scripted(mbe, {"Ga.PV": [650, 652, 648], "Ga.PV.TSP": [650], "In.PV": [781.5], "In.PV.TSP": [780]})
+        reached = mbe.wait_for_all({"Ga": None, "In": None}, n=3, timeout=5)
+        self.assertEqual(reached, {"Ga": None, "In": None})
+        self.assertEqual(mbe.recipe_time(), 6)
+        reached = mbe.wait_for_all({"Ga": None, "In": None}, error={"Ga": 5, "In": 2}, n=3, timeout=5)
+        self.assertEqual(reached, {"Ga": 2, "In": 2})
+
+    def test_wait_for_all_error(self):
+        """
+        Tests that a connection failing during the wait stops it with the error
+        """
+        mbe = self.recipe()
+        self.scripted(mbe, {"Ga.PV": [700], "Ga.PV.TSP": [650]}, fail_after=3)
+        self.assertRaisesRegexp(RuntimeError, "Connection lost", mbe.wait_for_all, {"Ga": None}, timeout=60)
+        self.assertEqual(mbe.recipe_time(), 2)
+
+    def test_read_pressures(self):
+        """
+        Tests that a stable pressure stops after a few readings, and a noisy one after max_t or with a full window
+        """
+        mbe = self.recipe()
+        self.scripted(mbe, {"BFM.P": [1E-6, 1.001E-6, 0.999E-6], "MBE.P": [2E-8]})
+        stats = mbe.read_pressures_stats(n=20, error=0.02)
+        self.assertEqual((stats["readings"], stats["precise"]), (3, True))
+        self.assertAlmostEqual(stats["BFM.P"], 1E-6)
+        self.assertEqual(mbe.recipe_time(), 2)
+        p_bfm, p_mbe, p_bfm_std, p_mbe_std = mbe.read_pressures(n=20, error=0.02)  # The readings repeat from now on
+        self.assertEqual((p_bfm, p_mbe, p_bfm_std, p_mbe_std), (0.999E-6, 2E-8, 0.0, 0.0))
+
+        noisy = [1E-6, 1.5E-6] * 100
+        self.scripted(mbe, {"BFM.P": list(noisy), "MBE.P": [2E-8]})
+        stats = mbe.read_pressures_stats(n=5, error=0.02, max_t=10)
+        self.assertEqual((stats["readings"], stats["precise"]), (12, False))
+        self.assertAlmostEqual(stats["BFM.P"], 1.3E-6)
+
+        self.scripted(mbe, {"BFM.P": [0], "MBE.P": [0]})  # Gauge off
+        stats = mbe.read_pressures_stats(error=0.02, max_t=3)
+        self.assertEqual((stats["BFM.P"], stats["precise"]), (0, False))
+
+    def test_read_pressures_small_n(self):
+        """
+        Tests that with fewer than 3 readings per window the full window decides, and the timeout still applies
+        """
+        mbe = self.recipe()
+        self.scripted(mbe, {"BFM.P": [1E-6], "MBE.P": [2E-8]})
+        self.assertEqual(mbe.read_pressures_stats(n=1)["readings"], 1)
+        self.assertEqual(mbe.read_pressures_stats(n=2)["readings"], 2)
+        self.scripted(mbe, {"BFM.P": [1E-6, 1.5E-6] * 100, "MBE.P": [2E-8]})
+        stats = mbe.read_pressures_stats(n=2, max_t=5)
+        self.assertEqual((stats["readings"], stats["precise"]), (7, False))
+
+    def converge(self, pressure, calibration=None, **kwargs):
+        """
+        Converges with the BFM against a calibration expecting 1E-7mbar per % of the As valve
+
+        :param pressure: function giving the BFM pressure for an opening of the As valve and the seconds since it moved
+        :param calibration: calibration to use instead of the linear one
+        :return: opening returned by converge_with_bfm, openings at which the pressure was measured
+        """
+        mbe = self.recipe()
+        measured = []
+        moves = []
+        set_param = mbe.set_param
+
+        def move(parameter, value, delay=None):
+            moves.append(mbe.recipe_time())
+            set_param(parameter, value, delay)
+
+        def bfm_pressure():
+            opening = float(mbe.conn.send_command("Get AsCracker.Valve"))
+            measured.append(opening)
+            return pressure(opening, mbe.recipe_time() - moves[-1])
+
+        mbe.set_param = move
+        self.scripted(mbe, {"BFM.P": bfm_pressure, "MBE.P": [2E-8]})
+        opening = mbe.converge_with_bfm(2.5E-6, calibration or LinearCalibration(1E-7), **kwargs)
+        self.assertEqual(float(mbe.conn.send_command("Get BFM.LT")), 0)  # Withdrawn again
+        return opening, sorted(set(measured), key=measured.index)
+
+    def test_converge_with_bfm(self):
+        """
+        Tests that an outdated calibration is corrected within a few steps, and not at all if within the tolerance
+        """
+        outdated = lambda opening, since: 0.8E-7 * opening  # 20% less flux than calibrated
+        opening, measured = self.converge(outdated)
+        self.assertEqual(measured[0], 25)
+        self.assertLessEqual(len(measured), 3)
+        self.assertLess(abs(0.8E-7 * opening - 2.5E-6), 0.02 * 2.5E-6)
+
+        opening, measured = self.converge(outdated, tolerance=0.25)
+        self.assertAlmostEqual(opening, 25)
+        self.assertEqual(len(measured), 1)
+
+        calibration = LinearCalibration(1E-7)
+        calibration.bfm_data = pd.DataFrame({"AsOpening": [25.], "BFM.P": [2.5E-6]})  # A single point
+        opening, measured = self.converge(outdated, calibration)
+        self.assertLess(abs(0.8E-7 * opening - 2.5E-6), 0.02 * 2.5E-6)
+
+    def test_converge_with_bfm_drift(self):
+        """
+        Tests that the pressure is only used once it stopped drifting after the valve moved
+        """
+        slow = lambda opening, since: 0.8E-7 * opening * (1 - 0.3 * np.exp(-since / 5.))
+        opening, measured = self.converge(slow)
+        # From about the settled 2E-6 at 25%, two measurements in a row agree already at 1.96E-6 which gives 30.4%
+        self.assertAlmostEqual(measured[1], 30, delta=0.2)
+        self.assertLess(abs(0.8E-7 * opening - 2.5E-6), 0.02 * 2.5E-6)
+
+    def test_converge_with_bfm_fails(self):
+        """
+        Tests that the convergence gives up after the given number of corrections when the flux doesn't follow the
+        valve, keeping the valve within its range
+        """
+        empty = lambda opening, since: 1E-6  # Empty cell
+        opening, measured = self.converge(empty, iterations=4, tolerance=0.01)
+        np.testing.assert_allclose(measured, [25, 40, 55, 70])  # Opened by the calibration slope every time
+        self.assertAlmostEqual(opening, 85)
+        opening, measured = self.converge(empty, iterations=8, tolerance=0.01)
+        self.assertEqual((opening, max(measured)), (100, 100))
+
+    def test_timeline(self):
+        """
+        Tests that the commands of every event are sent once, close to the planned time, and confirmed afterwards
+        """
+        mbe = self.recipe()
+        mbe.conn.stats = CommandStats()
+        timeline = mbe.timeline()
+        for i in range(3):
+            timeline.shutter(0.2 + i * 0.3, ["Ga", "As"], [True, True])
+            timeline.shutter(0.35 + i * 0.3, "Ga", False)
+        timeline.set_param(0.5, "Ga.PV.TSP", 600)
+        report = timeline.run()
+
+        self.assertEqual(len(report), 7)
+        self.assertEqual(mbe.conn.stats.commands[("open", "Shutter")].count, 6)
+        self.assertEqual(mbe.conn.stats.commands[("close", "Shutter")].count, 3)
+        self.assertEqual(mbe.conn.stats.commands[("set", "PV.TSP")].count, 1)
+        for description, planned, achieved in report:
+            self.assertLess(abs(achieved - planned), 0.05)
+        self.assertEqual(timeline.lateness.count, 7)
+        self.assertEqual((timeline.checks, timeline.failures), ([], []))
+        self.assertEqual(mbe.conn.send_many(["Get Shutter.Ga", "Get Shutter.As", "Get Ga.PV.TSP"]),
+                         ["closed", "open", "600.0"])
+
+    def test_timeline_not_confirmed(self):
+        """
+        Tests that an event which doesn't show up in the readbacks is reported at the end, without being sent again
+        """
+        mbe = self.recipe()
+        mbe.conn.stats = CommandStats()
+        timeline = mbe.timeline()
+        timeline.commands = lambda kind, arguments: ["Get Ga.PV"]  # Doesn't move the shutter
+        timeline.readback_time = timeline.poll_interval = 0.01
+        timeline.shutter(0.1, "Ga", True)
+        mbe.readback.deadline = lambda parameter: 0.2
+        self.assertRaisesRegexp(Exception, "Could not confirm: open Ga", timeline.run)
+        self.assertEqual(len(timeline.failures), 1)
+        self.assertNotIn(("open", "Shutter"), mbe.conn.stats.commands)
+
+    def tearDown(self):
+        """
+        Stops the connections, the virtual mbe server and removes the test directory
+        """
+        for mbe in self.recipes:
+            mbe.conn.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+        shutil.rmtree(self.directory)
@@ -0,0 +1,163 @@
+import socket, threading
+from struct import pack
+from time import sleep, time
+from unittest import TestCase
+
+from MBE_Tools import ServerConnection, ConnectionLost
+
+from Virtual_MBE.virtual_mbe_framed_host import FramedMBEServer, FramedMBERequestHandler
+
+
+class FragmentingRequestHandler(FramedMBERequestHandler):
+    """
+    Writes every reply in pieces of 3 bytes with pauses in between, so that the length prefixes are split as well
+    """
+
+    def send(self, *answers):
+        data = "".join([pack("!l", len(answer)) + answer for answer in answers])
+        for i in range(0, len(data), 3):
+            self.request.sendall(data[i:i + 3])
+            sleep(0.001)
+
+
+class TestMBEServerConnection(TestCase):
+    """
+    Testing class for the keepalive and the reconnection of the client, against the framed virtual mbe server
+    """
+    HOST, PORT = "localhost", 9969
+
+    def setUp(self):
+        """
+        Creates a thread for the framed virtual mbe server
+        """
+        self.start_server()
+        self.conns = []
+
+    def start_server(self):
+        self.server = FramedMBEServer((self.HOST, self.PORT))
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+
+    def kill_server(self):
+        """
+        Stops the server and drops the connections of its clients
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+
+    def connect(self, **kwargs):
+        conn = ServerConnection(self.HOST, self.PORT, "xxa", **kwargs)
+        self.conns.append(conn)
+        return conn
+
+    def test_reconnect(self):
+        """
+        Tests that commands go through again once the server is back, on a new connection
+        """
+        conn = self.connect(keepalive=None)
+        self.assertEqual(conn.send_command("Set Ga.PV.TSP 850"), "OK")
+        self.kill_server()
+        self.start_server()
+        self.assertEqual(float(conn.send_command("Get Ga.PV.TSP")), 550)  # The server was restarted
+        self.assertEqual(conn.reconnects, 1)
+        self.assertEqual(conn.Chamber, "D1")
+
+    def test_not_repeated(self):
+        """
+        Tests that a command which is not safe to repeat is not sent again after reconnecting
+        """
+        conn = self.connect(keepalive=None)
+        self.kill_server()
+        self.start_server()
+        self.assertRaises(ConnectionLost, conn.send_command, "Set This.RecipesRunning inc")
+        self.assertEqual(conn.reconnects, 1)
+        self.assertEqual(float(conn.send_command("Get This.RecipesRunning")), 0)
+
+    def test_connection_lost(self):
+        """
+        Tests that ConnectionLost is raised once all the reconnection attempts failed
+        """
+        conn = self.connect(keepalive=None, reconnectTries=2)
+        self.kill_server()
+        self.assertRaises(ConnectionLost, conn.send_command, "Get Ga.PV")
+        self.assertEqual(conn.reconnects, 0)
+        self.start_server()  # Back again, the next command reconnects
+        self.assertEqual(float(conn.send_command("Get Ga.PV")), 550)
+
+    def test_reconnect_timeout(self):
+        """
+        Tests that a server which accepts connections but never answers is given up quickly, without holding the
+        connection for the whole timeout of the commands, and that the timeout of the commands is back afterwards
+        """
+        conn = self.connect(keepalive=None, reconnectTries=2, reconnectTimeout=0.2)
+        self.kill_server()
+        mute = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # Listens, but nobody ever answers
+        mute.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        mute.bind((self.HOST, self.PORT))
+        mute.listen(5)
+        start = time()
+        try:
+            self.assertRaises(ConnectionLost, conn.send_command, "Get Ga.PV")
+        finally:
+            mute.close()
+        self.assertLess(time() - start, 3)  # 2 attempts of 0.2s and 1s between them, instead of 2 x 60s
+        self.start_server()
+        self.assertEqual(float(conn.send_command("Get Ga.PV")), 550)
+        self.assertEqual(conn._ServerConnection__socket.gettimeout(), conn.timeout)
+
+    def test_config_cache(self):
+        """
+        Tests that the config header is parsed only once, for all the connections and reconnections
+        """
+        first = self.connect(keepalive=None)
+        second = self.connect(keepalive=None)
+        self.assertIs(first.ByteInterpreter, second.ByteInterpreter)
+        interpreter = first.ByteInterpreter
+        self.kill_server()
+        self.start_server()
+        first.send_command("Get Ga.PV")
+        self.assertEqual(first.reconnects, 1)
+        self.assertIs(first.ByteInterpreter, interpreter)
+        self.assertIn(interpreter, ServerConnection.configCache.values())
+
+    def test_fragmented_replies(self):
+        """
+        Tests that replies arriving in small pieces are put back together, and that the following replies stay in sync
+        """
+        self.server.RequestHandlerClass = FragmentingRequestHandler
+        conn = self.connect(keepalive=None)
+        self.assertEqual(conn.send_command("Set Ga.PV.TSP 600"), "OK")
+        self.assertEqual(float(conn.send_command("Get Ga.PV.TSP")), 600)
+        self.assertEqual(conn.send_many(["Get Shutter.Ga", "Open Ga", "Get Shutter.Ga", "Get this.chamber"]),
+                         ["closed", "OK", "open", "D1"])
+        status = conn.getStatus()
+        self.assertEqual(len(status), 1)
+        self.assertEqual(status["Ga.PV.TSP"][0], 600)
+        self.assertTrue(status["Shutters.Ga"][0])
+        self.assertEqual(float(conn.send_command("Get In.PV")), 515)
+        self.assertEqual(conn.reconnects, 0)
+
+    def test_keepalive(self):
+        """
+        Tests that the keepalive runs when the connection is idle, reconnects after a restart of the server and stops
+        when the connection is closed
+        """
+        conn = self.connect(keepalive=0.2)
+        sleep(0.5)
+        self.assertIsNotNone(conn.latency)
+        self.kill_server()
+        self.start_server()
+        sleep(0.5)
+        self.assertEqual(conn.reconnects, 1)
+        thread = conn._ServerConnection__keepAlive
+        conn.close()
+        self.assertFalse(thread.is_alive())
+
+    def tearDown(self):
+        """
+        Stops the connections and the virtual mbe server
+        """
+        for conn in self.conns:
+            conn.close()
+        self.kill_server()
@@ -0,0 +1,105 @@
+import os, shutil, tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from mbe_settling import RollingWindow, SettlingDetector, SettlingHistory
+
+
+class TestMBESettling(TestCase):
+    """
+    Testing class for deciding when a temperature has settled
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def follow(self, detector, values):
+        """
+        Feeds one reading per second to a detector
+
+        :return: time of the reading at which it settled, None if it didn't
+        """
+        for t, value in enumerate(values):
+            if detector.add(float(t), value):
+                return t
+        return None
+
+    def test_rolling_window(self):
+        """
+        Tests that the mean and standard deviation updated per sample are those of the last n samples
+        """
+        values = np.random.RandomState(0).normal(700, 5, 200)
+        window = RollingWindow(10)
+        for i, value in enumerate(values):
+            window.add(value)
+            last = values[max(i - 9, 0):i + 1]
+            self.assertEqual(window.full, i >= 9)
+            np.testing.assert_array_equal(window.values, last)
+            self.assertAlmostEqual(window.mean, last.mean())
+            self.assertAlmostEqual(window.std, last.std())
+        window = RollingWindow(3)
+        self.assertEqual((window.mean, window.std, len(window.values)), (0.0, 0.0, 0))
+
+    def test_overshoot(self):
+        """
+        Tests that an approach overshooting the target is only settled once the oscillation stays within the error
+        """
+        t = np.arange(200)
+        values = 700 - 50 * np.exp(-t / 20.) * np.cos(t / 5.)
+        detector = SettlingDetector(700, 1)
+        settled = self.follow(detector, values)
+        self.assertIsNotNone(settled)
+        self.assertTrue(np.all(np.abs(values[settled - 2:settled + 1] - 700) < 1))
+        self.assertGreater(np.abs(values[:settled] - 700).max(), 1)
+        self.assertGreater(detector.overshoot, 1)
+        self.assertTrue(np.all(np.abs(values[settled:] - 700) < 1))  # Didn't return before the last excursion
+
+    def test_ramp(self):
+        """
+        Tests that a ramp going through the error band is not settled, and settles shortly after it stops at the target
+        """
+        for step in (0.2, 0.5):  # Fewer readings in the band than the window, the drift decides
+            through = np.arange(690, 710, step)
+            self.assertIsNone(self.follow(SettlingDetector(700, 1), through))
+            self.assertIsNone(self.follow(SettlingDetector(700, 1, min_samples=2), through))
+
+        stopping = np.concatenate([np.linspace(690, 700, 51), np.full(20, 700.)])
+        detector = SettlingDetector(700, 1, rate=0.2)
+        self.assertFalse(detector.add(0., 690))  # Not settled, with an estimate along the ramp
+        self.assertAlmostEqual(detector.eta(), 50)
+        settled = self.follow(SettlingDetector(700, 1, rate=0.2), stopping)
+        self.assertGreater(settled, 50)
+        self.assertLess(settled, 60)
+
+    def test_history(self):
+        """
+        Tests that what was learned is saved, in a directory created if needed, and read back in the next run
+        """
+        filename = os.path.join(self.directory, "state", "settling.json")
+        history = SettlingHistory(filename)
+        self.assertEqual(history.expected_time("Ga", 100), 100 + history.default_tail)
+        history.save()  # Nothing learned, nothing written
+        self.assertFalse(os.path.exists(filename))
+
+        detector = SettlingDetector(700, 1)
+        self.assertIsNotNone(self.follow(detector, [600, 650, 690, 699.5] + [700, 700.2, 699.9] * 4))
+        history.learn("Ga", 2, detector)
+        history.save()
+        loaded = SettlingHistory(filename)
+        self.assertEqual(loaded.controllers, history.controllers)
+        self.assertAlmostEqual(loaded.expected_time("Ga", 2), detector.times[-1])  # Same ramp, same time
+        self.assertFalse(loaded.changed)
+
+    def test_history_corrupt(self):
+        """
+        Tests that a history which can't be read is ignored
+        """
+        filename = os.path.join(self.directory, "settling.json")
+        with open(filename, "w") as f:
+            f.write("{not json")
+        self.assertEqual(SettlingHistory(filename).controllers, {})
+        self.assertEqual(SettlingHistory(None).controllers, {})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
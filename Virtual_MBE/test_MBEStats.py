@@ -0,0 +1,75 @@
+from unittest import TestCase
+
+import numpy as np
+
+from mbe_stats import classify, LatencyHistogram, CommandStats
+
+
+class TestMBEStats(TestCase):
+    """
+    Testing class for the command statistics
+    """
+
+    def test_classify(self):
+        """
+        Tests that commands are grouped by verb and parameter class
+        """
+        self.assertEqual(classify("Set Ga.PV.TSP 850"), ("set", "PV.TSP"))
+        self.assertEqual(classify("Get Shutter.In"), ("get", "Shutter"))
+        self.assertEqual(classify("Open Ga"), ("open", "Shutter"))
+        self.assertEqual(classify("get this.StatusInBytes"), ("get", "this.StatusInBytes"))
+        self.assertEqual(classify("Wait 10"), ("wait", ""))
+
+    def test_percentiles(self):
+        """
+        Tests that the percentiles are within the precision of the histogram, for values spanning several decades
+        """
+        values = np.random.RandomState(0).lognormal(np.log(2E-3), 1.0, 10000)
+        hist = LatencyHistogram()
+        for value in values:
+            hist.record(value)
+        self.assertEqual(hist.count, len(values))
+        self.assertAlmostEqual(hist.mean(), values.mean())
+        self.assertEqual((hist.min, hist.max), (values.min(), values.max()))
+        for p in [1, 50, 90, 99, 99.9]:
+            exact = np.percentile(values, p)
+            self.assertLess(abs(hist.percentile(p) - exact), 0.04 * exact)
+        self.assertEqual(hist.percentile(100), values.max())
+        self.assertEqual(hist.percentile(0), values.min())
+
+    def test_empty(self):
+        hist = LatencyHistogram()
+        self.assertEqual((hist.mean(), hist.percentile(50), hist.max), (0.0, 0.0, None))
+
+    def test_merge(self):
+        """
+        Tests that merging histograms gives the same result as recording all the values in one
+        """
+        values = np.random.RandomState(1).exponential(0.01, 2000)
+        first, second, whole = LatencyHistogram(), LatencyHistogram(), LatencyHistogram()
+        for i, value in enumerate(values):
+            (first if i % 3 else second).record(value)
+            whole.record(value)
+        first.merge(second)
+        first.merge(LatencyHistogram())
+        self.assertEqual(first.counts, whole.counts)
+        self.assertEqual((first.count, first.min, first.max), (whole.count, whole.min, whole.max))
+        self.assertAlmostEqual(first.total, whole.total)
+        for p in [50, 99]:
+            self.assertEqual(first.percentile(p), whole.percentile(p))
+
+    def test_command_stats(self):
+        """
+        Tests that the commands, retries and shutter moves end up in the summary
+        """
+        stats = CommandStats()
+        stats.record_command("Get Ga.PV", 0.002, 0.001)
+        stats.record_command("Get In.PV", 0.004)
+        stats.record_retries("Ga.PV.TSP", 2)
+        stats.record_shutter("Ga", 0.3)
+        self.assertEqual(stats.commands[("get", "PV")].count, 2)
+        self.assertEqual(stats.retries["PV.TSP"], [1, 2])
+        self.assertAlmostEqual(stats.time_spent["commands"], 0.006)
+        summary = stats.summary()
+        self.assertIn("set_param PV.TSP: 1 calls, 2 retries", summary)
+        self.assertIn("Shutter Ga confirmed after", summary)
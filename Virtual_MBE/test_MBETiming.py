@@ -0,0 +1,95 @@
+import threading
+from unittest import TestCase
+
+from MBE_Tools import ServerConnection
+from mbe_timing import RecipeClock, monotonic
+
+from Virtual_MBE.virtual_mbe_framed_host import FramedMBEServer
+
+
+class FakeTime:
+    """
+    Clock which only goes forward when sleeping, each sleep finishing a bit late
+    """
+
+    def __init__(self, late=0.01):
+        self.t = 1000.0
+        self.late = late
+        self.sleeps = []
+
+    def clock(self):
+        return self.t
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.t += seconds + self.late
+
+
+class TestRecipeClock(TestCase):
+    """
+    Testing class for the recipe clock
+    """
+
+    def setUp(self):
+        self.time = FakeTime()
+        self.clock = RecipeClock(clock=self.time.clock, sleep=self.time.sleep, max_sleep=1.0)
+
+    def test_wait_until(self):
+        """
+        Tests that waits against deadlines don't accumulate the lateness of every sleep
+        """
+        for i in range(1, 11):
+            overshoot = self.clock.wait_until(i * 0.5)
+            self.assertAlmostEqual(overshoot, 0.01)
+        self.assertAlmostEqual(self.clock.now(), 5.01)
+        self.assertEqual(self.clock.overshoots.count, 10)
+        self.assertAlmostEqual(self.clock.overshoots.max, 0.01)
+
+    def test_long_wait(self):
+        """
+        Tests that long waits are cut into sleeps of at most max_sleep
+        """
+        self.assertAlmostEqual(self.clock.wait(3.5), 0.01)
+        self.assertEqual(len(self.time.sleeps), 4)
+        self.assertTrue(all([seconds <= 1.0 for seconds in self.time.sleeps]))
+        self.assertAlmostEqual(self.clock.now(), 3.51)
+
+    def test_past_deadline(self):
+        """
+        Tests that a deadline which is already over returns immediately with the delay, and restarting the clock
+        """
+        self.time.t += 2
+        self.assertAlmostEqual(self.clock.wait_until(1.5), 0.5)
+        self.assertEqual(self.time.sleeps, [])
+        self.clock.restart()
+        self.assertEqual(self.clock.now(), 0)
+
+    def test_monotonic(self):
+        """
+        Tests that the monotonic clock goes forward, with a resolution far below a millisecond
+        """
+        times = [monotonic() for i in range(1000)]
+        self.assertTrue(all([b >= a for a, b in zip(times, times[1:])]))
+        self.assertGreater(times[-1], times[0])
+        self.assertLess(times[-1] - times[0], 0.1)
+
+    def test_virtual(self):
+        """
+        Tests the clock following the time of the virtual mbe, which goes forward in whole seconds
+        """
+        server = FramedMBEServer(("localhost", 9971))
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.start()
+        conn = ServerConnection("localhost", 9971, "xxa", keepalive=None)
+        try:
+            clock = RecipeClock.virtual(conn)
+            self.assertEqual(clock.now(), 0)
+            self.assertEqual(clock.wait(2.5), 0.5)
+            self.assertEqual(float(conn.send_command("Get time")), 3)
+            self.assertEqual(clock.wait_until(10), 0)
+            self.assertEqual(clock.now(), 10)
+        finally:
+            conn.close()
+            server.shutdown()
+            server.server_close()
+            server_thread.join()
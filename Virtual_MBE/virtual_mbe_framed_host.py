@@ -0,0 +1,194 @@
+"""
+Virtual MBE server which speaks the same protocol as the real MBE server: length-prefixed frames, password, the
+this.config header and binary StatusInBytes frames. Unlike virtual_mbe_server_host.py, the normal
+MBE_Tools.ServerConnection, ByteInterpreter and MBERecipe (with virtual_server=False) can be used against it, so the
+whole communication path can be tested and load-tested on a laptop without the lab network.
+
+Run it and point the recipe to it: MBERecipe(server_address=("localhost", 55001))
+"""
+
+import SocketServer, socket, threading
+from calendar import timegm
+from time import time, sleep
+
+import numpy as np
+
+from MBE_Tools import ByteConfig
+from mbe_framing import FramingMixIn
+from Virtual_MBE.virtual_mbe_server_host import VirtualMBEServer, MBERequestHandler
+
+# Names used by the real server, the virtual MBE stores everything in lower case
+CONTROLLERS = ['Manip', 'Ga', 'In', 'As', 'Al', 'Sb', 'SUSI', 'SUKO', 'AsCracker', 'SbCracker', 'SbCond']
+CONTROLLER_PARAMETERS = ['PV', 'PV.TSP', 'PV.Rate', 'OP', 'OP.TSP', 'OP.Rate']
+SHUTTERS = ['In', 'Ga', 'As', 'Al', 'Sb', 'SUSI', 'SUKO', 'Pyrometer', 'Viewport']
+VALUES = ['MBE.P', 'BFM.P', 'BFM.LT', 'Manip.RS', 'Pyrometer.T', 'AsCracker.Valve', 'SbCracker.Valve']
+GATE_VALVES = ['Cryo1', 'Cryo2']
+
+
+def make_header():
+    """
+    Creates the this.config header describing the status frame, in the format read by MBE_Tools.ByteConfig
+
+    :return: the header
+    :rtype: str
+    """
+    lines = ["F64(Time)",
+             "{}x{}xF32(Controllers[{}]{{{}}})".format(len(CONTROLLERS), len(CONTROLLER_PARAMETERS),
+                                                       ":".join(CONTROLLERS), ":".join(CONTROLLER_PARAMETERS)),
+             "{}xF32(Values[{}])".format(len(VALUES), ":".join(VALUES)),
+             "B32(Shutters[{}])".format(":".join(SHUTTERS)),
+             "B32(GateValves[{}])".format(":".join(GATE_VALVES))]
+    return "\r\n".join(lines) + "\r\n"
+
+
+class FramedMBEServer(SocketServer.ThreadingMixIn, VirtualMBEServer):
+    """
+    Virtual MBE server using the protocol of the real MBE server. Every client keeps its connection open, so each one
+    is handled in its own thread.
+    """
+    daemon_threads = True
+
+    def __init__(self, server_address, password="xxa", chamber="D1", realtime=False):
+        """
+        :param server_address: (host, port) to listen on
+        :type server_address: tuple
+        :param password: password the clients have to use
+        :type password: str
+        :param chamber: answer to "get this.chamber"
+        :type chamber: str
+        :param realtime: if True the virtual MBE evolves by itself once per second, like the real one. Otherwise it
+            only evolves with "Wait" commands, like the normal virtual server.
+        :type realtime: bool
+        """
+        VirtualMBEServer.__init__(self, server_address, FramedMBERequestHandler)
+        self.password = password
+        self.chamber = chamber
+        self.lock = threading.RLock()  # The virtual MBE is shared by all the client threads
+        self.clients = set()  # Sockets of the connected clients
+        self.header = make_header()
+        self.byteConfig = ByteConfig(self.header, string=True)
+        self.start_time = time() - timegm((1904, 1, 1, 0, 0, 0))  # The server counts seconds since 1904
+        if realtime:
+            clock = threading.Thread(target=self.run_clock)
+            clock.daemon = True
+            clock.start()
+
+    def run_clock(self):
+        while True:
+            sleep(1.0)
+            with self.lock:
+                self.mbe.wait(1)
+
+    def drop_clients(self):
+        """
+        Closes the connections of all the clients, like the real server does when it is restarted
+        """
+        with self.lock:
+            for client in list(self.clients):
+                try:
+                    client.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass  # Already disconnected
+
+    def server_close(self):
+        VirtualMBEServer.server_close(self)
+        self.drop_clients()
+
+    def status_bytes(self):
+        """
+        Packs the current state of the virtual MBE into a big-endian status frame described by the header
+
+        :return: the status frame
+        :rtype: str
+        """
+        with self.lock:
+            variables = self.mbe.variables
+            record = np.zeros(1, dtype=self.byteConfig.dtypefile)
+            record['Time'] = self.start_time + variables['time']
+            for controller in CONTROLLERS:
+                for parameter in CONTROLLER_PARAMETERS:
+                    key = "{}.{}".format(controller, parameter).lower()
+                    record["{}.{}".format(controller, parameter)] = variables.get(key, 0)
+            for name in VALUES:
+                value = self.mbe.get_param(name)
+                record[name] = value if not isinstance(value, bool) else 0
+            shutters = 0
+            for i, name in enumerate(SHUTTERS):
+                if variables['shutter.' + name.lower()] == 'open':
+                    shutters |= 1 << i
+            record['Shutters'] = shutters
+            gate_valves = 0
+            for i in range(len(GATE_VALVES)):
+                gate_valves |= 2 << (2 * i)  # Two bits per gate valve, 2 = open
+            record['GateValves'] = gate_valves
+        return record.tostring()
+
+    def is_known(self, parameter):
+        """
+        :return: whether the virtual MBE knows this parameter
+        :rtype: bool
+        """
+        parameter = parameter.lower()
+        return parameter in self.mbe.variables or parameter in ('manip.rs', 'ascracker.valve', 'sbcracker.valve')
+
+
+class FramedMBERequestHandler(FramingMixIn, MBERequestHandler):
+    """
+    Handles one client for as long as it stays connected, using the framing of the real MBE server. The commands
+    themselves are processed the same way as in the normal virtual server.
+    """
+
+    def setup(self):
+        FramingMixIn.setup(self)
+        with self.server.lock:
+            self.server.clients.add(self.request)
+
+    def finish(self):
+        with self.server.lock:
+            self.server.clients.discard(self.request)
+
+    def handle(self):
+        while True:
+            message = self.receive()
+            if message is None:
+                return  # Client disconnected
+            if not message.startswith(self.server.password):
+                self.send("PWD")
+                continue
+            cmd = message[len(self.server.password):]
+            if cmd.startswith("Client:"):  # Login, not answered
+                continue
+
+            words = cmd.lower().split(" ")
+            if cmd.lower() == "ok":
+                self.send("OK")
+            elif cmd.lower() == "get this.config":
+                self.send("WAIT", self.server.header)
+            elif cmd.lower() == "get this.chamber":
+                self.send("WAIT", self.server.chamber)
+            elif cmd.lower() == "get this.statusinbytes":
+                self.send("WAIT", self.server.status_bytes())
+            elif words[0] == "get" and len(words) == 2 and not self.server.is_known(words[1]):
+                self.send("Error: unknown parameter {}".format(words[1]))
+            elif words[0] == "set" and len(words) == 2 and words[1].startswith("this.processinterlock"):
+                self.send("OK")
+            else:
+                if words[0] == "set" and len(words) == 3 and words[1].endswith(".mode") and words[2] == "auto":
+                    cmd = " ".join(words[:2] + ["pid"])  # The real server calls the pid mode "Auto"
+                with self.server.lock:
+                    reply = self.process_command(cmd)
+                if reply == "OK.":
+                    self.send("OK")
+                elif reply == "Error!":
+                    self.send("Error: could not process '{}'".format(cmd))
+                else:
+                    self.send("WAIT", str(reply))
+
+
+# For running the framed virtual MBE server
+if __name__ == "__main__":
+    HOST, PORT = "localhost", 55001
+    server = FramedMBEServer((HOST, PORT), realtime=True)
+
+    print("Starting framed virtual MBE server on {}:{}.".format(HOST, PORT))
+    server.serve_forever()
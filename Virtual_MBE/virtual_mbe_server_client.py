@@ -1,5 +1,5 @@
 import socket
-from time import sleep
+from time import sleep, time
 
 
 class Connect(object):
@@ -20,6 +20,7 @@ class Connect(object):
         """
         self.HOST, self.PORT = HOST, PORT
         self.verbose = verbose
+        self.stats = None  # Set to a mbe_stats.CommandStats to record the timing of every command
 
     def connect(self):
         """
@@ -44,6 +45,7 @@ class Connect(object):
         :return: response from the server
         :rtype: str
         """
+        start = time()
         sock = self.connect()  # Create the socket connection
         if self.verbose:
             print('sending: ' + command)
@@ -53,8 +55,22 @@ class Connect(object):
         if self.verbose:
             print('received: ' + data)
         sock.close()  # Close socket after getting the response
+        if self.stats is not None:
+            self.stats.record_command(command, time() - start)
         return data
 
+    def send_many(self, commands):
+        """
+        Sends several commands to the server. The virtual server opens a new socket per command, so this simply sends
+        them one after the other. Provided so that it can be used interchangeably with MBE_Tools.ServerConnection
+
+        :param commands: commands to be sent to the server
+        :type commands: list of str
+        :return: responses from the server, in the same order as the commands
+        :rtype: list of str
+        """
+        return [self.send_command(command) for command in commands]
+
     def close(self):
         """
         No need to do anything when closing the connection since the socket is closed after each sent command
@@ -0,0 +1,327 @@
+"""
+Event driven client for the MBE server. Speaks the same length-prefixed, password-prefixed protocol as
+MBE_Tools.ServerConnection, but without any threads: all commands go through one socket and are pipelined, meaning
+that they are sent right away and the replies are matched to them in the order they come back. Because of this, many
+tasks (the recipe, a telemetry sampler, a valve watchdog, a live plot...) can share one connection and keep running
+while the recipe is waiting.
+
+asyncio does not exist in Python 2, so this is built on asyncore from the standard library. Example:
+
+    conn = AsyncServerConnection("10.18.7.24", "55001", "xxa")
+    conn.every(1.0, lambda: conn.request("Get AsCracker.PV", callback=check_cracker))
+    conn.call("Set Ga.PV.TSP 850")
+    conn.sleep(60)  # Keeps the sampler above running while waiting
+    print conn.call_many(["Get Ga.PV", "Get In.PV"])
+    conn.close()
+"""
+
+import asyncore, socket, sys
+from collections import deque
+from struct import pack, unpack
+from time import time, sleep
+
+from MBE_Tools import ByteInterpreter
+
+
+class Request:
+    """
+    A command that was sent to the MBE server and its (future) answer
+    """
+
+    def __init__(self, cmd, callback=None):
+        """
+        :param cmd: command sent to the server (without password)
+        :type cmd: str
+        :param callback: called with the request once the answer has arrived
+        :type callback: function
+        """
+        self.cmd = cmd
+        self.callback = callback
+        self.answer = None
+        self.error = None
+        self.done = False
+        self.waiting = False  # Server replied WAIT, the real answer is in the next frame
+
+    def finish(self, answer=None, error=None):
+        self.answer = answer
+        self.error = error
+        self.done = True
+        if self.callback is not None:
+            self.callback(self)
+
+    def result(self):
+        """
+        :return: the answer of the server
+        :rtype: str
+        """
+        if not self.done:
+            raise RuntimeError("No answer yet for '{}'".format(self.cmd))
+        if self.error is not None:
+            raise RuntimeError(self.error)
+        return self.answer
+
+
+class AsyncServerConnection(asyncore.dispatcher):
+    """
+    Single-socket, pipelined connection to the MBE server. All the work happens in poll(), which the blocking helpers
+    (call, call_many, sleep) run for you until they are done.
+    """
+
+    def __init__(self, tcp, port, password, name="async", keepalive=15.0, timeout=30.0):
+        """
+        Connects to the server, logs in and reads the status frame configuration
+
+        :param tcp: ip address of the MBE server
+        :type tcp: str
+        :param port: port of the MBE server
+        :type port: int, str
+        :param password: password which gets prepended to every command
+        :type password: str
+        :param name: name of this client, shown on the server
+        :type name: str
+        :param keepalive: send a keepalive after this many seconds without any traffic
+        :type keepalive: float
+        :param timeout: default time in seconds that call() waits for an answer
+        :type timeout: float
+        """
+        self.__map = {}  # Own socket map, so that this doesn't interfere with other asyncore users
+        asyncore.dispatcher.__init__(self, map=self.__map)
+        self.tcp = tcp
+        self.port = int(port)
+        self.password = password
+        self.name = name
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.ByteInterpreter = None
+        self.Chamber = None
+
+        self.__out = deque()
+        self.__in = bytearray()
+        self.__pending = deque()
+        self.__timers = []
+        self.__last_traffic = time()
+        self.__error = None
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((self.tcp, self.port))
+        self.__write(self.password + "Client:" + self.name)  # The server doesn't answer the login
+        self.ByteInterpreter = ByteInterpreter(self.call("get this.config"))
+        self.Chamber = self.call("get this.chamber")
+
+        if self.keepalive:
+            self.every(1.0, self.__keep_alive)
+
+    # Requests
+
+    def request(self, cmd, callback=None):
+        """
+        Sends a command without waiting for the answer
+
+        :param cmd: command to send (ex: "Get Ga.PV")
+        :type cmd: str
+        :param callback: called with the Request once the answer has arrived
+        :type callback: function
+        :return: handle to get the answer from once it is done
+        :rtype: Request
+        """
+        if self.__error is not None:
+            raise RuntimeError(self.__error)
+        req = Request(cmd, callback)
+        self.__pending.append(req)
+        self.__write(self.password + cmd)
+        return req
+
+    def call(self, cmd, timeout=None):
+        """
+        Sends a command and runs the event loop until its answer is there. Other tasks keep being served meanwhile.
+
+        :param cmd: command to send (ex: "Get Ga.PV")
+        :type cmd: str
+        :param timeout: maximum time to wait for the answer in seconds, defaults to self.timeout
+        :type timeout: float
+        :return: answer of the server
+        :rtype: str
+        """
+        req = self.request(cmd)
+        self.wait_for([req], timeout)
+        return req.result()
+
+    def call_many(self, cmds, timeout=None):
+        """
+        Sends several commands back-to-back and waits for all of their answers
+
+        :param cmds: commands to send
+        :type cmds: list of str
+        :return: answers of the server, in the same order as the commands
+        :rtype: list of str
+        """
+        reqs = [self.request(cmd) for cmd in cmds]
+        self.wait_for(reqs, timeout)
+        return [req.result() for req in reqs]
+
+    def getStatus(self, callback=None):
+        """
+        Fetches the whole machine state in one frame
+
+        :param callback: if given, doesn't wait and calls it with the decoded status once it has arrived
+        :type callback: function
+        :return: the decoded status (only if no callback was given)
+        :rtype: numpy.ndarray
+        """
+        if callback is not None:
+            return self.request("get this.StatusInBytes",
+                                lambda req: callback(self.ByteInterpreter.convert(req.result())))
+        return self.ByteInterpreter.convert(self.call("get this.StatusInBytes"))
+
+    # Scheduling
+
+    def every(self, interval, func):
+        """
+        Calls func every interval seconds from within the event loop
+
+        :return: the timer, can be passed to cancel()
+        """
+        timer = [time() + interval, interval, func]
+        self.__timers.append(timer)
+        return timer
+
+    def after(self, delay, func):
+        """
+        Calls func once after delay seconds from within the event loop
+
+        :return: the timer, can be passed to cancel()
+        """
+        timer = [time() + delay, None, func]
+        self.__timers.append(timer)
+        return timer
+
+    def cancel(self, timer):
+        if timer in self.__timers:
+            self.__timers.remove(timer)
+
+    def sleep(self, seconds):
+        """
+        Waits a certain amount of time while still serving all requests and timers
+        """
+        end = time() + seconds
+        while time() < end:
+            self.poll(end - time())
+
+    def wait_for(self, reqs, timeout=None):
+        """
+        Runs the event loop until all the given requests have been answered
+        """
+        if timeout is None:
+            timeout = self.timeout
+        end = time() + timeout
+        while not all([req.done for req in reqs]):
+            if self.__error is not None:
+                raise RuntimeError(self.__error)
+            if time() > end:
+                raise RuntimeError("Timeout while waiting for an answer of the MBE server")
+            self.poll(end - time())
+
+    def poll(self, timeout=0.0):
+        """
+        Runs one iteration of the event loop: handles socket traffic for at most timeout seconds, then runs the
+        timers which are due
+        """
+        now = time()
+        if self.__timers:
+            timeout = min(timeout, max(0.0, min([timer[0] for timer in self.__timers]) - now))
+        if self.__map:
+            asyncore.loop(timeout=max(timeout, 0.0), map=self.__map, count=1)
+        else:  # Connection is closed, only the timers are left
+            sleep(max(timeout, 0.0))
+
+        now = time()
+        for timer in [timer for timer in self.__timers if timer[0] <= now]:
+            if timer[1] is None:
+                self.__timers.remove(timer)
+            else:
+                timer[0] = now + timer[1]
+            timer[2]()
+
+    def close(self):
+        """
+        Closes the connection, the requests which are still waiting for an answer finish with an error
+        """
+        self.__timers = []
+        asyncore.dispatcher.close(self)
+        self.__fail("Connection closed")
+
+    def __keep_alive(self):
+        if not self.__pending and time() - self.__last_traffic > self.keepalive:
+            self.request("OK")
+
+    # Socket handling
+
+    def __write(self, byte):
+        self.__out.append(pack("!l", len(byte)) + byte)
+        self.__last_traffic = time()
+
+    def writable(self):
+        return bool(self.__out) or not self.connected
+
+    def handle_write(self):
+        data = "".join(self.__out)
+        sent = self.send(data)
+        self.__out.clear()
+        if sent < len(data):
+            self.__out.append(data[sent:])
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if not data:
+            return
+        self.__in.extend(data)
+        self.__last_traffic = time()
+
+        # Handle every complete frame in the input buffer
+        start = 0
+        while len(self.__in) - start >= 4:
+            length = unpack("!l", str(self.__in[start:start + 4]))[0]
+            if len(self.__in) - start - 4 < length:
+                break
+            self.__answer(str(self.__in[start + 4:start + 4 + length]))
+            start += 4 + length
+        del self.__in[:start]
+
+    def __answer(self, answer):
+        """ Same reply handling as ServerConnection.__receive """
+        if not self.__pending:
+            return  # Nobody asked for this
+        req = self.__pending[0]
+        if answer == "WAIT" and not req.waiting:
+            req.waiting = True
+            return
+
+        self.__pending.popleft()
+        try:
+            if req.waiting or answer == "OK" or answer == "":
+                req.finish(answer)
+            elif answer == "PWD":
+                req.finish(error="Error 9201: Password rejected")
+            else:
+                req.finish(error=answer)
+        except Exception, err:  # A failing callback shouldn't take the connection down
+            print "Error: " + str(err)
+
+    def handle_close(self):
+        asyncore.dispatcher.close(self)
+        self.__fail("Connection closed by server")
+
+    def handle_error(self):
+        error = "Connection error: {}".format(sys.exc_info()[1])
+        asyncore.dispatcher.close(self)
+        self.__fail(error)
+
+    def __fail(self, error):
+        """ Finishes all the pending requests with an error, new requests are refused """
+        if self.__error is None:
+            self.__error = error
+        while self.__pending:
+            try:
+                self.__pending.popleft().finish(error=self.__error)
+            except Exception, err:  # A failing callback shouldn't keep the others from being called
+                print "Error: " + str(err)
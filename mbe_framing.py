@@ -0,0 +1,60 @@
+"""
+Server side of the framing used by the MBE server: every message is a 4 byte big-endian length followed by the
+message. Shared by the request handlers of the local proxy (mbe_proxy.py) and of the framed virtual MBE server
+(Virtual_MBE/virtual_mbe_framed_host.py).
+"""
+
+import socket
+from struct import pack, unpack
+
+
+class FramingMixIn:
+    """
+    Mix-in for SocketServer request handlers which read and write length-prefixed frames on self.request, ex:
+
+        class MyRequestHandler(FramingMixIn, SocketServer.BaseRequestHandler):
+            def handle(self):
+                message = self.receive()
+                ...
+    """
+
+    def setup(self):
+        # Replies to pipelined commands are written one by one, don't let Nagle's algorithm hold them back
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def receive(self):
+        """
+        :return: the next frame sent by the client, None if the client disconnected
+        :rtype: str
+        """
+        header = self.receive_exactly(4)
+        if header is None:
+            return None
+        return self.receive_exactly(unpack("!l", header)[0])
+
+    def receive_exactly(self, length):
+        """
+        :param length: number of bytes to read
+        :type length: int
+        :return: exactly length bytes, None if the client disconnected before sending them
+        :rtype: str
+        """
+        data = ""
+        while len(data) < length:
+            try:
+                chunk = self.request.recv(length - len(data))
+            except socket.error:
+                return None
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def send(self, *answers):
+        """
+        Sends one or several frames at once
+
+        :param answers: the frames, ex: "WAIT" and the value
+        :type answers: str
+        """
+        self.request.sendall("".join([pack("!l", len(answer)) + answer for answer in answers]))
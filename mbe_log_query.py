@@ -0,0 +1,143 @@
+"""
+Queries over a whole directory of binary MBE logs, ex: all Ga.PV and BFM.P samples of 2018 taken while the Ga shutter
+was open:
+
+    from datetime import datetime
+    from mbe_log_query import LogQuery
+
+    if __name__ == "__main__":  # Needed on Windows, the files are read in other processes
+        logs = LogQuery("D:/MBE Logs")
+        result = logs.query(["Ga.PV", "BFM.P"], datetime(2018, 1, 1), datetime(2019, 1, 1), where={"Shutters.Ga": True})
+        plot(result["Time"], result["Ga.PV"])
+
+Every file is opened memory-mapped with its own header, so logs written by different versions of the MBE software
+can be mixed. The files are read in parallel by a pool of processes and only the requested time window and columns
+are decoded. A file which can't be read (truncated, corrupt) is skipped without losing the results of the others.
+"""
+
+import glob, os, struct
+from collections import OrderedDict
+from multiprocessing import Pool
+
+import numpy as np
+
+from MBE_Tools import LogFile, to_timestamp
+
+
+def query_file(path, columns, start=None, end=None, where=None):
+    """
+    Runs a query on one log file
+
+    :param path: path of the log file
+    :param columns: names of the columns to return
+    :param start: unix timestamp of the beginning of the time window, or None
+    :param end: unix timestamp of the end of the time window (excluded), or None
+    :param where: only keep the records where these columns have these values, ex: {"Shutters.Ga": True}
+    :return: (path, dict of the Time and the requested columns, error), the dict is None if the file doesn't have all
+        of these columns or can't be read, error is then why it can't be read
+    :rtype: tuple
+    """
+    try:
+        return path, _query_log(path, columns, start, end, where), None
+    except (IOError, ValueError, struct.error) as e:  # Raised in a pool, it would abort the query of all the files
+        return path, None, "{}: {}".format(type(e).__name__, e)
+
+
+def _query_log(path, columns, start, end, where):
+    """
+    Runs a query on one log file, see query_file
+
+    :return: dict of the Time and the requested columns, None if the file doesn't have all of these columns
+    :rtype: OrderedDict
+    """
+    log = LogFile(path, memoryMap=True, decodeAll=False)
+    try:
+        where = where or {}
+        names = log.byteConfig.dtype.names
+        if not all([name in names for name in list(columns) + where.keys()]):
+            return None
+        first = 0 if start is None else log.time_index(start)
+        last = max(first, log.count if end is None else log.time_index(end))
+        records = log.columns[first:last]
+        mask = None
+        for name, value in where.iteritems():
+            condition = records[name] == value
+            mask = condition if mask is None else mask & condition
+        result = OrderedDict()
+        for name in ["Time"] + [column for column in columns if column != "Time"]:
+            values = records[name]
+            result[name] = values[mask] if mask is not None else np.array(values)
+        return result
+    finally:
+        log.close()
+
+
+def _query_file(args):
+    return query_file(*args)
+
+
+class LogQuery:
+    """
+    Column and time-range queries over all the binary logs of a directory
+    """
+
+    def __init__(self, directory, pattern="*.log", processes=None):
+        """
+        :param directory: directory containing the logs
+        :type directory: str
+        :param pattern: pattern of the names of the log files
+        :type pattern: str
+        :param processes: number of processes reading the files, one per CPU if None. With 1 everything is done in
+            this process, which is easier to debug.
+        :type processes: int
+        """
+        self.directory = directory
+        self.pattern = pattern
+        self.processes = processes
+        self.skipped = []  # Files of the last query which didn't contain all the columns or couldn't be read
+        self.errors = OrderedDict()  # Files of the last query which couldn't be read: why
+
+    def files(self):
+        """
+        :return: paths of all the log files, sorted by name
+        :rtype: list of str
+        """
+        return sorted(glob.glob(os.path.join(self.directory, self.pattern)))
+
+    def query(self, columns, start=None, end=None, where=None):
+        """
+        Collects columns from all the log files
+
+        :param columns: names of the columns to return, ex: ["Ga.PV", "BFM.P"]
+        :type columns: list of str
+        :param start: beginning of the time window: datetime (local time), numpy.datetime64 (UTC) or unix timestamp.
+            From the beginning of every file if None.
+        :param end: end of the time window (excluded), until the end of every file if None
+        :param where: only keep the records where these columns have these values, ex: {"Shutters.Ga": True}
+        :type where: dict
+        :return: the Time column and the requested columns, in chronological order
+        :rtype: OrderedDict of numpy.ndarray
+        """
+        start = None if start is None else to_timestamp(start)
+        end = None if end is None else to_timestamp(end)
+        tasks = [(path, columns, start, end, where) for path in self.files()]
+        if self.processes == 1:
+            parts = map(_query_file, tasks)
+        else:
+            pool = Pool(self.processes)
+            try:
+                parts = pool.map(_query_file, tasks)
+            finally:
+                pool.close()
+                pool.join()
+
+        self.skipped = [path for path, part, error in parts if part is None]
+        self.errors = OrderedDict([(path, error) for path, part, error in parts if error is not None])
+        for path, error in self.errors.iteritems():
+            print("Could not read {}: {}".format(path, error))
+        parts = [part for path, part, error in parts if part is not None and len(part["Time"])]
+        parts.sort(key=lambda part: part["Time"][0])
+        result = OrderedDict()
+        for name in ["Time"] + [column for column in columns if column != "Time"]:
+            result[name] = np.concatenate([part[name] for part in parts]) if parts else np.array([])
+        return result
@@ -0,0 +1,183 @@
+"""
+Local proxy in front of the MBE server. It holds a single connection to the real MBE server and lets many local
+clients (the running recipe, ValveGuardian, ad-hoc scripts...) connect to it with the normal MBE_Tools.ServerConnection
+protocol. Identical "Get" requests that arrive at the same time are sent to the MBE server only once, and their answer
+is re-used for a short time, so that several programs polling the same values don't multiply the load on the server.
+
+Run it on the growth computer and point the clients to it, ex: MBERecipe(server_address=("localhost", 55002))
+"""
+
+import SocketServer, threading
+from SocketServer import ThreadingTCPServer
+from time import time
+
+from MBE_Tools import ServerConnection
+from mbe_framing import FramingMixIn
+
+
+class CoalescingCache:
+    """
+    Runs read-only commands against the upstream connection. Concurrent identical commands share one upstream call and
+    the answers are kept for ttl seconds.
+    """
+
+    def __init__(self, conn, ttl=0.5):
+        """
+        :param conn: connection to the MBE server
+        :type conn: MBE_Tools.ServerConnection
+        :param ttl: number of seconds an answer can be re-used for
+        :type ttl: float
+        """
+        self.conn = conn
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.answers = {}  # key: (time of answer, answer, error)
+        self.in_flight = {}  # key: threading.Event set once the upstream answer is there
+        self.generation = 0  # Incremented by clear(), answers from before a clear() are not kept
+        self.upstream_calls = 0
+        self.hits = 0
+
+    def get(self, cmd):
+        """
+        :param cmd: command to send (ex: "Get Ga.PV")
+        :type cmd: str
+        :return: answer of the MBE server
+        :rtype: str
+        """
+        key = cmd.lower()
+        while True:
+            self.lock.acquire()
+            entry = self.answers.get(key)
+            if entry is not None and time() - entry[0] <= self.ttl:
+                self.hits += 1
+                self.lock.release()
+                return self.__result(entry)
+            event = self.in_flight.get(key)
+            if event is None:  # Nobody is asking for it right now, so we do it
+                event = threading.Event()
+                self.in_flight[key] = event
+                generation = self.generation
+                self.lock.release()
+                break
+            self.lock.release()
+            event.wait()  # Somebody else is already asking, wait for their answer
+
+        try:
+            entry = (time(), self.conn.send_command(cmd), None)
+        except RuntimeError, err:
+            entry = (time(), None, str(err))
+        self.lock.acquire()
+        self.upstream_calls += 1
+        if generation == self.generation:
+            self.answers[key] = entry
+        del self.in_flight[key]
+        self.lock.release()
+        event.set()
+        return self.__result(entry)
+
+    def clear(self):
+        """
+        Forgets all the answers, used when something is changed on the MBE
+        """
+        self.lock.acquire()
+        self.answers.clear()
+        self.generation += 1
+        self.lock.release()
+
+    def __result(self, entry):
+        if entry[2] is not None:
+            raise RuntimeError(entry[2])
+        return entry[1]
+
+
+class MBEProxyServer(ThreadingTCPServer):
+    """
+    TCP server that local clients connect to instead of the MBE server
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, server_address, conn, password="xxa", ttl=0.5):
+        """
+        :param server_address: (host, port) to listen on
+        :type server_address: tuple
+        :param conn: connection to the MBE server
+        :type conn: MBE_Tools.ServerConnection
+        :param password: password that the local clients have to use
+        :type password: str
+        :param ttl: number of seconds a "Get" answer can be re-used for
+        :type ttl: float
+        """
+        ThreadingTCPServer.__init__(self, server_address, MBEProxyRequestHandler)
+        self.conn = conn
+        self.password = password
+        self.cache = CoalescingCache(conn, ttl)
+        self.config = conn.ByteInterpreter.byteConfig.header
+
+
+class MBEProxyRequestHandler(FramingMixIn, SocketServer.BaseRequestHandler):
+    """
+    Handles one local client for as long as it stays connected
+    """
+
+    def handle(self):
+        while True:
+            message = self.receive()
+            if message is None:
+                return  # Client disconnected
+            if not message.startswith(self.server.password):
+                self.send("PWD")
+                continue
+            cmd = message[len(self.server.password):]
+            if cmd.startswith("Client:"):  # Login, the MBE server doesn't answer it either
+                print("{} connected as {}".format(self.client_address[0], cmd[len("Client:"):]))
+                continue
+
+            try:
+                answer = self.process_command(cmd)
+            except RuntimeError, err:
+                self.send(str(err))  # Errors are sent back as they are, the client raises them
+                continue
+            if answer == "OK" or answer == "":
+                self.send(answer)
+            else:
+                self.send("WAIT", answer)
+
+    def process_command(self, cmd):
+        """
+        Answers a command of a local client, either locally, from the cache or by forwarding it to the MBE server
+
+        :param cmd: command without the password
+        :type cmd: str
+        :return: answer of the MBE server
+        :rtype: str
+        """
+        lower = cmd.lower()
+        if lower == "ok":  # Keepalive, our own connection to the server is kept alive by the ServerConnection
+            return "OK"
+        elif lower == "get this.config":
+            return self.server.config
+        elif lower == "get this.chamber":
+            return self.server.conn.Chamber
+        elif lower.startswith("get ") and not lower.startswith("get this.recipesrunning"):
+            return self.server.cache.get(cmd)
+
+        # Anything else changes something on the MBE, pass it on and forget what we know
+        self.server.cache.clear()
+        try:
+            return self.server.conn.send_command(cmd)
+        finally:
+            self.server.cache.clear()
+
+
+if __name__ == "__main__":
+    HOST, PORT = "localhost", 55002
+    print("Connecting to the MBE server.")
+    upstream = ServerConnection("10.18.7.24", "55001", "xxa", name="proxy")
+    server = MBEProxyServer((HOST, PORT), upstream)
+
+    print("Starting proxy on {}:{}.".format(HOST, PORT))
+    try:
+        server.serve_forever()
+    finally:
+        upstream.close()
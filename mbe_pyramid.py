@@ -0,0 +1,175 @@
+"""
+Multi-resolution min/max/mean summary ("pyramid") of long time series, for fast plotting of multi-hour or multi-day
+logs. Level 0 summarizes bins of `factor` samples, level 1 bins of factor**2 samples etc. A plot of any time window
+only needs the finest level which still gives a few thousand points, the min and max keep short spikes (or a shutter
+opened for a few seconds) visible. Plot the min/max envelope (see DecimationPyramid.envelope) rather than the means.
+
+The pyramid is built incrementally: new samples can be appended at any time, only they are processed. It can be saved
+next to the log and loaded again, see MBE_Tools.LogFile.pyramid().
+"""
+
+import numpy as np
+
+
+class _Growable:
+    """
+    1D array which can be appended to in amortized constant time
+    """
+
+    def __init__(self, dtype=np.float64, values=None):
+        self.buffer = np.empty(1024 if values is None else max(1024, 2 * len(values)), dtype=dtype)
+        self.size = 0
+        if values is not None:
+            self.append(values)
+
+    def append(self, values):
+        end = self.size + len(values)
+        if end > len(self.buffer):
+            grown = np.empty(2 * end, dtype=self.buffer.dtype)
+            grown[:self.size] = self.buffer[:self.size]
+            self.buffer = grown
+        self.buffer[self.size:end] = values
+        self.size = end
+
+    @property
+    def values(self):
+        return self.buffer[:self.size]
+
+
+class DecimationPyramid:
+    """
+    Min/max/mean pyramid of several columns sharing a time axis
+    """
+
+    def __init__(self, columns, factor=16, levels=6):
+        """
+        :param columns: names of the columns
+        :type columns: list of str
+        :param factor: number of bins of a level summarized by one bin of the next level
+        :type factor: int
+        :param levels: number of levels, the coarsest one summarizes factor**levels samples per bin
+        :type levels: int
+        """
+        self.columns = list(columns)
+        self.factor = factor
+        self.count = 0  # Number of samples appended so far
+        # Per level: start time of every bin and min/max/mean of every column. "pending" holds the samples (level 0)
+        # or the bins of the level below which don't make a full bin yet.
+        self.levels = [{"time": _Growable(), "pending": None,
+                        "data": dict([(column, [_Growable(), _Growable(), _Growable()]) for column in self.columns])}
+                       for i in range(levels)]
+
+    def append(self, times, values):
+        """
+        Adds new samples
+
+        :param times: times of the samples, increasing
+        :type times: numpy.ndarray
+        :param values: column name: values of the samples
+        :type values: dict
+        """
+        self.count += len(times)
+        data = [np.asarray(times, dtype=np.float64)]
+        for column in self.columns:
+            v = np.asarray(values[column], dtype=np.float64)
+            data += [v, v, v]
+        for level in self.levels:
+            if level["pending"] is not None:
+                data = [np.concatenate([pending, new]) for pending, new in zip(level["pending"], data)]
+            complete = len(data[0]) // self.factor * self.factor
+            level["pending"] = [d[complete:] for d in data]
+            if not complete:
+                return
+            data = self.__reduce([d[:complete] for d in data])
+            level["time"].append(data[0])
+            for c, column in enumerate(self.columns):
+                for k in range(3):
+                    level["data"][column][k].append(data[1 + 3 * c + k])
+
+    def __reduce(self, data):
+        """ Summarizes every `factor` consecutive entries into one bin """
+        shape = (-1, self.factor)
+        reduced = [data[0].reshape(shape)[:, 0]]
+        for c in range(len(self.columns)):
+            minimum, maximum, mean = data[1 + 3 * c:4 + 3 * c]
+            reduced += [minimum.reshape(shape).min(axis=1), maximum.reshape(shape).max(axis=1),
+                        mean.reshape(shape).mean(axis=1)]
+        return reduced
+
+    def select(self, start=None, end=None, max_points=2000):
+        """
+        Summary of a time window at the finest level which gives at most about max_points points. The last bins are
+        only partly summarized (they come from the level below), as they don't have all their samples yet.
+
+        :param start: beginning of the window, from the beginning if None
+        :param end: end of the window, until the end if None
+        :param max_points: maximum number of points wanted
+        :return: (times, {column: (min, max, mean)})
+        :rtype: tuple
+        """
+        for level in self.levels:
+            times, data = self.__level_data(level)
+            first = 0 if start is None else max(np.searchsorted(times, start, side="right") - 1, 0)
+            last = len(times) if end is None else np.searchsorted(times, end)
+            if last - first <= max_points or level is self.levels[-1]:
+                return times[first:last], dict([(column, tuple([d[first:last] for d in data[column]]))
+                                                for column in self.columns])
+
+    def envelope(self, start=None, end=None, max_points=2000):
+        """
+        Like select, but ready to be plotted as lines: every bin gives two points at its time, its min followed by its
+        max, so that short spikes stay visible instead of being averaged away
+
+        :param max_points: maximum number of points wanted, two per bin
+        :return: (times, {column: values})
+        :rtype: tuple
+        """
+        times, data = self.select(start, end, max(max_points // 2, 1))
+        return np.repeat(times, 2), dict([(column, np.column_stack(data[column][:2]).ravel())
+                                          for column in self.columns])
+
+    def __level_data(self, level):
+        """ Bins of a level followed by the pending entries of this level and of all the levels below """
+        parts = [[level["time"].values] + [g.values for column in self.columns for g in level["data"][column]]]
+        for lower in self.levels[self.levels.index(level)::-1]:
+            if lower["pending"] is not None:
+                parts.append(lower["pending"])
+        data = [np.concatenate(arrays) for arrays in zip(*parts)]
+        return data[0], dict([(column, data[1 + 3 * c:4 + 3 * c]) for c, column in enumerate(self.columns)])
+
+    def save(self, path):
+        """
+        Saves the pyramid, ex: next to the log file it summarizes
+
+        :param path: path of the file, should end with .npz
+        """
+        arrays = {"columns": np.array(self.columns), "factor": self.factor, "count": self.count,
+                  "levels": len(self.levels)}
+        for i, level in enumerate(self.levels):
+            arrays["{}/time".format(i)] = level["time"].values
+            for c, column in enumerate(self.columns):
+                for k in range(3):
+                    arrays["{}/{}/{}".format(i, c, k)] = level["data"][column][k].values
+            if level["pending"] is not None:
+                for k, pending in enumerate(level["pending"]):
+                    arrays["{}/pending/{}".format(i, k)] = pending
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a pyramid saved with save()
+
+        :rtype: DecimationPyramid
+        """
+        f = np.load(path)
+        pyramid = cls(list(f["columns"]), int(f["factor"]), int(f["levels"]))
+        pyramid.count = int(f["count"])
+        for i, level in enumerate(pyramid.levels):
+            level["time"] = _Growable(values=f["{}/time".format(i)])
+            for c, column in enumerate(pyramid.columns):
+                level["data"][column] = [_Growable(values=f["{}/{}/{}".format(i, c, k)]) for k in range(3)]
+            if "{}/pending/0".format(i) in f.files:
+                level["pending"] = [f["{}/pending/{}".format(i, k)] for k in range(1 + 3 * len(pyramid.columns))]
+        f.close()
+        return pyramid
@@ -0,0 +1,132 @@
+"""
+When to read back a parameter after setting it. Instead of always sleeping the worst case before checking, the value
+is read back after a short delay, then again with exponentially growing delays until it is confirmed or the deadline of
+its parameter class is over. How long each parameter typically takes to be confirmed is learned and saved between
+runs, so the first readback already comes at about the right time.
+
+What is learned is kept per user in STATE_DIR (~/.mbe_toolbox by default, or the MBE_STATE_DIR environment variable),
+not in the repository.
+"""
+
+import json, os
+
+from mbe_stats import classify
+
+# Parameter class: (deadline in seconds, tolerance of the readback for numbers)
+READBACK_CLASSES = {"PV.TSP": (5.0, 0.1),
+                    "PV.Rate": (5.0, 0.1),
+                    "OP.TSP": (5.0, 0.1),
+                    "OP.Rate": (5.0, 0.1),
+                    "RS.RPM": (5.0, 0.1),
+                    "Mode": (5.0, 0.1),
+                    "Shutter": (2.0, 0.1),
+                    "Valve.OP": (15.0, 0.1)}  # The As and Sb valves take a while to move
+DEFAULT_CLASS = (5.0, 0.1)
+STATE_DIR = os.environ.get("MBE_STATE_DIR", os.path.join(os.path.expanduser("~"), ".mbe_toolbox"))
+SETTLE_TIMES_FILE = os.path.join(STATE_DIR, "settle_times.json")
+
+
+def load_state(filename):
+    """
+    :param filename: json file written by save_state, or None
+    :return: its content, an empty dict if there is none or it can't be read
+    :rtype: dict
+    """
+    if filename is None or not os.path.exists(filename):
+        return {}
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (IOError, ValueError) as e:  # Starting from scratch is better than not starting the recipe
+        print("Could not read {}: {}".format(filename, e))
+        return {}
+
+
+def save_state(filename, state):
+    """
+    Writes a dict to a json file, creating its directory if needed
+    """
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(filename, "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+
+
+class ReadbackPolicy:
+    """
+    Readback schedule, deadlines and tolerances of the parameters, and their learned settle times
+    """
+
+    def __init__(self, filename=SETTLE_TIMES_FILE, first_delay=0.02, max_delay=1.0):
+        """
+        :param filename: file where the learned settle times are kept, None to not keep them
+        :type filename: str
+        :param first_delay: shortest delay before reading back, in seconds
+        :type first_delay: float
+        :param max_delay: longest delay between two readbacks, in seconds
+        :type max_delay: float
+        """
+        self.filename = filename
+        self.first_delay = first_delay
+        self.max_delay = max_delay
+        # Parameter (lower case): typical time until its readback is confirmed in seconds
+        self.settle_times = load_state(filename)
+        self.changed = False  # Something was learned since loading
+
+    def deadline(self, parameter):
+        """
+        :return: time in seconds after which the value should have been confirmed
+        :rtype: float
+        """
+        return READBACK_CLASSES.get(classify("Set " + parameter)[1], DEFAULT_CLASS)[0]
+
+    def tolerance(self, parameter):
+        """
+        :return: allowed difference between the value set and the value read back
+        :rtype: float
+        """
+        return READBACK_CLASSES.get(classify("Set " + parameter)[1], DEFAULT_CLASS)[1]
+
+    def schedule(self, parameter, first_delay=None):
+        """
+        Delays to wait before each readback: first the learned settle time (a bit less, or first_delay if nothing was
+        learned yet), then exponentially growing delays
+
+        :param parameter: parameter which was set
+        :type parameter: str
+        :param first_delay: delay before the first readback, overrides the learned one
+        :type first_delay: float
+        :return: generator of delays in seconds
+        """
+        settle = self.settle_times.get(parameter.lower())
+        if first_delay is None:
+            first_delay = max(self.first_delay, 0.8 * settle) if settle is not None else self.first_delay
+        yield first_delay
+        delay = self.first_delay
+        while True:
+            delay = min(2 * delay, self.max_delay)
+            yield delay
+
+    def learn(self, parameter, seconds):
+        """
+        Remembers how long it took until a parameter was confirmed
+
+        :param parameter: parameter which was set
+        :type parameter: str
+        :param seconds: time between setting it and the readback which confirmed it
+        :type seconds: float
+        """
+        key = parameter.lower()
+        previous = self.settle_times.get(key)
+        self.settle_times[key] = seconds if previous is None else 0.7 * previous + 0.3 * seconds
+        self.changed = True
+
+    def save(self):
+        """
+        Saves the learned settle times for the next runs, if something was learned
+        """
+        if self.filename is None or not self.changed:
+            return
+        save_state(self.filename, self.settle_times)
+        self.changed = False
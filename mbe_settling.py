@@ -0,0 +1,253 @@
+"""
+Tools to decide when a temperature (or any other reading) has settled:
+
+- RollingWindow: the last samples, with their mean and standard deviation updated in constant time per sample, used by
+  MBERecipe.wait_for_all.
+- SettlingDetector: follows the approach to a target (linear ramp, then exponential approach with possible overshoot),
+  gives a live estimate of the remaining time and decides statistically when the reading has settled, used by
+  MBERecipe.wait_to_reach_temp.
+- SettlingHistory: how each controller behaved in the past runs, to know how long a wait should take and when to give
+  up. It is kept per user in STATE_DIR, like the settle times of mbe_readback.
+"""
+
+import os
+
+import numpy as np
+
+from mbe_readback import STATE_DIR, load_state, save_state
+
+SETTLING_FILE = os.path.join(STATE_DIR, "settling.json")
+
+
+class RollingWindow:
+    """
+    Last n samples of a reading, with their mean and standard deviation updated in O(1) per sample (Welford's
+    algorithm, extended to remove the oldest sample once the window is full)
+    """
+
+    def __init__(self, n):
+        """
+        :param n: number of samples in the window
+        :type n: int
+        """
+        self.n = n
+        self.buffer = np.zeros(n)
+        self.count = 0  # Number of samples in the window
+        self.position = 0  # Where the next sample is written
+        self.mean = 0.0
+        self.__m2 = 0.0  # Sum of the squared differences to the mean
+
+    def add(self, value):
+        """
+        Adds a sample, removing the oldest one if the window is full
+
+        :param value: new sample
+        :type value: float
+        """
+        value = float(value)
+        if self.count < self.n:
+            self.count += 1
+            delta = value - self.mean
+            self.mean += delta / self.count
+            self.__m2 += delta * (value - self.mean)
+        else:
+            old = self.buffer[self.position]
+            previous_mean = self.mean
+            self.mean += (value - old) / self.n
+            self.__m2 = max(self.__m2 + (value - old) * (value - self.mean + old - previous_mean), 0.0)
+        self.buffer[self.position] = value
+        self.position = (self.position + 1) % self.n
+
+    @property
+    def full(self):
+        return self.count == self.n
+
+    @property
+    def std(self):
+        """
+        Standard deviation of the samples in the window (like numpy.std)
+        """
+        return np.sqrt(self.__m2 / self.count) if self.count else 0.0
+
+    @property
+    def values(self):
+        """
+        Samples in the window, from the oldest to the newest
+        """
+        if self.count < self.n:
+            return self.buffer[:self.count].copy()
+        return np.roll(self.buffer, -self.position)
+
+
+class SettlingDetector:
+    """
+    Follows a reading approaching a target. The readings inside the error band since the last one outside of it are
+    considered settled once their mean is within the error with 95% confidence, their scatter is below error/2 and they
+    don't drift anymore. This needs only a few readings when the reading is stable, more when it is noisy.
+    """
+
+    def __init__(self, target, error, rate=None, min_samples=3, max_samples=10):
+        """
+        :param target: value to reach
+        :type target: float
+        :param error: error within which +/- the target should be reached
+        :type error: float
+        :param rate: ramp rate of the setpoint in units per second, if known
+        :type rate: float
+        :param min_samples: minimum number of readings within the error to decide that it settled
+        :type min_samples: int
+        :param max_samples: with this many readings within the error, it settled if their mean and scatter are within
+            the error, like a fixed window of this size
+        :type max_samples: int
+        """
+        self.target = target
+        self.error = error
+        self.rate = rate
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.times = []
+        self.values = []
+        self.entered = None  # Time of the first reading within the error
+        self.overshoot = 0.0  # Largest excursion past the target
+        self.direction = None  # +1 when approaching from below, -1 from above
+        self.band_start = 0  # Index of the first reading of the current run within the error
+
+    def add(self, t, value):
+        """
+        Adds a reading
+
+        :param t: time of the reading in seconds
+        :type t: float
+        :param value: reading
+        :type value: float
+        :return: whether the reading settled at the target
+        :rtype: bool
+        """
+        residual = value - self.target
+        if self.direction is None:
+            self.direction = -1 if residual > 0 else 1
+        self.times.append(t)
+        self.values.append(value)
+        self.overshoot = max(self.overshoot, residual * self.direction)
+        if abs(residual) >= self.error:
+            self.band_start = len(self.values)
+            return False
+        if self.entered is None:
+            self.entered = t
+        return self.settled()
+
+    def settled(self):
+        """
+        :return: whether the readings within the error band meet the settling criterion
+        :rtype: bool
+        """
+        residuals = np.array(self.values[self.band_start:]) - self.target
+        m = len(residuals)
+        if m < self.min_samples:
+            return False
+        residuals = residuals[-self.max_samples:]
+        m = len(residuals)
+        mean, std = residuals.mean(), residuals.std()
+        if m >= self.max_samples:
+            return abs(mean) < self.error and std < self.error / 2.
+        times = np.array(self.times[-m:])
+        slope = np.polyfit(times - times[0], residuals, 1)[0] if times[-1] > times[0] else 0.0
+        confidence = 2 * residuals.std(ddof=1) / np.sqrt(m)
+        # The drift is extrapolated over a full window, a slow ramp through the band looks stable over a few readings
+        drift = abs(slope) * (times[-1] - times[0]) / (m - 1) * self.max_samples
+        return abs(mean) + confidence < self.error and std < self.error / 2. and drift < self.error / 2.
+
+    def eta(self):
+        """
+        Estimated time until the reading settles: along a linear ramp when far from the target, also from an exponential
+        fit of the approach (using the envelope when it oscillates around the target) when close to it. The shortest
+        estimate is used, so that a wait based on it doesn't miss the moment the reading settles.
+
+        :return: seconds from the last reading, None if it can't be estimated yet
+        :rtype: float
+        """
+        if not self.values:
+            return None
+        distances = np.abs(np.array(self.values[-self.max_samples:]) - self.target)
+        times = np.array(self.times[-self.max_samples:])
+        if distances[-1] < self.error:
+            return 0.0
+        estimates = []
+        # Linear ramp, at the observed speed or at the ramp rate of the setpoint
+        speed = 0.0
+        if len(distances) >= 2 and times[-1] > times[-2]:
+            speed = (distances[-2] - distances[-1]) / (times[-1] - times[-2])
+        if self.rate:
+            speed = max(speed, abs(self.rate))
+        if speed > 0:
+            estimates.append(distances[-1] / speed)
+        if distances[-1] < 10 * self.error and len(distances) >= 3:
+            # Exponential approach: log of the distance decreases linearly
+            k = -np.polyfit(times - times[0], np.log(np.maximum(distances, self.error / 10.)), 1)[0]
+            if k > 0:
+                estimates.append(np.log(distances[-1] / (self.error / 2.)) / k)
+        return min(estimates) if estimates else None
+
+
+class SettlingHistory:
+    """
+    How long the controllers took to settle in the past runs, learned as moving averages and saved between runs
+    """
+
+    def __init__(self, filename=SETTLING_FILE, default_tail=120.0):
+        """
+        :param filename: file where the history is kept, None to not keep it
+        :type filename: str
+        :param default_tail: time in seconds between reaching the error band and settling, for controllers without
+            history
+        :type default_tail: float
+        """
+        self.filename = filename
+        self.default_tail = default_tail
+        # Controller: {"ratio": actual / ramp time to reach the error band, "tail": seconds from the error band to
+        # settled, "overshoot": largest excursion past the target}
+        self.controllers = load_state(filename)
+        self.changed = False  # Something was learned since loading
+
+    def expected_time(self, controller, ramp_time):
+        """
+        :param controller: name of the controller, ex: "Manip"
+        :param ramp_time: time the setpoint ramp needs to reach the target in seconds
+        :return: seconds the controller should need to settle at the target
+        :rtype: float
+        """
+        history = self.controllers.get(controller, {})
+        return ramp_time * history.get("ratio", 1.0) + history.get("tail", self.default_tail)
+
+    def timeout(self, controller, ramp_time):
+        """
+        :return: seconds after which waiting for the controller to settle should be given up
+        :rtype: float
+        """
+        return 3 * self.expected_time(controller, ramp_time) + 120
+
+    def learn(self, controller, ramp_time, detector):
+        """
+        Remembers how a controller settled
+
+        :param controller: name of the controller
+        :param ramp_time: time the setpoint ramp needed to reach the target in seconds
+        :param detector: detector which followed the controller until it settled, its times start at 0
+        :type detector: SettlingDetector
+        """
+        observed = {"tail": detector.times[-1] - detector.entered, "overshoot": detector.overshoot}
+        if ramp_time > 0:
+            observed["ratio"] = detector.entered / ramp_time
+        history = self.controllers.setdefault(controller, {})
+        for key, value in observed.items():
+            history[key] = value if key not in history else 0.7 * history[key] + 0.3 * value
+        self.changed = True
+
+    def save(self):
+        """
+        Saves the history for the next runs, if something was learned
+        """
+        if self.filename is None or not self.changed:
+            return
+        save_state(self.filename, self.controllers)
+        self.changed = False
@@ -0,0 +1,192 @@
+"""
+Opt-in statistics about the communication with the MBE server: how long each kind of command takes, how long we wait
+for the connection to be free, how often set_param has to retry and where the time of a recipe goes in general.
+
+Enable it with MBERecipe(instrument=True), a summary is printed when the recipe exits.
+"""
+
+from collections import OrderedDict
+
+
+def classify(cmd):
+    """
+    Splits a command into its verb and the class of parameter it acts on, ex: "Set Ga.PV.TSP 850" -> ("set", "PV.TSP"),
+    "Get Shutter.In" -> ("get", "Shutter"), "Open Ga" -> ("open", "Shutter")
+
+    :param cmd: command sent to the MBE server
+    :type cmd: str
+    :return: (verb, parameter class)
+    :rtype: tuple
+    """
+    words = cmd.split(" ")
+    verb = words[0].lower()
+    if verb in ("open", "close"):
+        return verb, "Shutter"
+    if verb not in ("get", "set") or len(words) < 2:
+        return verb, ""
+    parts = words[1].split(".")
+    if parts[0].lower() == "shutter":
+        return verb, "Shutter"
+    elif parts[0].lower() == "this" or len(parts) == 1:
+        return verb, words[1]
+    return verb, ".".join(parts[1:])
+
+
+class LatencyHistogram:
+    """
+    Histogram of durations with a fixed relative precision, like an HdrHistogram. Values are stored in microseconds
+    and only their highest sub_bits bits are kept, so the memory used doesn't grow with the number of samples.
+    """
+
+    def __init__(self, sub_bits=5):
+        """
+        :param sub_bits: number of significant bits kept, 5 gives a precision of about 3%
+        :type sub_bits: int
+        """
+        self.sub_bits = sub_bits
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, seconds):
+        us = max(int(seconds * 1E6), 0)
+        if us >= (1 << self.sub_bits):
+            shift = us.bit_length() - self.sub_bits
+            us = (us >> shift) << shift
+        self.counts[us] = self.counts.get(us, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    def merge(self, other):
+        """
+        Adds all the values of another histogram (with the same sub_bits) to this one
+        """
+        for us, count in other.counts.iteritems():
+            self.counts[us] = self.counts.get(us, 0) + count
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        """
+        :param p: percentile to compute, between 0 and 100
+        :type p: float
+        :return: duration in seconds below which p percent of the values are
+        :rtype: float
+        """
+        if not self.count:
+            return 0.0
+        if p >= 100:  # The extremes are known exactly
+            return self.max
+        if p <= 0:
+            return self.min
+        target = p / 100.0 * self.count
+        seen = 0
+        for us in sorted(self.counts):
+            seen += self.counts[us]
+            if seen >= target:
+                # Middle of the bucket, the values are somewhere between us and the next bucket
+                width = 1 << max(us.bit_length() - self.sub_bits, 0) if us else 1
+                return min(max((us + width / 2.0) / 1E6, self.min), self.max)
+        return self.max
+
+
+class CommandStats:
+    """
+    Collects the statistics of one connection / recipe
+    """
+
+    def __init__(self):
+        self.commands = {}  # (verb, parameter class): LatencyHistogram of round trip times
+        self.lock_wait = LatencyHistogram()
+        self.retries = {}  # parameter class: [number of set_param calls, number of retries]
+        self.shutters = {}  # shutter name: LatencyHistogram of the time from the command to the confirmed state
+        self.time_spent = OrderedDict()  # category: total seconds, ex: "waiting", "verify sleep"
+
+    def record_command(self, cmd, seconds, lock_wait=0.0):
+        """
+        :param cmd: command that was sent
+        :param seconds: round trip time of the command
+        :param lock_wait: time spent waiting for the connection to be free before sending it
+        """
+        self.__record(cmd, seconds)
+        self.lock_wait.record(lock_wait)
+        self.add_time("lock wait", lock_wait)
+
+    def record_batch(self, cmds, durations, lock_wait=0.0):
+        """
+        Records commands which were pipelined (see ServerConnection.send_many), each one under its own class
+
+        :param cmds: commands that were sent together
+        :param durations: time between the reply of each command and the reply before it (or sending the batch, for
+            the first one), they add up to the round trip time of the batch
+        :param lock_wait: time spent waiting for the connection to be free before sending the batch
+        """
+        for cmd, seconds in zip(cmds, durations):
+            self.__record(cmd, seconds)
+        self.lock_wait.record(lock_wait)
+        self.add_time("lock wait", lock_wait)
+
+    def __record(self, cmd, seconds):
+        key = classify(cmd)
+        if key not in self.commands:
+            self.commands[key] = LatencyHistogram()
+        self.commands[key].record(seconds)
+        self.add_time("commands", seconds)
+
+    def record_retries(self, parameter, retries):
+        """
+        :param parameter: parameter that was set (ex: "Ga.PV.TSP")
+        :param retries: how many times setting it had to be repeated before it was read back properly
+        """
+        key = classify("Set " + parameter)[1]
+        counts = self.retries.setdefault(key, [0, 0])
+        counts[0] += 1
+        counts[1] += retries
+
+    def record_shutter(self, shutter, seconds):
+        """
+        :param shutter: shutter that was moved (ex: "Ga")
+        :param seconds: time between sending the command and reading back the new state of the shutter
+        """
+        if shutter not in self.shutters:
+            self.shutters[shutter] = LatencyHistogram()
+        self.shutters[shutter].record(seconds)
+
+    def add_time(self, category, seconds):
+        self.time_spent[category] = self.time_spent.get(category, 0.0) + seconds
+
+    def summary(self):
+        """
+        :return: human-readable summary of all the statistics
+        :rtype: str
+        """
+        lines = ["Command statistics (times in ms):",
+                 "{:<8}{:<20}{:>8}{:>10}{:>10}{:>10}{:>10}{:>12}".format("verb", "parameter", "n", "mean", "p50", "p99",
+                                                                          "max", "total [s]")]
+        for key in sorted(self.commands, key=lambda k: -self.commands[k].total):
+            hist = self.commands[key]
+            lines.append("{:<8}{:<20}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}{:>12.1f}".format(
+                key[0], key[1], hist.count, hist.mean() * 1E3, hist.percentile(50) * 1E3, hist.percentile(99) * 1E3,
+                hist.max * 1E3, hist.total))
+        lines.append("Waiting for the connection: mean {:.1f}ms, p99 {:.1f}ms, max {:.1f}ms".format(
+            self.lock_wait.mean() * 1E3, self.lock_wait.percentile(99) * 1E3, (self.lock_wait.max or 0) * 1E3))
+        for key in sorted(self.retries):
+            lines.append("set_param {}: {} calls, {} retries".format(key, self.retries[key][0], self.retries[key][1]))
+        for shutter in sorted(self.shutters):
+            hist = self.shutters[shutter]
+            lines.append("Shutter {} confirmed after: mean {:.1f}ms, p99 {:.1f}ms, max {:.1f}ms ({} moves)".format(
+                shutter, hist.mean() * 1E3, hist.percentile(99) * 1E3, hist.max * 1E3, hist.count))
+        lines.append("Time spent: " + ", ".join(["{} {:.1f}s".format(category, seconds)
+                                                 for category, seconds in self.time_spent.iteritems()]))
+        return "\n".join(lines)
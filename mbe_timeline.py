@@ -0,0 +1,207 @@
+"""
+Timeline of shutter and setpoint events at fixed times, ex: for a superlattice or a shutter modulation. Instead of
+chaining shutter() and waiting(), which makes every cycle late by the time its commands took, all the events are
+declared first at their offset from a start mark and then fired at their absolute deadline:
+
+    timeline = mbe.timeline()
+    for i in range(20):
+        t0 = i * 55
+        timeline.shutter(t0, ["Ga", "Al"], [True, True])
+        timeline.shutter(t0 + 30, "Al", False)
+        timeline.shutter(t0 + 40, "Ga", False)
+    timeline.run()
+
+The commands of an event are sent once, a bit before its deadline, by the time commands typically take to reach the
+server. They are checked by reading the values back in the time left before the next event, never in front of it, and
+an error is raised at the end if some of them could not be confirmed. The planned and achieved time of every event are
+reported, and the events which were late are pointed out.
+"""
+
+from mbe_stats import LatencyHistogram
+
+
+class Timeline:
+    """
+    Events of a recipe at offsets from a start mark
+    """
+
+    def __init__(self, recipe):
+        """
+        :param recipe: recipe sending the commands, see MBERecipe.timeline()
+        :type recipe: recipe_helper.MBERecipe
+        """
+        self.recipe = recipe
+        self.events = []  # (offset, kind, arguments, description)
+        self.latency = 0.0  # Typical time between sending the commands of an event and the server executing them
+        self.readback_time = 0.05  # Typical time a round of readbacks takes, kept free before every event
+        self.poll_interval = 0.1  # Time between two rounds of readbacks
+        self.late_warning = 0.1  # Events later than this many seconds are pointed out
+        self.report = []  # (description, planned recipe time, achieved recipe time) of every event of the last run
+        self.lateness = LatencyHistogram()  # How late the events of the last run were fired
+        self.checks = []  # Readbacks of fired events which are not confirmed yet, see add_checks
+        self.failures = []  # Events of the last run which could not be confirmed
+        self.superseded = 0  # Readbacks of the last run dropped because a later event changed the same parameter
+
+    def shutter(self, offset, shutter_names, openbools):
+        """
+        Opens or closes shutters at a given time, all the shutters of the event move together
+
+        :param offset: seconds after the start mark
+        :type offset: float, int
+        :param shutter_names: names of the shutters
+        :type shutter_names: str, list of str
+        :param openbools: new state of every shutter (true = open, false = closed)
+        :type openbools: bool, list of bool
+        """
+        if not type(shutter_names) == list:
+            shutter_names = [shutter_names]
+        if not type(openbools) == list:
+            openbools = [openbools]
+        if not len(shutter_names) == len(openbools):
+            raise Exception("Error, expected lists with the same length!")
+        description = ", ".join(["{} {}".format("open" if openbool else "close", shutter_name)
+                                 for shutter_name, openbool in zip(shutter_names, openbools)])
+        self.events.append((offset, "shutter", (shutter_names, openbools), description))
+
+    def set_params(self, offset, parameters):
+        """
+        Sets parameters at a given time
+
+        :param offset: seconds after the start mark
+        :type offset: float, int
+        :param parameters: parameters and the values they should get, in the order they have to be set
+        :type parameters: OrderedDict or list of (parameter, value) tuples
+        """
+        if hasattr(parameters, 'items'):
+            parameters = parameters.items()
+        parameters = [(parameter, self.recipe.clamp_value(parameter, value)) for parameter, value in parameters]
+        description = ", ".join(["{}={}".format(parameter, value) for parameter, value in parameters])
+        self.events.append((offset, "set", parameters, description))
+
+    def set_param(self, offset, parameter, value):
+        """
+        Sets a parameter at a given time, see set_params
+        """
+        self.set_params(offset, [(parameter, value)])
+
+    def commands(self, kind, arguments):
+        """
+        :return: commands to send to the server for an event
+        :rtype: list of str
+        """
+        if kind == "shutter":
+            return ["{} {}".format("Open" if openbool else "Close", shutter_name)
+                    for shutter_name, openbool in zip(*arguments)]
+        return ["Set {} {}".format(parameter, value) for parameter, value in arguments]
+
+    def run(self, start=None):
+        """
+        Fires all the events at their time, in chronological order (events at the same time in the order they were
+        added). The commands of every event are sent once and checked afterwards, see verify. An event which is late
+        anyway is fired immediately and reported.
+
+        :param start: recipe time of the start mark (see MBERecipe.recipe_time), now if None
+        :type start: float
+        :return: (description, planned recipe time, achieved recipe time) of every event
+        :rtype: list of tuple
+        """
+        recipe = self.recipe
+        if start is None:
+            start = recipe.recipe_time()
+        self.report = []
+        self.lateness = LatencyHistogram()
+        self.checks = []
+        self.failures = []
+        self.superseded = 0
+        for offset, kind, arguments, description in sorted(self.events, key=lambda event: event[0]):
+            planned = start + offset
+            self.verify(planned - self.latency - 1.5 * self.readback_time)
+            recipe.wait_until(planned - self.latency, verbose=False)
+
+            sent = recipe.recipe_time()
+            try:
+                recipe.conn.send_many(self.commands(kind, arguments))
+            except RuntimeError as e:
+                recipe.ts_print("Error while firing {}: {}".format(description, e))  # Not confirmed when verifying
+            # The server executed the commands somewhere between sending them and getting the replies
+            achieved = (sent + recipe.recipe_time()) / 2.0
+            self.latency = 0.7 * self.latency + 0.3 * (achieved - sent)
+            self.lateness.record(max(achieved - planned, 0.0))
+            self.report.append((description, planned, achieved))
+            recipe.ts_print("t={:.3f}s (planned {:.3f}s, {:+.1f}ms): {}".format(
+                achieved, planned, (achieved - planned) * 1E3, description))
+            if achieved - planned > self.late_warning:
+                recipe.ts_print("Warning: {} fired {:.0f}ms late".format(description, (achieved - planned) * 1E3))
+            self.add_checks(kind, arguments, description, sent)
+        self.verify()
+
+        if self.report:
+            errors = [abs(achieved - planned) for description, planned, achieved in self.report]
+            recipe.ts_print("Timeline done, {} events off by: mean {:.1f}ms, max {:.1f}ms, {} late by more than "
+                            "{:.0f}ms".format(len(errors), sum(errors) / len(errors) * 1E3, max(errors) * 1E3,
+                                              len([error for error in errors if error > self.late_warning]),
+                                              self.late_warning * 1E3))
+        if self.superseded:
+            recipe.ts_print("{} readbacks were not checked before the next event changed the same parameter".format(
+                self.superseded))
+        if self.failures:
+            raise Exception("Error! Could not confirm: {}".format("; ".join(self.failures)))
+        return self.report
+
+    def add_checks(self, kind, arguments, description, sent):
+        """
+        Remembers the readbacks which confirm a fired event
+
+        :param sent: recipe time at which the commands of the event were sent
+        """
+        recipe = self.recipe
+        if kind == "shutter":
+            checks = [("Shutter." + shutter_name, "Get Shutter.{}".format(shutter_name), "open" if openbool else "closed")
+                      for shutter_name, openbool in zip(*arguments)]
+        else:
+            checks = [(parameter, "Get {}".format(recipe.readback_parameter(parameter)), value)
+                      for parameter, value in arguments]
+        for parameter, readback, expected in checks:
+            # A check of the same parameter from an earlier event can't be confirmed anymore
+            kept = [check for check in self.checks if check[0].lower() != parameter.lower()]
+            self.superseded += len(self.checks) - len(kept)
+            self.checks = kept + [(parameter, readback, expected, description, sent + recipe.readback.deadline(parameter))]
+
+    def verify(self, until=None):
+        """
+        Reads back the values of the fired events which are not confirmed yet, all of them in one batch per round. An
+        event which isn't confirmed before the deadline of its parameter class (see mbe_readback) is reported and added
+        to self.failures, its commands are not sent again.
+
+        :param until: recipe time at which to stop, the readbacks which are not confirmed yet are checked later. If None,
+            until all of them are confirmed or failed.
+        :type until: float
+        """
+        recipe = self.recipe
+        while self.checks:
+            started = recipe.recipe_time()
+            if until is not None and started >= until:
+                return
+            try:
+                replies = recipe.conn.send_many([check[1] for check in self.checks])
+            except RuntimeError:
+                replies = [None] * len(self.checks)
+            now = recipe.recipe_time()
+            self.readback_time = 0.7 * self.readback_time + 0.3 * (now - started)
+
+            pending = []
+            for check, reply in zip(self.checks, replies):
+                parameter, readback, expected, description, deadline = check
+                if reply is not None and recipe.is_set(expected, reply, recipe.readback.tolerance(parameter)):
+                    continue
+                if now >= deadline:
+                    self.failures.append("{} ({} gave {})".format(description, readback, reply))
+                    recipe.ts_print("Error! {} not confirmed: {} gave {}".format(description, readback, reply))
+                else:
+                    pending.append(check)
+            self.checks = pending
+            if self.checks:
+                pause = now + self.poll_interval
+                if until is not None:
+                    pause = min(pause, until)
+                recipe.wait_until(pause, verbose=False)
@@ -0,0 +1,123 @@
+"""
+Timing of the recipes. Waits are computed against a deadline on a monotonic clock instead of sleeping a number of
+times, so they don't accumulate drift and keep fractions of a second. Every wait measures how late it finished (its
+overshoot). Times can also be given as recipe time, the seconds elapsed since the recipe was started, ex: open a shutter
+exactly 600s after the start, independent of how long the steps before took.
+"""
+
+import ctypes, ctypes.util, math, sys
+from time import sleep, time
+
+from mbe_stats import LatencyHistogram
+
+
+def _monotonic_clock():
+    """
+    :return: function giving the time in seconds of a clock which never goes back (ex: when the system time is
+        corrected) and which counts wall time, not CPU time like time.clock does on Linux
+    """
+    try:
+        from time import monotonic  # Python 3
+        return monotonic
+    except ImportError:
+        pass
+    if sys.platform == "win32":
+        from time import clock  # QueryPerformanceCounter on Windows: monotonic wall time with sub-microsecond resolution
+        return clock
+
+    class Timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    try:
+        clock_gettime = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True).clock_gettime
+    except (OSError, AttributeError):
+        return time
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+    clock_id = 6 if sys.platform == "darwin" else 1  # CLOCK_MONOTONIC
+
+    def monotonic():
+        t = Timespec()
+        if clock_gettime(clock_id, ctypes.pointer(t)):
+            raise OSError(ctypes.get_errno(), "clock_gettime failed")
+        return t.tv_sec + t.tv_nsec * 1E-9
+
+    return monotonic
+
+
+monotonic = _monotonic_clock()
+
+
+class RecipeClock:
+    """
+    Clock of a recipe, waits until deadlines given in recipe time
+    """
+
+    def __init__(self, clock=monotonic, sleep=sleep, max_sleep=1.0):
+        """
+        :param clock: function giving the current time in seconds
+        :param sleep: function sleeping a number of seconds
+        :param max_sleep: longest single sleep in seconds, so that a long wait can still be interrupted with Ctrl+C.
+            None to sleep the whole wait at once.
+        :type max_sleep: float
+        """
+        self.clock = clock
+        self.sleep = sleep
+        self.max_sleep = max_sleep
+        self.start = clock()
+        self.overshoots = LatencyHistogram()  # How late the waits finished
+
+    @classmethod
+    def virtual(cls, conn):
+        """
+        Clock following the time of the virtual MBE server, which only goes forward with "Wait" commands
+
+        :param conn: connection to the virtual MBE server
+        :rtype: RecipeClock
+        """
+        # The virtual time goes forward in whole seconds, round up so that the deadline is always reached
+        return cls(clock=lambda: float(conn.send_command("Get time")),
+                   sleep=lambda seconds: conn.send_command("Wait {}".format(int(math.ceil(seconds)))),
+                   max_sleep=None)
+
+    def restart(self):
+        """
+        Sets the recipe time back to 0
+        """
+        self.start = self.clock()
+
+    def now(self):
+        """
+        :return: recipe time, the seconds since the clock was created or restarted
+        :rtype: float
+        """
+        return self.clock() - self.start
+
+    def wait(self, seconds):
+        """
+        Waits a number of seconds from now
+
+        :param seconds: time to wait in seconds
+        :type seconds: float
+        :return: overshoot, how many seconds later than asked the wait finished
+        :rtype: float
+        """
+        return self.wait_until(self.now() + seconds)
+
+    def wait_until(self, recipe_time):
+        """
+        Waits until a recipe time, returns immediately if it is already over
+
+        :param recipe_time: seconds since the start of the recipe
+        :type recipe_time: float
+        :return: overshoot, how many seconds after recipe_time the wait finished (the whole delay if recipe_time was
+            already over)
+        :rtype: float
+        """
+        while True:
+            remaining = recipe_time - self.now()
+            if remaining <= 0:
+                break
+            self.sleep(remaining if self.max_sleep is None else min(remaining, self.max_sleep))
+        overshoot = max(-remaining, 0.0)
+        self.overshoots.record(overshoot)
+        return overshoot
@@ -2,13 +2,22 @@
 Some functions that help in MBE growth
 """
 
+import sys
+
 import numpy as np
+from scipy.stats import chi2
+from collections import OrderedDict
 from datetime import datetime
-from time import sleep, clock
+from time import sleep, time
 
-from MBE_Tools import ServerConnection
+from MBE_Tools import ServerConnection, GATE_VALVE_STATES
 from Virtual_MBE.virtual_mbe_server_client import Connect
 from mbe_calibration import Calibration
+from mbe_stats import CommandStats
+from mbe_readback import ReadbackPolicy
+from mbe_timing import RecipeClock, monotonic
+from mbe_timeline import Timeline
+from mbe_settling import RollingWindow, SettlingDetector, SettlingHistory
 
 
 def ts_print(string):
@@ -33,10 +42,26 @@ class MBERecipe:
     a user's recipe and the MBE server.
     """
 
-    def __init__(self, virtual_server=False, scriptname=None, stdby_at_exit=True):
+    def __init__(self, virtual_server=False, scriptname=None, stdby_at_exit=True, snapshot_ttl=None,
+                 server_address=("10.18.7.24", "55001"), instrument=False):
+        """
+        :param virtual_server: whether to connect to the virtual MBE server instead of the real one
+        :type virtual_server: bool
+        :param scriptname: filename of the recipe, used to name the log file
+        :type scriptname: str
+        :param stdby_at_exit: whether to put the MBE in standby when exiting the recipe
+        :type stdby_at_exit: bool
+        :param snapshot_ttl: if set, get_param reads values from a cached status frame of the MBE server which is
+            refreshed when older than this many seconds (ex: 0.5). Only available with the real MBE server.
+        :type snapshot_ttl: float
+        :param server_address: (host, port) of the MBE server, or of a local mbe_proxy in front of it
+        :type server_address: tuple
+        :param instrument: record timing statistics of all commands, waits and retries and print them at exit
+        :type instrument: bool
+        """
         self.virtual_server = virtual_server
         if not self.virtual_server:
-            self.conn = ServerConnection("10.18.7.24", "55001", "xxa")
+            self.conn = ServerConnection(server_address[0], server_address[1], "xxa")
         else:
             # make a debugging server connection
             self.conn = Connect('localhost', 9999)
@@ -53,6 +78,22 @@ class MBERecipe:
         self.timer_start_time = 0
         self.stdby_at_exit = stdby_at_exit
 
+        # The virtual server doesn't provide the status frame, so snapshot mode is only possible on the real server
+        self.snapshot_ttl = snapshot_ttl if not self.virtual_server else None
+        self.snapshot = None
+        self.snapshot_time = 0
+        self.snapshot_fields = None
+
+        self.stats = CommandStats() if instrument else None
+        self.conn.stats = self.stats
+
+        # The virtual MBE doesn't behave like the real one, don't let it overwrite what was learned on the real one
+        self.readback = ReadbackPolicy(filename=None) if self.virtual_server else ReadbackPolicy()
+        self.settling = SettlingHistory(filename=None) if self.virtual_server else SettlingHistory()
+
+        # Recipe time, the virtual MBE has its own time which only goes forward with "Wait" commands
+        self.clock = RecipeClock.virtual(self.conn) if self.virtual_server else RecipeClock()
+
     def __enter__(self):
         return self
 
@@ -69,6 +110,17 @@ class MBERecipe:
             self.decrement_recipes_running()  # Decrement number of recipes flag
             self.set_process_interlock(False)
             self.conn.close()  # Close MBE server connection
+        if self.stats is not None:
+            self.ts_print(self.stats.summary())
+        if self.clock.overshoots.count:
+            self.ts_print("{} waits, finished late by: mean {:.1f}ms, max {:.1f}ms".format(
+                self.clock.overshoots.count, self.clock.overshoots.mean() * 1E3, self.clock.overshoots.max * 1E3))
+        if exc_type is None:  # What a failed recipe learned may be wrong
+            for learned in (self.readback, self.settling):
+                try:
+                    learned.save()
+                except (IOError, OSError) as e:
+                    print("Could not save {}: {}".format(learned.filename, e))
 
     def ts_print(self, string):
         """
@@ -88,6 +140,20 @@ class MBERecipe:
             with open(self.log_fn, 'a') as out_file:
                 out_file.write(print_string + "\n")
 
+    def pause(self, seconds, category):
+        """
+        Sleeps for a certain amount of time. When instrumented, the time is accounted to the given category.
+
+        :param seconds: time to sleep in seconds
+        :type seconds: float
+        :param category: what the time is spent on (ex: "verify sleep")
+        :type category: str
+        :return: None
+        """
+        sleep(seconds)
+        if self.stats is not None:
+            self.stats.add_time(category, seconds)
+
     def start_recipe(self):
         """
         Run just before starting a recipe. Increments number of running recipes and sets recipe running flag to true.
@@ -97,6 +163,37 @@ class MBERecipe:
         self.recipeStarted = True
         self.increment_recipes_running()
         self.set_process_interlock(True)
+        self.clock.restart()
+
+    def recipe_time(self):
+        """
+        :return: seconds since the recipe was started (or since the MBERecipe was created if start_recipe wasn't called)
+        :rtype: float
+        """
+        return self.clock.now()
+
+    def wait_until(self, recipe_time, verbose=True):
+        """
+        Waits until a given recipe time, ex: wait_until(600) continues exactly 10min after start_recipe, independent of
+        how long the steps before took. The wait is done against a deadline, so it keeps fractions of a second and
+        doesn't drift. Waits which finish noticeably late are reported.
+
+        :param recipe_time: seconds since the recipe was started
+        :type recipe_time: float, int
+        :param verbose: print the wait
+        :type verbose: bool
+        :return: overshoot, how many seconds after recipe_time the wait finished
+        :rtype: float
+        """
+        if verbose:
+            self.ts_print("Waiting until t={:.2f}s (now t={:.2f}s)".format(recipe_time, self.clock.now()))
+        start = time()
+        overshoot = self.clock.wait_until(recipe_time)
+        if self.stats is not None:
+            self.stats.add_time("waiting", time() - start)
+        if overshoot > 0.1 and not self.virtual_server:
+            self.ts_print("Warning: wait finished {:.3f}s late".format(overshoot))
+        return overshoot
 
     def get_param(self, parameter):
         """
@@ -108,20 +205,161 @@ class MBERecipe:
         :rtype: str
         """
 
+        if self.snapshot_ttl:
+            value = self.get_snapshot_value(parameter)
+            if value is not None:
+                return value
         return self.conn.send_command("Get {}".format(parameter))
 
-    def set_param(self, parameter, value, delay=0.1):
+    def get_params(self, parameters):
+        """
+        Returns the values of several parameters from the MBE server, sending all requests in a single batch.
+
+        :param parameters: IDs of the parameters that you want to know (ex: ['MBE.P', 'Shutter.Al', 'Ga.PV'])
+        :type parameters: list of str
+        :return: values of the parameters, as strings, in the same order as requested
+        :rtype: list of str
+        """
+        values = [None] * len(parameters)
+        if self.snapshot_ttl:
+            values = [self.get_snapshot_value(parameter) for parameter in parameters]
+
+        # Whatever is not part of the status frame gets asked for in one batch
+        missing = [i for i, value in enumerate(values) if value is None]
+        if missing:
+            replies = self.conn.send_many(["Get {}".format(parameters[i]) for i in missing])
+            for i, reply in zip(missing, replies):
+                values[i] = reply
+        return values
+
+    def get_snapshot_value(self, parameter):
+        """
+        Returns the value of a parameter from the cached status frame of the MBE server. The status frame contains all
+        temperatures, pressures, shutters etc. in one go and is fetched again once it is older than snapshot_ttl.
+
+        :param parameter: ID of the parameter that you want to know (ex: 'MBE.P', 'Shutter.Al', or 'Ga.PV')
+        :type parameter: str
+        :return: value of the parameter formatted like the reply to a "Get" command, None if it isn't in the frame
+        :rtype: str
+        """
+        if self.snapshot is None or time() - self.snapshot_time > self.snapshot_ttl:
+            self.snapshot = self.conn.getStatus(lazy=True)  # Only the columns which are asked for get decoded
+            self.snapshot_time = time()
+            if self.snapshot_fields is None:
+                self.snapshot_fields = dict([(name.lower(), name) for name in self.snapshot.names])
+
+        key = parameter.lower()
+        if key.startswith('shutter.'):
+            key = key.replace('shutter.', 'shutters.', 1)  # The bitfield section is called "Shutters" in the frame
+        field = self.snapshot_fields.get(key)
+        if field is None:
+            return None
+
+        value = self.snapshot[field][0]
+        if key.startswith('shutters.'):
+            return "Open" if value else "Closed"
+        elif key.startswith('gatevalves.'):
+            return GATE_VALVE_STATES[value]
+        elif isinstance(value, (bool, np.bool_)):
+            return str(bool(value))
+        elif isinstance(value, str):
+            return value
+        elif isinstance(value, np.floating):
+            return str(value)  # Shortest repr at the precision of the frame, ex: 1e-07 and not 1.00000001169e-07
+        return str(float(value))
+
+    def invalidate_snapshot(self):
+        """
+        Forgets the cached status frame so that the next read goes to the MBE server again. Called whenever the recipe
+        changes something on the MBE so that it always sees its own changes.
+
+        :return: None
         """
-        Set a parameter in the MBE, read it back to verify that its state has been set properly
+        self.snapshot = None
+
+    def set_param(self, parameter, value, delay=None):
+        """
+        Set a parameter in the MBE, read it back to verify that its state has been set properly. It is read back as
+        soon as it typically gets confirmed, then more and more rarely until the deadline of this kind of parameter (see
+        mbe_readback), after which the value is sent again.
 
         :param parameter: what parameter you want to set
         :type parameter: str
         :param value: what value should it get
         :type value: bool, str, int, float
-        :param delay: time to wait before trying to read the parameter (to check if it was set properly)
+        :param delay: time to wait before the first readback, by default the time this parameter usually takes
         :type value: int, float
         :return: None, returns once the parameter has been set properly
         """
+        self.set_params([(parameter, value)], delay)
+
+    def set_params(self, parameters, delay=None):
+        """
+        Set several parameters in the MBE, in the given order. All the values are sent in one batch and then all read
+        back in one batch, until all are confirmed. Only the ones which were not confirmed in time are sent again. Use
+        it instead of several set_param in a row, ex:
+
+            mbe.set_params(OrderedDict([("Ga.PV.Rate", 40), ("Ga.OP.Rate", 0), ("Ga.PV.TSP", 900)]))
+
+        :param parameters: parameters and the values they should get, in the order they have to be set
+        :type parameters: OrderedDict or list of (parameter, value) tuples (a normal dict has no order!)
+        :param delay: time to wait before the first readback, by default the time these parameters usually take
+        :type delay: int, float
+        :return: None, returns once all the parameters have been set properly
+        """
+        if hasattr(parameters, 'items'):
+            parameters = parameters.items()
+        pending = [(parameter, self.clamp_value(parameter, value)) for parameter, value in parameters]
+
+        MAX_SENDS = 3
+        sends = 1
+        self.invalidate_snapshot()
+        while True:
+            if len(pending) == 1:
+                self.conn.send_command("Set {} {}".format(*pending[0]))
+            else:
+                self.conn.send_many(["Set {} {}".format(parameter, value) for parameter, value in pending])
+            start = time()
+            deadline = start + max([self.readback.deadline(parameter) for parameter, value in pending])
+            schedules = [self.readback.schedule(parameter, delay) for parameter, value in pending]
+            due = [start + schedule.next() for schedule in schedules]  # When each value should be read back
+
+            while True:
+                self.pause(max(min(min(due), deadline) - time(), 0), "verify sleep")
+                readbacks = ["Get {}".format(self.readback_parameter(parameter)) for parameter, value in pending]
+                if len(readbacks) == 1:
+                    replies = [self.conn.send_command(readbacks[0])]
+                else:
+                    replies = self.conn.send_many(readbacks)
+                now = time()
+
+                failed = []
+                for k, ((parameter, value), srv_reply) in enumerate(zip(pending, replies)):
+                    if self.is_set(value, srv_reply, self.readback.tolerance(parameter)):
+                        self.readback.learn(parameter, now - start)
+                        if self.stats is not None:
+                            self.stats.record_retries(parameter, sends - 1)
+                    else:
+                        failed.append(k)
+                if not failed:
+                    return
+                last_replies = [(pending[k][0], pending[k][1], replies[k]) for k in failed]
+                pending = [pending[k] for k in failed]
+                if now >= deadline:
+                    break
+                schedules = [schedules[k] for k in failed]
+                due = [due[k] if due[k] > now else now + schedules[n].next() for n, k in enumerate(failed)]
+
+            if sends >= MAX_SENDS:
+                raise Exception("Error! Could not set {} to {}, got {}".format(*last_replies[0]))
+            sends += 1
+
+    def clamp_value(self, parameter, value):
+        """
+        Limits the setpoints of the cells and of the manipulator to their maximum temperature
+
+        :return: the value to set
+        """
         MAX_TEMPS = {'manip.pv.tsp': 900,
                      'in.pv.tsp': 830,
                      'ga.pv.tsp': 1020,
@@ -132,53 +370,55 @@ class MBERecipe:
                                                                                               MAX_TEMPS[
                                                                                                   parameter.lower()]))
                 value = MAX_TEMPS[parameter.lower()]
+        return value
 
-        MAX_TRIES = 10
-        tries = 1
-        while True:
-            self.conn.send_command("Set {} {}".format(parameter, value))
-
-            sleep(delay)
-            if parameter.lower() == 'manip.rs.rpm':
-                srv_reply = self.conn.send_command("Get Manip.RS")
-            elif parameter.lower() == 'ascracker.valve.op':
-                sleep(1)  # Give time for As valve to open respond
-                srv_reply = self.conn.send_command('Get AsCracker.Valve')
-            elif parameter.lower() == 'sbcracker.valve.op':
-                sleep(1)  # Give time for Sb valve to respond
-                srv_reply = self.conn.send_command('Get SbCracker.Valve')
-            else:
-                srv_reply = self.conn.send_command("Get {}".format(parameter))
-
-            if isinstance(value, bool):
-                set_properly = srv_reply.lower() == str(value).lower()  # Convert bool to string and do the comparison
-            elif isinstance(value, str):
-                set_properly = value.lower() == srv_reply.lower()  # Do direct string comparison
-                if (value.lower() == 'auto') and (
-                        srv_reply.lower() == 'pid'):  # Quick and dirty fix for problem when running virtual MBE server host
-                    set_properly = True  # TODO: fix this hack properly on the side of the MBE server
-            elif isinstance(value, int) or isinstance(value, float):
-                set_properly = abs(float(value) - float(srv_reply)) <= 0.1  # Convert to float and do comparison
-            else:
-                raise Exception("Unknown parameter type {}".format(type(value)))
-
-            if set_properly:
-                return
-            elif not set_properly and tries >= MAX_TRIES:
-                raise Exception("Error! Could not set {} to {}, got {}".format(parameter, value, srv_reply))
-            else:
-                sleep(1)  # Pause 1 second
-                tries += 1
-
-    def shutter(self, shutter_names, openbools):
+    def readback_parameter(self, parameter):
+        """
+        :return: the parameter to read to check that a parameter was set, some are read back under another name
+        :rtype: str
+        """
+        if parameter.lower() == 'manip.rs.rpm':
+            return "Manip.RS"
+        elif parameter.lower() == 'ascracker.valve.op':
+            return 'AsCracker.Valve'
+        elif parameter.lower() == 'sbcracker.valve.op':
+            return 'SbCracker.Valve'
+        return parameter
+
+    def is_set(self, value, srv_reply, tolerance=0.1):
+        """
+        :param tolerance: allowed difference for numbers
+        :return: whether the reply of the server corresponds to the value that was set
+        :rtype: bool
+        """
+        if isinstance(value, bool):
+            return srv_reply.lower() == str(value).lower()  # Convert bool to string and do the comparison
+        elif isinstance(value, str):
+            if (value.lower() == 'auto') and (
+                    srv_reply.lower() == 'pid'):  # Quick and dirty fix for problem when running virtual MBE server host
+                return True  # TODO: fix this hack properly on the side of the MBE server
+            return value.lower() == srv_reply.lower()  # Do direct string comparison
+        elif isinstance(value, int) or isinstance(value, float):
+            return abs(float(value) - float(srv_reply)) <= tolerance  # Convert to float and do comparison
+        raise Exception("Unknown parameter type {}".format(type(value)))
+
+    def shutter(self, shutter_names, openbools, simultaneous=False):
         """
         Open or close specific shutters in the MBE, double checks the shutter state after sending the value
 
+        By default the shutters are moved one after the other, each one being checked before the next one is moved. With
+        simultaneous=True all the commands are sent back-to-back in one batch and the shutters are then checked
+        together, so they move within a few milliseconds of each other (ex: at the interface between two layers).
+
         :param shutter_names: list of names of shutters to be manipulated
         :type shutter_names: str, list of str
         :param openbools: list of boolean values of shutter states (true = open, false = closed)
         :type openbools: bool, list of bool
-        :return: return once shutters have been set
+        :param simultaneous: send all the commands at once and check the shutters together
+        :type simultaneous: bool
+        :return: None, or with simultaneous=True the time in seconds between sending the commands and the readback
+            confirming the new state, for every shutter
+        :rtype: OrderedDict
         """
         if not type(shutter_names) == list:
             shutter_names = [shutter_names]
@@ -188,6 +428,11 @@ class MBERecipe:
         if not len(shutter_names) == len(openbools):
             raise Exception("Error, expected lists with the same length!")
 
+        self.invalidate_snapshot()
+
+        if simultaneous:
+            return self.shutters_simultaneous(shutter_names, ["Open" if openbool else "Close" for openbool in openbools])
+
         for shutter_name, openbool in zip(shutter_names, openbools):
             # Add check to make sure shutter is one of the valid shutters
             if openbool:
@@ -201,11 +446,11 @@ class MBERecipe:
             while True:
                 try:
                     self.conn.send_command("{} {}".format(value, shutter_name))
-                    sleep(0.1)
+                    self.pause(0.1, "verify sleep")
                     srv_reply = self.conn.send_command("Get Shutter.{}".format(shutter_name))
                 except RuntimeError:
                     tries += 1
-                    sleep(0.1)
+                    self.pause(0.1, "retry sleep")
                     continue
 
                 if value.lower() == 'close' and srv_reply.lower() == "closed":
@@ -214,11 +459,79 @@ class MBERecipe:
                     break
                 else:
                     tries += 1
-                    sleep(0.1)
+                    self.pause(0.1, "retry sleep")
 
             if tries > 3:
                 raise Exception("Error! Could not {} shutter {} after 3 tries".format(value, shutter_name))
 
+    def shutters_simultaneous(self, shutter_names, values):
+        """
+        Sends all the shutter commands back-to-back, then reads all the shutters back together until they are all
+        confirmed, see shutter(simultaneous=True). Shutters which are not confirmed before the deadline are sent again,
+        up to 3 times.
+
+        :param shutter_names: names of the shutters
+        :type shutter_names: list of str
+        :param values: "Open" or "Close" for every shutter
+        :type values: list of str
+        :return: time in seconds between sending the commands and the readback confirming the new state, for every
+            shutter. The resolution is the interval between two readbacks.
+        :rtype: OrderedDict
+        """
+        latencies = OrderedDict()
+        pending = zip(shutter_names, values)
+        sends = 1
+        while True:
+            start = time()
+            try:
+                self.conn.send_many(["{} {}".format(value, shutter_name) for shutter_name, value in pending])
+            except RuntimeError as e:
+                self.ts_print("Error while moving the shutters: {}".format(e))  # Checked below and sent again
+            deadline = start + self.readback.deadline("Shutter")
+            schedules = [self.readback.schedule("Shutter." + shutter_name) for shutter_name, value in pending]
+            due = [start + schedule.next() for schedule in schedules]
+
+            while True:
+                self.pause(max(min(min(due), deadline) - time(), 0), "verify sleep")
+                try:
+                    replies = self.conn.send_many(["Get Shutter.{}".format(shutter_name)
+                                                   for shutter_name, value in pending])
+                except RuntimeError:
+                    replies = [None] * len(pending)
+                now = time()
+
+                failed = []
+                for k, ((shutter_name, value), srv_reply) in enumerate(zip(pending, replies)):
+                    if srv_reply is not None and srv_reply.lower() == {"open": "open", "close": "closed"}[value.lower()]:
+                        latencies[shutter_name] = now - start
+                        self.readback.learn("Shutter." + shutter_name, now - start)
+                        if self.stats is not None:
+                            self.stats.record_shutter(shutter_name, now - start)
+                    else:
+                        failed.append(k)
+                pending = [pending[k] for k in failed]
+                if not failed:
+                    self.ts_print("Shutters moved: {}".format(", ".join(
+                        ["{} {} after {:.0f}ms".format(value.lower(), shutter_name, latencies[shutter_name] * 1E3)
+                         for shutter_name, value in zip(shutter_names, values)])))
+                    return latencies
+                if now >= deadline:
+                    break
+                schedules = [schedules[k] for k in failed]
+                due = [due[k] if due[k] > now else now + schedules[n].next() for n, k in enumerate(failed)]
+
+            if sends >= 3:
+                raise Exception("Error! Could not {} shutter {} after 3 tries".format(pending[0][1], pending[0][0]))
+            sends += 1
+
+    def timeline(self):
+        """
+        New timeline, to fire shutter and setpoint events at fixed times from a start mark, see mbe_timeline
+
+        :rtype: Timeline
+        """
+        return Timeline(self)
+
     def timer_start(self):
         """
         Starts the clock-based timer. Later use timer_wait to wait rest of amount of time since start_timer was called.
@@ -226,10 +539,7 @@ class MBERecipe:
         :return: None
         """
         self.ts_print("Starting timer.")
-        if self.virtual_server:
-            self.timer_start_time = float(self.conn.send_command('Get time'))
-        else:
-            self.timer_start_time = clock()
+        self.timer_start_time = self.clock.now()
 
     def timer_wait(self, seconds):
         """
@@ -241,20 +551,9 @@ class MBERecipe:
         :param seconds: Number of seconds to wait.
         :return: Returns None once the timer is up.
         """
-
-        if self.virtual_server:
-            now = float(self.conn.send_command('Get time'))
-        else:
-            now = clock()
-
-        self.ts_print(
-            "Waiting {} seconds, of which {:.2f}s already elapsed.".format(seconds, now - self.timer_start_time))
-
-        if self.virtual_server:
-            self.conn.send_command('Wait {}'.format(now - (self.timer_start_time + seconds)))
-        else:
-            while clock() < (self.timer_start_time + seconds):
-                sleep(1)
+        self.ts_print("Waiting {} seconds, of which {:.2f}s already elapsed.".format(
+            seconds, self.clock.now() - self.timer_start_time))
+        self.wait_until(self.timer_start_time + seconds, verbose=False)
         self.ts_print("Timer is up!")
         return
 
@@ -357,49 +656,73 @@ class MBERecipe:
 
     def read_pressures(self, delay=1, n=20, error=0.02, max_t=60):
         """
-        Reads the pressures of the BFM and MBE, returning the mean values from all n measurements of each
+        Reads the pressures of the BFM and MBE, returning the mean values from the last n measurements of each, see
+        read_pressures_stats
+
         :param max_t: maximum acquisition time before returning (in seconds)
         :param error: percent error of reading desired as exit criteria
         :param delay: delay between successive measurements (in seconds)
-        :param n: number of measurements to take (statistics)
-        :return: returns the mean of both pressures in the format (BFM_pressure, MBE_pressure)
+        :param n: largest number of measurements used for the statistics
+        :return: returns the mean of both pressures and their standard deviations in the format (BFM_pressure,
+            MBE_pressure, BFM_std, MBE_std)
         """
+        stats = self.read_pressures_stats(delay=delay, n=n, error=error, max_t=max_t)
+        return stats["BFM.P"], stats["MBE.P"], stats["BFM.P std"], stats["MBE.P std"]
 
-        start_time = clock()
+    def read_pressures_stats(self, delay=1, n=20, error=0.02, max_t=60):
+        """
+        Reads the pressures of the BFM and MBE until the BFM pressure is precise enough
 
-        ps_bfm = []
-        ps_mbe = []
-        # Read the BFM and MBE pressures repeatedly until have n data points and the error is small enough
-        while True:
-            ps_bfm.append(float(self.get_param("BFM.P")))
-            ps_mbe.append(float(self.get_param("MBE.P")))
-
-            # If have acquired more datapoints than required, remove oldest point
-            if len(ps_bfm) > n:
-                ps_bfm = ps_bfm[1:]
-                ps_mbe = ps_mbe[1:]
-
-            # If have full dataset (n), perform statistics + see if we have enough precision to exit the loop
-            if len(ps_bfm) == n:
-                p_bfm = np.mean(ps_bfm)
-                p_bfm_std = np.std(ps_bfm)
-                # Precision achieved
-                if (p_bfm_std / p_bfm) < error:
-                    self.ts_print('Precision reached! Error = +/-{:.2f}%'.format(p_bfm_std / p_bfm * 100))
-                    break
-                # Timeout condition
-                if clock() > (start_time + max_t):
-                    self.ts_print('Timeout reached! Error = +/-{:.2f}%'.format(p_bfm_std / p_bfm * 100))
-                    break
+        Both pressures are read in one batch per measurement. From the third reading on, the measurement stops as soon
+        as the relative scatter of the BFM readings is below the error with 95% confidence (upper confidence bound of
+        their standard deviation), which can be after a few readings when the pressure is stable. Otherwise it stops
+        once the scatter of the last n readings is below the error, or once max_t is over.
 
-            sleep(delay)
+        :param max_t: maximum acquisition time before returning (in seconds)
+        :param error: percent error of reading desired as exit criteria
+        :param delay: delay between successive measurements (in seconds)
+        :param n: largest number of measurements used for the statistics
+        :return: mean and standard deviation of both pressures over the last n readings ("BFM.P", "MBE.P", "BFM.P std",
+            "MBE.P std"), number of readings taken ("readings") and whether the precision was reached ("precise")
+        :rtype: dict
+        """
+        start_time = self.clock.now()
 
-        p_mbe = np.mean(ps_mbe)
-        p_mbe_std = np.std(ps_mbe)
+        window_bfm = RollingWindow(n)
+        window_mbe = RollingWindow(n)
+        # Read the BFM and MBE pressures repeatedly until the error is small enough
+        readings = 0
+        while True:
+            p_bfm, p_mbe = self.get_params(["BFM.P", "MBE.P"])
+            window_bfm.add(float(p_bfm))
+            window_mbe.add(float(p_mbe))
+            readings += 1
+
+            k = window_bfm.count
+            p_bfm, p_bfm_std = window_bfm.mean, window_bfm.std
+            # Relative error, a gauge reading 0 is never precise
+            relative = p_bfm_std / abs(p_bfm) if p_bfm else float("inf")
+            # Upper bound of the standard deviation of the readings, 95% confidence
+            precise = k >= 3 and window_bfm.std * np.sqrt(k / chi2.ppf(0.05, k - 1)) < error * abs(p_bfm)
+            # Precision achieved, with a full window the scatter itself is enough like before
+            if precise or (window_bfm.full and relative < error):
+                precise = True
+                self.ts_print('Precision reached after {} readings! Error = +/-{:.2f}%'.format(readings, relative * 100))
+                break
+            # Timeout condition
+            if self.clock.now() > (start_time + max_t):
+                self.ts_print('Timeout reached! Error = +/-{:.2f}%'.format(relative * 100))
+                break
+
+            self.wait_until(start_time + readings * delay, verbose=False)
+
+        p_mbe = window_mbe.mean
+        p_mbe_std = window_mbe.std
 
         self.ts_print('BFM={}+/-{}, MBE={}+/-{}'.format(p_bfm, p_bfm_std, p_mbe, p_mbe_std))
 
-        return p_bfm, p_mbe, p_bfm_std, p_mbe_std
+        return {"BFM.P": p_bfm, "MBE.P": p_mbe, "BFM.P std": p_bfm_std, "MBE.P std": p_mbe_std, "readings": readings,
+                "precise": precise}
 
     def bfm(self, insert=False):
         """
@@ -432,132 +755,241 @@ class MBERecipe:
             else:
                 self.ts_print("BFM retracted")
 
-    def converge_with_bfm(self, p_desired, calib_As, iterations=3, datapoints=30, withdraw_bfm=True):
+    def converge_with_bfm(self, p_desired, calib_As, iterations=3, datapoints=30, withdraw_bfm=True, tolerance=0.02,
+                          settle_time=10):
         """
         Converges with the BFM to a desired As flux. Only As supported right now.
 
+        Starts from the opening given by the calibration, then corrects it with Newton steps using the slope of the
+        calibration curve (secant steps through the measured points once there are two of them), until the measured
+        pressure is within the tolerance. After every change of the valve, the pressure is given settle_time and then
+        measured until the last three measurements don't drift anymore, instead of always waiting the worst case.
+
         Use in recipe like: mbe.converge_with_bfm(2.5E-6,calib_As)
 
-        :param withdraw: Whether or not to withdraw BFM at end of function (for if you want to do more measurements)
+        :param withdraw_bfm: Whether or not to withdraw BFM at end of function (for if you want to do more measurements)
         :param p_desired: The desired pressure that you want to reach
         :param calib_As: Arsenic calibration structure that you want to use to converge
-        :param iterations: Number of iterations performed for pressure convergence
-        :param datapoints: Number of datapoints to take with the BFM at each iteration
+        :param iterations: Maximum number of corrections of the As opening
+        :param datapoints: Maximum number of datapoints to take with the BFM for every measurement
+        :param tolerance: Relative error of the pressure at which to stop, ex: 0.02 for 2%
+        :param settle_time: Minimum time in seconds between moving the valve and measuring
         :return: The optimized As opening value
         """
         self.ts_print("Converging with BFM to {}".format(p_desired))
         f_interp = calib_As.get_interpolator()
-        self.bfm(insert=True)
-        offset = 0
+        p_min, p_max = calib_As.bfm_data['BFM.P'].min(), calib_As.bfm_data['BFM.P'].max()
+
+        def calibration_slope(p):
+            # Slope of the opening vs. pressure calibration around p, kept inside the calibration range
+            p = min(max(p, p_min), p_max)
+            h = 0.02 * (p_max - p_min)
+            p_low, p_high = max(p - h, p_min), min(p + h, p_max)
+            if p_high <= p_low:  # Calibration of a single pressure, assume the pressure is proportional to the opening
+                return float(f_interp(p)) / p if p > 0 else 0.0
+            return (float(f_interp(p_high)) - float(f_interp(p_low))) / (p_high - p_low)
+
+        def measure():
+            # The pressure needs some time to settle after moving the valve. Measure until the trend of the last three
+            # measurements, extrapolated over another settle time, stays within the tolerance.
+            self.waiting(settle_time, verbose=False)
+            times, pressures = [], []
+            for k in range(10):
+                p_bfm, p_mbe, p_bfm_std, p_mbe_std = self.read_pressures(delay=1.0, n=datapoints, error=0.02)
+                times.append(self.clock.now())
+                pressures.append(p_bfm)
+                if len(pressures) >= 3:
+                    t = np.array(times[-3:]) - times[-3]
+                    slope = np.polyfit(t, pressures[-3:], 1)[0] if t[-1] > 0 else 0.0
+                    if abs(slope) * max(settle_time, t[-1]) < tolerance / 2. * p_desired:
+                        return float(np.mean(pressures[-3:]))
+            self.ts_print("BFM pressure still drifting: {}".format(", ".join(["{:.2e}".format(p) for p in pressures])))
+            return p_bfm
 
-        # Modify the interpolator using the measured bfm pressure and move to next iteration
-        def f_interp_new(interp, p, _offset):
-            return float(interp(p + _offset))
-
-        self.set_param("AsCracker.Valve.OP", f_interp_new(f_interp, p_desired, offset))
+        self.bfm(insert=True)
+        optimized_as_opening = calib_As.calc_setpoint(p_desired)
+        self.set_param("AsCracker.Valve.OP", optimized_as_opening)
 
+        points = []  # Measured (opening, pressure)
         for i in range(iterations):
-            self.waiting(30)
             self.ts_print("Measuring BFM pressure")
-            p_bfm, _ = self.read_pressures(delay=1.0, n=datapoints, error=0.02)
-            offset += p_desired - p_bfm
-            optimized_as_opening = f_interp_new(f_interp, p_desired, offset)
+            p_bfm = measure()
+            points.append((optimized_as_opening, p_bfm))
+            if abs(p_bfm - p_desired) <= tolerance * p_desired:
+                self.ts_print("BFM pressure {:.2e} is within {:.1f}% of {:.2e}".format(p_bfm, tolerance * 100,
+                                                                                       p_desired))
+                break
+
+            slope = calibration_slope(p_bfm)
+            if len(points) > 1:
+                (x0, p0), (x1, p1) = points[-2:]
+                # Secant through the last two measurements, if they are far enough apart to give a sensible slope
+                if abs(p1 - p0) > tolerance * p_desired and (x1 - x0) / (p1 - p0) > 0:
+                    slope = (x1 - x0) / (p1 - p0)
+            optimized_as_opening = min(max(optimized_as_opening + slope * (p_desired - p_bfm), 0), 100)
+            self.ts_print("BFM pressure {:.2e} instead of {:.2e}, setting As valve to {:.2f}".format(
+                p_bfm, p_desired, optimized_as_opening))
             self.set_param("AsCracker.Valve.OP", optimized_as_opening)
-            self.ts_print("Adjusting calibration curve by {:.2e}".format((p_desired - p_bfm)))
-            self.ts_print("Set As valve to {:.2f}".format(f_interp_new(f_interp, p_desired, offset)))
 
         if withdraw_bfm:
             self.bfm(insert=False)
 
         return optimized_as_opening
 
+    def wait_for_all(self, targets, error=1, n=10, timeout=None, poll=1.0):
+        """
+        Waits until several controllers reach their temperature, ex: after ramping the manipulator and the cells
+        together:
+
+            mbe.wait_for_all({"Manip": 750, "Ga": None, "In": 780})
+
+        All the controllers are read in one batch per tick. A controller has reached its temperature when the mean of
+        its last n readings is within error of it and their standard deviation below error/2, or as soon as it went
+        past it if it is only an intermediate temperature on the way to its setpoint.
+
+        :param targets: controller (PID) name: temperature to reach, or None to wait for its current setpoint
+        :type targets: dict
+        :param error: error within which +/- the temperatures should be reached, for all or per controller
+        :type error: float, int, dict
+        :param n: number of readings which have to be within the error
+        :type n: int
+        :param timeout: maximum time to wait in seconds, no timeout if None
+        :type timeout: float, int
+        :param poll: time between two readings in seconds
+        :type poll: float, int
+        :return: controller name: seconds until it reached its temperature, None for the ones which didn't before the
+            timeout
+        :rtype: OrderedDict
+        """
+        pids = sorted(targets)
+        errors = dict([(pid, float(error[pid] if isinstance(error, dict) else error)) for pid in pids])
+        values = self.get_params(["{}.PV".format(pid) for pid in pids] + ["{}.PV.TSP".format(pid) for pid in pids])
+        current = dict(zip(pids, [float(value) for value in values[:len(pids)]]))
+        setpoints = dict(zip(pids, [float(value) for value in values[len(pids):]]))
+        temps = dict([(pid, setpoints[pid] if targets[pid] is None else float(targets[pid])) for pid in pids])
+        # Targets different from the setpoint are only passed through, they count as reached once crossed
+        directions = dict([(pid, np.sign(temps[pid] - current[pid])) for pid in pids])
+        passing = dict([(pid, abs(setpoints[pid] - temps[pid]) > errors[pid]) for pid in pids])
+
+        self.ts_print("Waiting for {}".format(", ".join(["{} to reach {:.2f}".format(pid, temps[pid]) for pid in pids])))
+        reached = OrderedDict([(pid, None) for pid in pids])
+        windows = dict([(pid, RollingWindow(n)) for pid in pids])
+        pending = list(pids)
+        start = self.clock.now()
+        tick = 0
+        while True:
+            readings = self.get_params(["{}.PV".format(pid) for pid in pending])
+            now = self.clock.now()
+            for pid, reading in zip(list(pending), readings):
+                window = windows[pid]
+                window.add(float(reading))
+                if passing[pid] and (float(reading) - temps[pid]) * directions[pid] >= 0:
+                    self.ts_print("{} passed {:.2f} after {:.0f}s".format(pid, temps[pid], now - start))
+                elif window.full and abs(window.mean - temps[pid]) < errors[pid] and window.std < errors[pid] / 2.:
+                    self.ts_print("{} reached {:.2f}+/-{:.2f} after {:.0f}s".format(pid, window.mean, window.std,
+                                                                                   now - start))
+                else:
+                    continue
+                reached[pid] = now - start
+                pending.remove(pid)
+            if not pending:
+                return reached
+            if timeout is not None and now - start > timeout:
+                self.ts_print("Timeout reached! Still waiting for {}".format(", ".join(
+                    ["{} (T = {:.2f}+/-{:.2f})".format(pid, windows[pid].mean, windows[pid].std) for pid in pending])))
+                return reached
+            tick += 1
+            self.wait_until(start + tick * poll, verbose=False)
+
     def wait_to_reach_temp(self, temp=None, PID='Manip', error=1, n=10, timeout_on=True):
         """
         Wait until mbe manipulator or one of the cells reaches a certain temperature
 
+        The approach is followed with a SettlingDetector (see mbe_settling): the temperature is read rarely while it is
+        far away and every second once it gets close, with a live estimate of the remaining time. It has reached the
+        temperature once the readings within the error are statistically stable, which takes a few readings when the
+        temperature is stable and up to n readings when it is noisy. How long each controller took is remembered, the
+        timeout depends on it.
+
         :param temp: temperature you are waiting to reach
         :type temp: float, int
+        :param PID: name of the controller, ex: "Manip" or "Ga"
+        :type PID: str
         :param error: error within which +/- the temperature should be reached
         :type error: float, int
+        :param n: largest number of readings needed to decide that the temperature is reached
+        :type n: int
+        :param timeout_on: give up when the controller takes much longer than usual
+        :type timeout_on: bool
         :return: None, returns once temperature has been reached
         """
-        # TODO: make temp input optional, if none is provided simply waits until temp reaches the TSP
-        if self.virtual_server:
-            start_time = float(self.conn.send_command('Get time'))
-        else:
-            start_time = clock()
+        start_time = self.clock.now()
 
+        t_current, t_tsp, t_rate = [float(value) for value in self.get_params(
+            ["{:s}.PV".format(PID), "{:s}.PV.TSP".format(PID), "{:s}.PV.Rate".format(PID)])]
         # If no temp was passed to the function, wait until current setpoint is reached
         if not temp:
-            temp = float(self.get_param("{:s}.PV.TSP".format(PID)))
+            temp = t_tsp
 
         self.ts_print("Waiting to reach {:s} temperature of {:.2f}".format(PID, temp))
         if not timeout_on:
             self.ts_print("Note: Timeout condition is off.".format(PID, temp))
 
-        t_current = float(self.get_param("{:s}.PV".format(PID)))
-        t_tsp = float(self.get_param("{:s}.PV.TSP".format(PID)))
-
         # Have already passed the temperature that we want to reach
         if (t_tsp <= t_current <= temp) or (t_tsp >= t_current >= temp):
             self.ts_print('Temp reached! Current T = {:.2f}'.format(t_current))
             return
 
-        t_rate = float(self.get_param("{:s}.PV.Rate".format(PID)))
-        est_time = abs(t_current - temp) / t_rate * 60.0 - 3
-        self.waiting(int(est_time))
+        ramp_time = abs(t_current - temp) / t_rate * 60.0 if t_rate > 0 else 0.0
+        max_t = self.settling.timeout(PID, ramp_time)
+        self.ts_print("Expected to take {:.0f}s".format(self.settling.expected_time(PID, ramp_time)))
 
-        max_t = est_time * 10.
-
-        latest_temps = []
+        detector = SettlingDetector(temp, error, rate=t_rate / 60.0 if t_rate > 0 else None, max_samples=n)
+        direction = np.sign(temp - t_current)
+        passing = abs(t_tsp - temp) > error  # Only an intermediate temperature on the way to the setpoint
+        next_report = 0
         while True:
-            if self.virtual_server:
-                self.waiting(1, verbose=False)
-            else:
-                sleep(1)
-            latest_temps.append(float(self.get_param("{:s}.PV".format(PID))))
-
-            if len(latest_temps) > n:
-                latest_temps = latest_temps[1:]
+            t_current = float(self.get_param("{:s}.PV".format(PID)))
+            now = self.clock.now() - start_time
+            if passing and (t_current - temp) * direction >= 0:
+                self.ts_print('Temp reached! Current T = {:.2f}'.format(t_current))
+                return
+            if detector.add(now, t_current):
+                values = np.array(detector.values[detector.band_start:][-n:])
+                self.ts_print('Temp reached! Current T = {:.2f}+/-{:.2f} after {:.0f}s'.format(
+                    values.mean(), values.std(), now))
+                self.settling.learn(PID, ramp_time, detector)
+                return
 
-            if len(latest_temps) == n:
-                t_current = np.mean(latest_temps)
-                t_current_std = np.std(latest_temps)
-                if abs(t_current - temp) < error and t_current_std < (error / 2.):
-                    self.ts_print('Temp reached! Current T = {:.2f}+/-{:.2f}'.format(t_current, t_current_std))
-                    return
+            # Timeout condition
+            if timeout_on and now > max_t:
+                self.ts_print('Timeout reached! Current T = {:.2f}'.format(t_current))
+                return
 
-                # Timeout condition
-                if self.virtual_server:
-                    now = float(self.conn.send_command('Get time'))
-                else:
-                    now = clock()
-                if timeout_on and now > (start_time + max_t):
-                    self.ts_print('Timeout reached! Current T = {:.2f}+/-{:.2f}'.format(t_current, t_current_std))
-                    break
+            eta = detector.eta()
+            if now >= next_report and eta:
+                self.ts_print("{:s} at {:.2f}, about {:.0f}s to go".format(PID, t_current, eta))
+                next_report = now + 60
+            # Read rarely while far away, every second once close
+            interval = 1.0 if eta is None else min(max(eta / 3., 1.0), 30.0)
+            self.wait_until(self.clock.now() + interval, verbose=False)
 
     def waiting(self, wait_time, verbose=True):
         """
-        Waits a certain amount of time before continuing, gets rounded down to nearest second. TIP: can use instead the
-        timer_start and timer_wait functions for more robust timing (in some cases).
+        Waits a certain amount of time before continuing, with sub-second resolution. TIP: can use instead the
+        timer_start and timer_wait functions, or wait_until, to wait until a fixed time independent of how long the
+        previous steps took.
 
         :param time: time in seconds that you want to wait
         :type time: float, int
-        :return: None, once timer is up
+        :return: overshoot, how many seconds longer than wait_time the wait took
+        :rtype: float
         """
         # TODO: Add a shorter wait during debugging mode of a recipe
 
         if verbose:
             self.ts_print("Waiting {}s".format(wait_time))
-        if self.virtual_server:
-            self.conn.send_command('Wait {}'.format(wait_time))
-        else:  # Normal recipe
-            for i in xrange(int(round(wait_time))):
-                sleep(1.0)
-
-            # for _ in trange(0, int(round(wait_time)), desc='Waiting', ascii=True):
-            # for _ in range(0, int(round(wait_time))):
-            #     sleep(1 - time() % 1)  # sleep until a whole second boundary
+        return self.wait_until(self.clock.now() + wait_time, verbose=False)
 
     def check_stdby(self):
         """
@@ -578,17 +1010,24 @@ class MBERecipe:
             # "SbCracker.PV": (795, 805),  # Double check this! ****************************
             "SUKO.OP": (-0.1, 10.1),
             "SUSI.OP": (-0.1, 10.1)}
+        shutters = ['In', 'Ga', 'As', 'Al', 'Sb', 'SUSI', 'SUKO']
+
+        # Read everything in one batch
+        params = stdby_chk_dict.keys()
+        values = self.get_params(params + ["Shutter.{}".format(shutter) for shutter in shutters])
+        readings = dict(zip(params, values[:len(params)]))
+        shutter_states = dict(zip(shutters, values[len(params):]))
+
         for param, val in stdby_chk_dict.iteritems():
-            value = float(self.get_param(param))
+            value = float(readings[param])
             if not (val[0] < value < val[1]):
                 self.ts_print(
                     'Check Standby Failed: condition {} < {} < {} not fulfilled'.format(val[0], param, val[1]))
                 stdby = False
 
         # Check if all shutters are closed
-        shutters = ['In', 'Ga', 'As', 'Al', 'Sb', 'SUSI', 'SUKO']
         for shutter in shutters:
-            if not (self.get_param("Shutter.{}".format(shutter)).lower() == "closed"):
+            if not (shutter_states[shutter].lower() == "closed"):
                 self.ts_print('Check Standby Failed: {} Shutter Open'.format(shutter))
                 stdby = False
         return stdby
@@ -600,9 +1039,14 @@ class MBERecipe:
 
         :return: None
         """
-        # Close all shutters
+        # Close all shutters. If one of them fails, the valves and cells are still put in standby before raising it
         shutters = ['In', 'Ga', 'As', 'Al', 'Sb', 'SUSI', 'SUKO', 'Viewport', 'Pyrometer']
-        self.shutter(shutters, [False] * len(shutters))
+        shutter_error = None
+        try:
+            self.shutter(shutters, [False] * len(shutters), simultaneous=True)
+        except Exception as e:
+            self.ts_print("ERROR, COULDN'T CLOSE THE SHUTTERS: {}".format(e))
+            shutter_error = sys.exc_info()
 
         # Close Arsenic/Antimony Valves
         self.set_param("AsCracker.Valve.OP", 0)
@@ -621,12 +1065,14 @@ class MBERecipe:
             "Ga": {"PV.TSP": 550, "PV.Rate": 40},
             "Al": {"PV.TSP": 750, "PV.Rate": 10},
             "Sb": {"PV.TSP": 380, "PV.Rate": 5}}
+        cells = stdby_set_dict.keys()
+        cell_temps = dict(zip(cells, self.get_params(["{}.PV".format(key) for key in cells])))
         for key, value in stdby_set_dict.iteritems():
-            if float(self.get_param("{}.PV".format(key))) <= value["PV.TSP"]:  # Don't ramps up cold cells or manip
+            if float(cell_temps[key]) <= value["PV.TSP"]:  # Don't ramps up cold cells or manip
                 continue
-            self.set_param("{}.Mode".format(key), "Auto")
-            self.set_param("{}.PV.Rate".format(key), value["PV.Rate"])
-            self.set_param("{}.PV.TSP".format(key), value["PV.TSP"])
+            self.set_params([("{}.Mode".format(key), "Auto"),
+                             ("{}.PV.Rate".format(key), value["PV.Rate"]),
+                             ("{}.PV.TSP".format(key), value["PV.TSP"])])
 
         # Ramp down all Manual doping cells to standby values)
         stdby_set_doping_dict = {
@@ -634,9 +1080,9 @@ class MBERecipe:
             # "SUSI": {"OP.TSP": 10, "OP.Rate": 2}
                                 }
         for key, value in stdby_set_doping_dict.iteritems():
-            self.set_param("{}.Mode".format(key), "Manual")
-            self.set_param("{}.OP.Rate".format(key), value["OP.Rate"])
-            self.set_param("{}.OP.TSP".format(key), value["OP.TSP"])
+            self.set_params([("{}.Mode".format(key), "Manual"),
+                             ("{}.OP.Rate".format(key), value["OP.Rate"]),
+                             ("{}.OP.TSP".format(key), value["OP.TSP"])])
 
         # # Retract BFM, if it throws an error, don't worry about it (ex: loss of communication), deal with it later
         # try:
@@ -644,6 +1090,9 @@ class MBERecipe:
         # except:
         #     pass
 
+        if shutter_error is not None:
+            raise shutter_error[0], shutter_error[1], shutter_error[2]
+
     def reinit_cells(self, cell):
         """
         Just re-initializes all the parameters in each Eurotherm, seems to solve the problem of having NaN values read